@@ -1,5 +1,7 @@
+import asyncio
 import logging
 import math
+import time
 from pathlib import Path
 
 from aiogram import Router
@@ -50,12 +52,25 @@ from app.repositories.user_profile import (
     spend_energy,
 )
 from app.config import settings
+from app.services.admission import admission_controller
+from app.services.context_builder import build_reply_context
 from app.services.image_client import ImageClient
+from app.services.queue_service import TaskStatus, TaskType
 from app.services.venice_client import VeniceClient
 from app.bot.task_helpers import (
+    NoWorkerAvailableError,
+    enqueue_dialog_photo_generation,
     enqueue_image_generation,
     enqueue_reply_generation,
+    find_request_task,
+    format_queue_status,
+    format_rejection,
+    idempotent_request,
+    invalidate_task_lane,
+    make_request_key,
     send_image_from_task_result,
+    take_over_task,
+    wait_for_duplicate_result,
     wait_for_task_result,
 )
 
@@ -105,6 +120,21 @@ async def safe_edit_media(message: Message, media, reply_markup=None) -> None:
 # Хранит ссылку на сообщение-предупреждение, которое нужно удалить после генерации
 _generating_images: dict[int, Message | None] = {}
 
+# Сколько ждать ответ из очереди, прежде чем генерировать его напрямую (секунды)
+_REPLY_WAIT_TIMEOUT = 60.0
+
+# Сколько ждать фото из очереди, прежде чем отменить задачу и вернуть алмазы (секунды)
+_IMAGE_WAIT_TIMEOUT = 120.0
+
+# Заголовок сообщения о ходе генерации фото
+_IMAGE_STATUS_TITLE = "🎨 Генерирую фото..."
+
+# Ответ на повторное нажатие, пока фото по тому же запросу ещё генерируется
+_IMAGE_IN_PROGRESS_TEXT = "⏳ Это фото уже генерируется, подожди немного."
+
+# Ответ на повторную доставку нажатия, которое уже обработано
+_IMAGE_HANDLED_TEXT = "✅ Это нажатие уже обработано."
+
 # Путь к папке с изображениями девушек
 GIRLS_IMAGES_DIR = Path("girls_images")
 
@@ -360,6 +390,38 @@ async def handle_generate_image(message: Message) -> None:
         await message.answer("⚠️ Не могу определить пользователя.")
         return
 
+    # Повторная доставка команды не списывает алмазы второй раз
+    request_key = make_request_key(TaskType.GENERATE_IMAGE, message.from_user.id, None, message.message_id)
+    async with idempotent_request(request_key) as (first, task_id):
+        if not first:
+            await _attach_to_image_request(message, task_id)
+            return
+        await _generate_image(message, request_key)
+
+
+async def _attach_to_image_request(message: Message, task_id: str, callback: CallbackQuery | None = None) -> None:
+    """
+    Присоединяет повтор запроса фото к задаче первого запроса.
+    
+    Для нажатия кнопки (callback) пользователь получает ответ во
+    всплывающем уведомлении, иначе - сообщением.
+    """
+    if await find_request_task(task_id) is None:
+        # Запрос уже обработан: фото отправил первый обработчик
+        if callback is not None:
+            await callback.answer(_IMAGE_HANDLED_TEXT)
+        return
+    if callback is not None:
+        await callback.answer(_IMAGE_IN_PROGRESS_TEXT)
+    else:
+        await message.answer(_IMAGE_IN_PROGRESS_TEXT)
+    task = await wait_for_duplicate_result(task_id, timeout=_IMAGE_WAIT_TIMEOUT)
+    if task is not None and task.result:
+        await send_image_from_task_result(message.bot, message, task.result, task.data.get("girl_name") or "photo")
+
+
+async def _generate_image(message: Message, request_key: str) -> None:
+    """Списывает алмазы и генерирует изображение текущего персонажа через очередь."""
     async with get_session() as session:
         # Проверяем наличие алмазов
         diamonds = await get_user_diamonds(session, user_id=message.from_user.id)
@@ -399,6 +461,12 @@ async def handle_generate_image(message: Message) -> None:
             await message.answer("⚠️ Персонажи пока не настроены. Попробуй позже.")
             return
         
+        # Не ставим задачу в перегруженную очередь: отказываем до списания алмазов
+        admission = await admission_controller.check(TaskType.GENERATE_IMAGE)
+        if not admission.admitted:
+            await message.answer(f"{format_rejection(admission.eta)} Алмазы не списаны.")
+            return
+        
         # Списываем алмазы
         await spend_diamonds(session, user_id=message.from_user.id, amount=settings.image_generation_cost)
         await session.commit()
@@ -422,21 +490,34 @@ async def handle_generate_image(message: Message) -> None:
     try:
         # Отправляем сообщение о начале генерации
         status_message = await message.answer(
-            "🎨 Генерирую фото...\n"
-            "⏱️ Генерация может занять обычно 20 секунд, пожалуйста, подождите."
+            format_queue_status(_IMAGE_STATUS_TITLE, TaskStatus.PENDING, admission.ahead, admission.eta)
         )
         
-        # Добавляем задачу в очередь
+        # Добавляем задачу в очередь. После deadline воркер её не начнёт, а начатую прервёт
         task_id = await enqueue_image_generation(
             user_id=message.from_user.id,
             prompt=prompt,
             girl_id=girl.id,
+            deadline=time.time() + _IMAGE_WAIT_TIMEOUT,
+            idempotency_key=request_key,
         )
         
         # Ожидаем результат (используем бот из контекста сообщения)
         from aiogram import Bot
         bot = message.bot
-        task_result = await wait_for_task_result(bot, message, task_id)
+        task_result = await wait_for_task_result(
+            bot,
+            message,
+            task_id,
+            timeout=_IMAGE_WAIT_TIMEOUT,
+            status_message=status_message,
+            status_title=_IMAGE_STATUS_TITLE,
+            task_type=TaskType.GENERATE_IMAGE,
+        )
+        if task_result is None:
+            # Не дождались: отменяем задачу, чтобы воркер не тратил на неё GPU
+            # и не списал фото после возврата алмазов
+            _, task_result = await take_over_task(task_id, grace=0)
         
         # Удаляем сообщение о генерации
         try:
@@ -456,6 +537,8 @@ async def handle_generate_image(message: Message) -> None:
                 await add_diamonds(session, user_id=message.from_user.id, amount=settings.image_generation_cost)
                 await session.commit()
             await message.answer("❌ Не получилось сгенерировать изображение. Алмазы возвращены.")
+    except NoWorkerAvailableError as exc:
+        await _refund_unqueued_photo(message, message.from_user.id, status_message, exc)
     except Exception as exc:
         await message.answer("❌ Не получилось сгенерировать изображение. Проверь, что локальный API запущен.")
         logging.getLogger(__name__).exception("Ошибка при генерации изображения", exc_info=exc)
@@ -470,6 +553,24 @@ async def handle_generate_image(message: Message) -> None:
                     pass
 
 
+async def _refund_unqueued_photo(
+    message: Message,
+    user_id: int,
+    status_message: Message,
+    exc: NoWorkerAvailableError,
+) -> None:
+    """Возвращает алмазы за фото, которое не поставлено: воркеры пропали после контроля приёма."""
+    logging.getLogger(__name__).warning(f"Очередь фото недоступна: {exc}")
+    try:
+        await status_message.delete()
+    except Exception:
+        pass
+    async with get_session() as session:
+        await add_diamonds(session, user_id=user_id, amount=settings.image_generation_cost)
+        await session.commit()
+    await message.answer(f"{format_rejection(0.0)} Алмазы возвращены.")
+
+
 @router.message(lambda m: m.text and ("Главное меню" in m.text or m.text == "🏠 Главное меню"))
 async def handle_main_menu(message: Message) -> None:
     """Обработчик кнопки 'Главное меню'."""
@@ -713,6 +814,20 @@ async def handle_dialogue(message: Message) -> None:
             _generating_images[message.from_user.id] = warning_msg
         return
 
+    # Повторно доставленное сообщение присоединяется к уже идущему ответу:
+    # ответ отправляет первый обработчик, повтор - только если тот прервался
+    request_key = make_request_key(TaskType.GENERATE_REPLY, message.from_user.id, None, message.message_id)
+    async with idempotent_request(request_key) as (first, task_id):
+        if first:
+            await _reply_to_message(message, request_key)
+        elif await find_request_task(task_id) is not None:
+            task = await wait_for_duplicate_result(task_id, timeout=_REPLY_WAIT_TIMEOUT)
+            if task is not None and task.result and "reply" in task.result:
+                await message.answer(task.result["reply"])
+
+
+async def _reply_to_message(message: Message, request_key: str) -> None:
+    """Списывает энергию, сохраняет сообщение пользователя и отвечает через очередь."""
     reply_text: str | None = None
     girl_name: str | None = None
     active_dialog_id: int | None = None
@@ -820,13 +935,16 @@ async def handle_dialogue(message: Message) -> None:
         history = await get_recent_messages(
             session,
             dialog_id=active_dialog_id,
-            limit=30,
+            limit=settings.reply_history_max_messages,
         )
 
-        history_payload = [
-            {"role": msg.role, "content": msg.content}
-            for msg in history
-        ]
+        # В задачу идёт только история, помещающаяся в бюджет токенов модели
+        # (VeniceClient подрежет её ещё раз с учётом динамических инструкций)
+        history_payload = build_reply_context(
+            girl.system_prompt,
+            [{"role": msg.role, "content": msg.content} for msg in history],
+            settings.venice_model,
+        ).messages[1:]
         
         # Проверяем наличие 18+ контента и обновляем флаг
         from app.services.nsfw_detector import detect_nsfw_in_messages
@@ -844,32 +962,49 @@ async def handle_dialogue(message: Message) -> None:
         await session.commit()  # Сохраняем сообщение пользователя
 
     # Генерируем ответ через очередь
+    task_id: str | None = None
+    status_message: Message | None = None
     try:
         # Показываем индикатор загрузки
         status_message = await message.answer("💭 Думаю...")
         
-        # Добавляем задачу в очередь
+        # Добавляем задачу в очередь. После deadline воркер её не начнёт
+        # (или прервёт), и ответ можно сгенерировать напрямую
         task_id = await enqueue_reply_generation(
             user_id=message.from_user.id,
             system_prompt=girl.system_prompt,
             history=history_payload,
             dialog_id=active_dialog_id,
             user_message=message.text,
+            deadline=time.time() + _REPLY_WAIT_TIMEOUT,
+            idempotency_key=request_key,
         )
         
-        # Ожидаем результат
+        # Ожидаем результат; ответ появляется в индикаторе загрузки по мере генерации
         bot = message.bot
-        task_result = await wait_for_task_result(bot, message, task_id, timeout=60.0)
-        
-        # Удаляем индикатор загрузки
-        try:
-            await status_message.delete()
-        except Exception:
-            pass
+        task_result = await wait_for_task_result(
+            bot,
+            message,
+            task_id,
+            timeout=_REPLY_WAIT_TIMEOUT,
+            stream_message=status_message,
+        )
+        if not task_result:
+            # Забираем задачу у очереди до fallback, чтобы воркер не
+            # сгенерировал и не сохранил второй ответ
+            _, task_result = await take_over_task(task_id)
+            task_id = None
         
         if task_result and "reply" in task_result:
             reply_text = task_result["reply"]
         else:
+            # Удаляем индикатор загрузки (с началом ответа, если он успел появиться)
+            try:
+                await status_message.delete()
+            except Exception:
+                pass
+            status_message = None
+            
             # Fallback: генерируем напрямую, если очередь не работает
             client = VeniceClient()
             try:
@@ -895,30 +1030,51 @@ async def handle_dialogue(message: Message) -> None:
                 await client.close()
     
     except Exception as exc:
-        logging.getLogger(__name__).exception("Ошибка при генерации ответа через очередь", exc_info=exc)
-        # Fallback: генерируем напрямую
-        client = VeniceClient()
-        try:
-            reply_text = await client.generate_reply(girl.system_prompt, history_payload)
-            async with get_session() as session:
-                await add_message(
-                    session,
-                    dialog_id=active_dialog_id,
-                    role="assistant",
-                    content=reply_text,
-                )
-                await session.commit()
-        except Exception as exc2:
-            # Возвращаем энергию, если генерация не удалась
-            async with get_session() as session:
-                from app.repositories.user_profile import add_energy
-                await add_energy(session, user_id=message.from_user.id, amount=settings.message_energy_cost)
-                await session.commit()
-            await message.answer("⚠️ Не получилось получить ответ от модели. Энергия возвращена.")
-            logging.getLogger(__name__).exception("Ошибка при обращении к Venice API", exc_info=exc2)
-            return
-        finally:
-            await client.close()
+        if isinstance(exc, NoWorkerAvailableError):
+            # Воркеров для ответов нет: не ждём таймаута, отвечаем сразу
+            logging.getLogger(__name__).warning(f"Очередь ответов недоступна, отвечаем напрямую: {exc}")
+        else:
+            logging.getLogger(__name__).exception("Ошибка при генерации ответа через очередь", exc_info=exc)
+        if status_message is not None:
+            try:
+                await status_message.delete()
+            except Exception:
+                pass
+            status_message = None
+        # Задача могла успеть выполниться: забираем её до fallback
+        task_result = None
+        if task_id is not None:
+            try:
+                _, task_result = await take_over_task(task_id)
+            except Exception as takeover_exc:
+                # Redis недоступен: отменить задачу нельзя, отвечаем напрямую
+                logging.getLogger(__name__).warning(f"Не удалось забрать задачу {task_id}: {takeover_exc}")
+        if task_result and "reply" in task_result:
+            reply_text = task_result["reply"]
+        else:
+            # Fallback: генерируем напрямую
+            client = VeniceClient()
+            try:
+                reply_text = await client.generate_reply(girl.system_prompt, history_payload)
+                async with get_session() as session:
+                    await add_message(
+                        session,
+                        dialog_id=active_dialog_id,
+                        role="assistant",
+                        content=reply_text,
+                    )
+                    await session.commit()
+            except Exception as exc2:
+                # Возвращаем энергию, если генерация не удалась
+                async with get_session() as session:
+                    from app.repositories.user_profile import add_energy
+                    await add_energy(session, user_id=message.from_user.id, amount=settings.message_energy_cost)
+                    await session.commit()
+                await message.answer("⚠️ Не получилось получить ответ от модели. Энергия возвращена.")
+                logging.getLogger(__name__).exception("Ошибка при обращении к Venice API", exc_info=exc2)
+                return
+            finally:
+                await client.close()
     
     # Получаем информацию о пользователе для счётчика фото
     async with get_session() as session:
@@ -945,8 +1101,44 @@ async def handle_dialogue(message: Message) -> None:
         
         inline_keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
         
+        # Индикатор загрузки, в котором ответ показывался по мере генерации,
+        # становится самим ответом
+        if status_message is not None and await _finish_streamed_reply(status_message, reply_text, inline_keyboard):
+            return
+        
         # Отправляем только текстовое сообщение с кнопкой
         await message.answer(reply_text, reply_markup=inline_keyboard)
+    elif status_message is not None:
+        try:
+            await status_message.delete()
+        except Exception:
+            pass
+
+
+async def _finish_streamed_reply(status_message: Message, reply_text: str, reply_markup: InlineKeyboardMarkup) -> bool:
+    """
+    Заменяет текст индикатора загрузки итоговым ответом.
+    
+    Returns:
+        True, если ответ показан; иначе индикатор удалён и ответ нужно отправить
+    """
+    from aiogram.exceptions import TelegramRetryAfter
+    
+    for _ in range(2):
+        try:
+            await safe_edit_text(status_message, reply_text, reply_markup=reply_markup)
+            return True
+        except TelegramRetryAfter as exc:
+            # Промежуточный ответ только что правили: ждём, сколько просит Telegram
+            await asyncio.sleep(exc.retry_after)
+        except Exception as exc:
+            logging.getLogger(__name__).warning(f"Не удалось показать ответ в индикаторе загрузки: {exc}")
+            break
+    try:
+        await status_message.delete()
+    except Exception:
+        pass
+    return False
 
 
 def build_girl_keyboard(girls: list, current_index: int, selected_girl_id: int | None = None, active_dialog_id: int | None = None) -> InlineKeyboardMarkup:
@@ -1901,6 +2093,9 @@ async def handle_successful_payment(message: Message) -> None:
                         await message.answer(success_text)
                 else:
                     await message.answer(success_text)
+        
+        # Следующие задачи пользователя сразу пойдут в платную полосу очереди
+        invalidate_task_lane(message.from_user.id)
     except Exception as e:
         logger.error(f"Error processing payment: {e}", exc_info=True)
         await message.answer(f"⚠️ Произошла ошибка при обработке платежа. Пожалуйста, обратитесь к администратору.")
@@ -1965,19 +2160,39 @@ async def handle_back_to_main_menu_callback(callback: CallbackQuery) -> None:
 @router.callback_query(lambda c: c.data and c.data.startswith("get_photo:"))
 async def handle_get_photo_callback(callback: CallbackQuery) -> None:
     """Обработчик для кнопки 'Получить фото'."""
-    # Отвечаем на callback СРАЗУ, чтобы избежать таймаута
-    await callback.answer()
-    
     if not callback.from_user:
+        await callback.answer()
         await callback.message.answer("⚠️ Ошибка: не могу определить пользователя.")
         return
 
     try:
         dialog_id = int(callback.data.split(":")[1])
     except (ValueError, IndexError):
+        await callback.answer()
         await callback.message.answer("⚠️ Ошибка: неверный ID диалога.")
         return
 
+    # Повторная доставка того же нажатия (тот же callback.id) присоединяется
+    # к уже идущей генерации и не списывает алмазы второй раз
+    request_key = make_request_key(TaskType.GENERATE_IMAGE, callback.from_user.id, dialog_id, callback.id)
+    async with idempotent_request(request_key) as (first, task_id):
+        if not first:
+            await _attach_to_image_request(callback.message, task_id, callback)
+            return
+        # Новое нажатие, пока фото по диалогу генерируется, отбрасывается.
+        # Ключ держится только на время генерации: после неё нажатие - новый запрос фото
+        active_key = make_request_key(TaskType.GENERATE_IMAGE, callback.from_user.id, dialog_id, "active")
+        async with idempotent_request(active_key, linger=0) as (idle, _):
+            if not idle:
+                await callback.answer(_IMAGE_IN_PROGRESS_TEXT)
+                return
+            # Отвечаем на callback сразу, чтобы избежать таймаута
+            await callback.answer()
+            await _generate_dialog_photo(callback, dialog_id, request_key)
+
+
+async def _generate_dialog_photo(callback: CallbackQuery, dialog_id: int, request_key: str) -> None:
+    """Списывает алмазы и генерирует фото по контексту диалога через очередь."""
     async with get_session() as session:
         # Проверяем наличие алмазов
         diamonds = await get_user_diamonds(session, user_id=callback.from_user.id)
@@ -2023,6 +2238,15 @@ async def handle_get_photo_callback(callback: CallbackQuery) -> None:
             await callback.message.answer(f"📷 Лимит фото исчерпан ({photos_used}/{MAX_PHOTOS_PER_DIALOG})")
             return
         
+        # Не ставим задачу в перегруженную очередь: отказываем до списания алмазов
+        # Задача проходит два этапа: промпт по диалогу, затем фото
+        admission = await admission_controller.check(
+            TaskType.GENERATE_IMAGE_PROMPT, next_stages=[TaskType.GENERATE_IMAGE]
+        )
+        if not admission.admitted:
+            await callback.message.answer(f"{format_rejection(admission.eta)} Алмазы не списаны.")
+            return
+        
         # Списываем алмазы перед генерацией
         diamonds_spent = await spend_diamonds(session, user_id=callback.from_user.id, amount=settings.image_generation_cost)
         if not diamonds_spent:
@@ -2044,136 +2268,120 @@ async def handle_get_photo_callback(callback: CallbackQuery) -> None:
             return
         
         await session.commit()
+    
+    # Сессия закрыта сразу после списания: промпт по диалогу и само фото
+    # генерирует воркер. Здесь - только базовый промпт с характеристиками
+    # персонажа и одеждой, контекст диалога (эмоции и уровень обнажения)
+    # воркер добавит на этапе GENERATE_IMAGE_PROMPT
+    base_prompt = build_image_prompt(
+        girl_name=girl.name,
+        clothing_description=girl.clothing_description,
+    )
+    
+    # Определяем, какую одежду снимает персонаж при раздевании
+    undressing_clothing = {
+        "Стейси": "shirt",  # рубашка
+        "Аманда": "dress",  # платье
+        "Джейн": "dress",   # платье
+    }
+    clothing_item = undressing_clothing.get(girl.name, "clothes")
+    
+    # Генерируем и отправляем изображение через очередь
+    # Устанавливаем флаг генерации
+    if callback.from_user:
+        _generating_images[callback.from_user.id] = None
+    
+    try:
+        # Отправляем сообщение о начале генерации
+        status_message = await callback.message.answer(
+            format_queue_status(_IMAGE_STATUS_TITLE, TaskStatus.PENDING, admission.ahead, admission.eta)
+        )
         
-        # Получаем все сообщения для анализа контекста
-        all_messages = await get_all_messages(session, dialog_id=dialog_id)
-        
-        # Используем базовый промпт с характеристиками персонажа и одеждой
-        base_prompt = build_image_prompt(
+        # Одна задача проходит оба этапа в воркере: промпт по диалогу, затем фото.
+        # После deadline воркер её не начнёт, а начатую прервёт
+        task_id = await enqueue_dialog_photo_generation(
+            user_id=callback.from_user.id,
+            dialog_id=dialog_id,
+            girl_id=girl.id,
             girl_name=girl.name,
-            clothing_description=girl.clothing_description,
+            girl_description=f"{girl.name}, {girl.system_prompt[:200]}",
+            base_prompt=base_prompt,
+            undressing_clothing=clothing_item,
+            deadline=time.time() + _IMAGE_WAIT_TIMEOUT,
+            idempotency_key=request_key,
         )
         
-        # Формируем контекст из диалога (только эмоции и уровень обнажения)
-        if all_messages:
-            # Берем последние сообщения для анализа
-            recent_messages = list(all_messages[-15:]) if len(all_messages) >= 15 else all_messages
-            
-            # Формируем диалог из последних сообщений
-            recent_dialogue = [
-                {"role": msg.role, "content": msg.content}
-                for msg in recent_messages
-            ]
-            
-            venice_client = VeniceClient()
-            try:
-                girl_description = f"{girl.name}, {girl.system_prompt[:200]}"
-                
-                # Определяем, какую одежду снимает персонаж при раздевании
-                undressing_clothing = {
-                    "Стейси": "shirt",  # рубашка
-                    "Аманда": "dress",  # платье
-                    "Джейн": "dress",   # платье
-                }
-                clothing_item = undressing_clothing.get(girl.name, "clothes")
-                
-                dialogue_context = await venice_client.generate_image_prompt(
-                    girl_name=girl.name,
-                    girl_description=girl_description,
-                    recent_dialogue=recent_dialogue,
-                    full_dialogue=None,  # Не нужен полный диалог
-                    undressing_clothing=clothing_item,
-                )
-                # Добавляем контекст к базовому промпту
-                if dialogue_context and len(dialogue_context.strip()) > 5:
-                    image_prompt = f"{base_prompt}, {dialogue_context}"
-                else:
-                    image_prompt = base_prompt
-            except Exception as exc:
-                logging.getLogger(__name__).warning(f"Не удалось добавить контекст через ИИ: {exc}")
-                image_prompt = base_prompt
-            finally:
-                await venice_client.close()
-        else:
-            # Если нет истории, используем только базовый промпт
-            image_prompt = base_prompt
-        
-        # Генерируем и отправляем изображение через очередь
-        # Устанавливаем флаг генерации
-        if callback.from_user:
-            _generating_images[callback.from_user.id] = None
+        # Ожидаем результат
+        bot = callback.message.bot
+        task_result = await wait_for_task_result(
+            bot,
+            callback.message,
+            task_id,
+            timeout=_IMAGE_WAIT_TIMEOUT,
+            status_message=status_message,
+            status_title=_IMAGE_STATUS_TITLE,
+            task_type=TaskType.GENERATE_IMAGE_PROMPT,
+            next_stages=[TaskType.GENERATE_IMAGE],
+        )
+        if task_result is None:
+            # Не дождались: отменяем задачу, чтобы воркер не тратил на неё GPU
+            # и не списал фото после возврата алмазов
+            _, task_result = await take_over_task(task_id, grace=0)
         
+        # Удаляем сообщение о генерации
         try:
-            # Отправляем сообщение о начале генерации
-            status_message = await callback.message.answer(
-                "🎨 Генерирую фото...\n"
-                "⏱️ Генерация может занять обычно 20 секунд, пожалуйста, подождите."
-            )
-            
-            # Добавляем задачу в очередь
-            task_id = await enqueue_image_generation(
-                user_id=callback.from_user.id,
-                prompt=image_prompt,
-                dialog_id=dialog_id,
-                girl_id=girl.id,
-            )
-            
-            # Ожидаем результат
-            bot = callback.message.bot
-            task_result = await wait_for_task_result(bot, callback.message, task_id)
+            await status_message.delete()
+        except Exception:
+            pass
+        
+        if task_result:
+            await send_image_from_task_result(bot, callback.message, task_result, girl.name)
             
-            # Удаляем сообщение о генерации
-            try:
-                await status_message.delete()
-            except Exception:
-                pass
+            # Показываем обновленный баланс
+            async with get_session() as session:
+                new_diamonds = await get_user_diamonds(session, user_id=callback.from_user.id)
+                await callback.message.answer(f"💎 Алмазов осталось: {new_diamonds}")
             
-            if task_result:
-                await send_image_from_task_result(bot, callback.message, task_result, girl.name)
+            # Обновляем общий счётчик фото для пользователя
+            async with get_session() as session:
+                await increment_user_photos_used(session, user_id=callback.from_user.id)
+                new_photos_used = await get_user_photos_used(session, user_id=callback.from_user.id)
                 
-                # Показываем обновленный баланс
-                async with get_session() as session:
-                    new_diamonds = await get_user_diamonds(session, user_id=callback.from_user.id)
-                    await callback.message.answer(f"💎 Алмазов осталось: {new_diamonds}")
+                # Отслеживаем генерацию фото
+                from app.repositories.retention import (
+                    increment_user_photos,
+                    track_user_activity,
+                    update_user_retention,
+                )
+                await update_user_retention(session, user_id=callback.from_user.id)
+                await increment_user_photos(session, user_id=callback.from_user.id)
+                await track_user_activity(session, user_id=callback.from_user.id, photos_generated=1)
                 
-                # Обновляем общий счётчик фото для пользователя
-                async with get_session() as session:
-                    await increment_user_photos_used(session, user_id=callback.from_user.id)
-                    new_photos_used = await get_user_photos_used(session, user_id=callback.from_user.id)
-                    
-                    # Отслеживаем генерацию фото
-                    from app.repositories.retention import (
-                        increment_user_photos,
-                        track_user_activity,
-                        update_user_retention,
-                    )
-                    await update_user_retention(session, user_id=callback.from_user.id)
-                    await increment_user_photos(session, user_id=callback.from_user.id)
-                    await track_user_activity(session, user_id=callback.from_user.id, photos_generated=1)
-                    
-                    await session.commit()
-            else:
-                # Возвращаем алмазы, если генерация не удалась
-                async with get_session() as session:
-                    await add_diamonds(session, user_id=callback.from_user.id, amount=settings.image_generation_cost)
-                    await session.commit()
-                await callback.message.answer("❌ Не получилось сгенерировать изображение. Алмазы возвращены.")
-        except ValueError as exc:
-            error_msg = str(exc)
-            logging.getLogger(__name__).warning(f"Не удалось сгенерировать изображение: {error_msg}")
-            await callback.message.answer(f"❌ Ошибка генерации изображения: {error_msg}")
-        except Exception as exc:
-            logging.getLogger(__name__).exception("Ошибка при генерации изображения", exc_info=exc)
-            await callback.message.answer("❌ Ошибка при генерации изображения")
-        finally:
-            # Удаляем сообщение-предупреждение, если оно было отправлено
-            if callback.from_user:
-                warning_msg = _generating_images.pop(callback.from_user.id, None)
-                if warning_msg:
-                    try:
-                        await warning_msg.delete()
-                    except Exception:
-                        pass
+                await session.commit()
+        else:
+            # Возвращаем алмазы, если генерация не удалась
+            async with get_session() as session:
+                await add_diamonds(session, user_id=callback.from_user.id, amount=settings.image_generation_cost)
+                await session.commit()
+            await callback.message.answer("❌ Не получилось сгенерировать изображение. Алмазы возвращены.")
+    except NoWorkerAvailableError as exc:
+        await _refund_unqueued_photo(callback.message, callback.from_user.id, status_message, exc)
+    except ValueError as exc:
+        error_msg = str(exc)
+        logging.getLogger(__name__).warning(f"Не удалось сгенерировать изображение: {error_msg}")
+        await callback.message.answer(f"❌ Ошибка генерации изображения: {error_msg}")
+    except Exception as exc:
+        logging.getLogger(__name__).exception("Ошибка при генерации изображения", exc_info=exc)
+        await callback.message.answer("❌ Ошибка при генерации изображения")
+    finally:
+        # Удаляем сообщение-предупреждение, если оно было отправлено
+        if callback.from_user:
+            warning_msg = _generating_images.pop(callback.from_user.id, None)
+            if warning_msg:
+                try:
+                    await warning_msg.delete()
+                except Exception:
+                    pass
 
 
 @router.callback_query(lambda c: c.data and c.data == "photo_limit_reached")
@@ -1,58 +1,401 @@
 import asyncio
 import base64
 import logging
-from typing import Any
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator
 
 from aiogram import Bot
-from aiogram.types import BufferedInputFile, Message
+from aiogram.types import BufferedInputFile, FSInputFile, Message
 
-from app.services.queue_service import TaskStatus, TaskType, queue_service
+from app.config import settings
+from app.db import get_session
+from app.repositories.payments import has_recent_payment
+from app.services.admission import admission_controller
+from app.services.blob_store import blob_store
+from app.services.queue_service import TERMINAL_STATUSES, QueueTask, TaskStatus, TaskType, queue_service
 
 logger = logging.getLogger(__name__)
 
+# Как часто обновлять сообщение о позиции в очереди (секунды)
+_STATUS_UPDATE_INTERVAL = 5.0
+# Максимальная длина текста сообщения Telegram
+_TELEGRAM_TEXT_LIMIT = 4096
+# Признак того, что ответ ещё генерируется
+_STREAM_CURSOR = " ▍"
+
+# Кэш полос приоритета: user_id -> (полоса, момент устаревания)
+_LANE_CACHE_TTL = 300.0
+_lane_cache: dict[int, tuple[str, float]] = {}
+
+# Сколько повтор запроса ждёт, пока первый обработчик поставит задачу или
+# заберёт её результат, прежде чем считать, что обработчика уже нет (секунды)
+_DUPLICATE_GRACE = 5.0
+
+# Кэш ёмкости воркеров из реестра: тип задач -> (слоты, момент устаревания)
+_CAPACITY_CACHE_TTL = 2.0
+_capacity_cache: dict[TaskType, tuple[int | None, float]] = {}
+
+
+async def resolve_task_lane(user_id: int) -> str:
+    """
+    Определяет полосу приоритета задач пользователя по истории платежей.
+    
+    Пользователи с платежом за последние settings.queue_paid_lane_days дней
+    попадают в платную полосу. Результат кэшируется на несколько минут.
+    
+    Args:
+        user_id: ID пользователя
+    
+    Returns:
+        Название полосы
+    """
+    now = time.monotonic()
+    cached = _lane_cache.get(user_id)
+    if cached and cached[1] > now:
+        return cached[0]
+    
+    async with get_session() as session:
+        paid = await has_recent_payment(session, user_id=user_id, days=settings.queue_paid_lane_days)
+    lane = settings.queue_paid_lane if paid else settings.queue_default_lane
+    
+    if len(_lane_cache) > 10000:
+        for key in [key for key, (_, expires) in _lane_cache.items() if expires <= now]:
+            del _lane_cache[key]
+    _lane_cache[user_id] = (lane, now + _LANE_CACHE_TTL)
+    return lane
+
+
+class NoWorkerAvailableError(RuntimeError):
+    """Ни один живой воркер не может сейчас выполнить задачу этого типа."""
+
+
+async def ensure_worker_available(task_type: TaskType) -> None:
+    """
+    Проверяет по реестру воркеров, что задачу типа task_type есть кому выполнить.
+    
+    Без живых воркеров со здоровым провайдером задача пролежала бы в
+    очереди до таймаута ожидания. Реестр кэшируется на пару секунд.
+    Воркеры, не сообщающие слоты (старые версии), считаются доступными.
+    
+    Args:
+        task_type: Тип задачи
+    
+    Raises:
+        NoWorkerAvailableError: Выполнить задачу некому
+    """
+    now = time.monotonic()
+    cached = _capacity_cache.get(task_type)
+    if cached and cached[1] > now:
+        capacity = cached[0]
+    else:
+        capacity = await queue_service.get_capacity(task_type)
+        _capacity_cache[task_type] = (capacity, now + _CAPACITY_CACHE_TTL)
+    if capacity == 0:
+        raise NoWorkerAvailableError(f"No healthy worker for {task_type.value} tasks")
+
+
+def invalidate_task_lane(user_id: int) -> None:
+    """Сбрасывает закэшированную полосу пользователя (например, после оплаты)."""
+    _lane_cache.pop(user_id, None)
+
+
+def make_request_key(task_type: TaskType, user_id: int, dialog_id: int | None, trigger_id: int | str) -> str:
+    """
+    Собирает ключ идемпотентности запроса.
+    
+    Args:
+        task_type: Тип задачи, которую порождает запрос
+        user_id: ID пользователя
+        dialog_id: ID диалога (None - не известен)
+        trigger_id: ID сообщения, вызвавшего запрос (для кнопки - ID callback:
+            его повторная доставка приходит с тем же ID, а новое нажатие - с новым)
+    
+    Returns:
+        Ключ, одинаковый для повторов одного запроса
+    """
+    return f"{task_type.value}:{user_id}:{dialog_id or '-'}:{trigger_id}"
+
+
+@asynccontextmanager
+async def idempotent_request(request_key: str, linger: int | None = None) -> AsyncIterator[tuple[bool, str]]:
+    """
+    Пропускает только первый из повторов запроса.
+    
+    Повторная доставка update от Telegram обрабатывается конкурентно с
+    первой. Ключ занимается до списания ресурсов и после обработки ещё
+    linger секунд указывает на задачу запроса, поэтому ни одновременный,
+    ни поздний повтор не списывает алмазы и не ставит вторую задачу, а
+    присоединяется к уже поставленной (find_request_task,
+    wait_for_duplicate_result). Задачи, поставленные с этим ключом
+    (idempotency_key), получают закреплённый за ним ID.
+    
+    Args:
+        request_key: Ключ запроса (make_request_key)
+        linger: Сколько секунд ключ держится после обработки (по умолчанию
+            settings.idempotency_key_linger, 0 - только пока запрос обрабатывается)
+    
+    Yields:
+        (True для первого запроса и False для повтора, ID задачи запроса)
+    """
+    task_id, created = await queue_service.reserve_task_id(request_key)
+    if not created:
+        logger.info(f"Duplicate request {request_key!r} joined task {task_id}")
+        yield False, task_id
+        return
+    if linger is None:
+        linger = settings.idempotency_key_linger
+    try:
+        yield True, task_id
+    finally:
+        try:
+            await queue_service.release_idempotency_key(request_key, task_id, linger=linger)
+            # Повтор, ждущий появления задачи, узнаёт, что запрос обработан
+            await queue_service.notify_task(task_id)
+        except Exception as exc:
+            # Ключ истечёт сам через settings.idempotency_key_ttl
+            logger.warning(f"Failed to release request key {request_key!r}: {exc}")
+
+
+async def find_request_task(task_id: str) -> QueueTask | None:
+    """
+    Находит задачу, к которой присоединяется повтор запроса.
+    
+    Первый обработчик ставит задачу только после проверки баланса, поэтому
+    повтор ждёт её появления до _DUPLICATE_GRACE секунд. Ожидание
+    просыпается по событию постановки задачи или завершения первого
+    обработчика (см. idempotent_request), а не опросом.
+    
+    Args:
+        task_id: ID задачи запроса (idempotent_request)
+    
+    Returns:
+        Задача или None, если запрос обработан без задачи или её результат
+        уже доставлен
+    """
+    return await queue_service.wait_for_task(task_id, timeout=_DUPLICATE_GRACE, created=True)
+
+
+async def wait_for_duplicate_result(task_id: str, timeout: float) -> QueueTask | None:
+    """
+    Ожидает задачу, к которой присоединился повтор запроса.
+    
+    Результат доставляет первый обработчик запроса. Повтор забирает его,
+    только если за _DUPLICATE_GRACE секунд после завершения задачи результат
+    никто не забрал: первый обработчик прервался (например, бот
+    перезапустился), и без повтора пользователь результата не получит.
+    
+    Args:
+        task_id: ID задачи запроса (idempotent_request)
+        timeout: Таймаут ожидания (секунды)
+    
+    Returns:
+        Завершённая задача, результат которой должен доставить повтор, иначе None
+    """
+    task = await queue_service.wait_for_task(task_id, timeout=timeout)
+    if task is None or task.status != TaskStatus.COMPLETED:
+        return None
+    await asyncio.sleep(_DUPLICATE_GRACE)
+    task = await queue_service.get_task(task_id)
+    if task is None or task.status != TaskStatus.COMPLETED:
+        return None
+    # Результат забирает только один из повторов
+    if not await queue_service.release_task(task_id):
+        return None
+    logger.warning(f"Result of task {task_id} was not picked up by the first request, delivering it from a duplicate")
+    return task
+
+
+def format_queue_status(title: str, status: TaskStatus | None, ahead: int, eta: float) -> str:
+    """
+    Формирует текст сообщения о ходе выполнения задачи.
+    
+    Args:
+        title: Первая строка (например, "🎨 Генерирую фото...")
+        status: Текущий статус задачи
+        ahead: Задач перед ней в очереди
+        eta: Ожидаемое время до результата (секунды)
+    
+    Returns:
+        Текст сообщения
+    """
+    if status == TaskStatus.PENDING and ahead > 0:
+        return (
+            f"{title}\n"
+            f"👥 Перед тобой в очереди: {ahead}\n"
+            f"⏱️ Примерно через {format_eta(eta)}, пожалуйста, подождите."
+        )
+    if status == TaskStatus.PENDING:
+        return f"{title}\n⏱️ Ты следующий в очереди, примерно {format_eta(eta)}."
+    return f"{title}\n⏱️ Уже почти готово, пожалуйста, подождите."
+
+
+def format_rejection(eta: float) -> str:
+    """Текст отказа в приёме задачи при перегруженной очереди (см. AdmissionController)."""
+    if eta <= 0:
+        return "⏳ Генерация сейчас недоступна, попробуй чуть позже."
+    return (
+        f"⏳ Сейчас очень много желающих: ждать пришлось бы около {format_eta(eta)}. "
+        f"Попробуй чуть позже."
+    )
+
+
+def format_eta(eta: float) -> str:
+    """Форматирует оценку времени: "40 сек" или "3 мин"."""
+    if eta < 60:
+        return f"{max(5, int(round(eta / 5.0)) * 5)} сек"
+    return f"{int(round(eta / 60.0))} мин"
+
 
 async def wait_for_task_result(
     bot: Bot,
     message: Message,
     task_id: str,
-    check_interval: float = 0.2,  # Уменьшено с 1.0 до 0.2 для более быстрой проверки
     timeout: float = 120.0,
+    status_message: Message | None = None,
+    status_title: str = "",
+    task_type: TaskType | None = None,
+    stream_message: Message | None = None,
+    next_stages: list[TaskType] | None = None,
 ) -> dict[str, Any] | None:
     """
     Ожидает результат выполнения задачи из очереди.
     
+    Не опрашивает Redis: ожидание просыпается по уведомлению воркера
+    о завершении задачи (см. QueueService.wait_for_task). Завершённая
+    задача сразу удаляется из Redis: результат уже у вызывающего.
+    
+    Если передано status_message, раз в несколько секунд в нём обновляются
+    позиция задачи в очереди и оценка времени ожидания.
+    
+    Если передано stream_message, в нём по мере генерации показывается
+    промежуточный результат задачи (см. QueueService.publish_progress):
+    не чаще раза в settings.reply_stream_interval секунд и с паузой, если
+    Telegram ответил RetryAfter.
+    
     Args:
         bot: Экземпляр бота
         message: Сообщение для отправки обновлений
         task_id: ID задачи
-        check_interval: Интервал проверки статуса (секунды)
         timeout: Таймаут ожидания (секунды)
+        status_message: Сообщение о ходе выполнения для обновления
+        status_title: Первая строка сообщения о ходе выполнения
+        task_type: Тип задачи (нужен для оценки времени ожидания)
+        stream_message: Сообщение для показа промежуточного результата
+        next_stages: Следующие этапы цепочки (входят в оценку времени ожидания)
     
     Returns:
         Результат задачи или None при таймауте/ошибке
     """
-    start_time = asyncio.get_event_loop().time()
-    
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    last_text = status_message.text if status_message else None
+    last_partial: str | None = None
+    next_edit_at = 0.0
     while True:
-        elapsed = asyncio.get_event_loop().time() - start_time
-        if elapsed > timeout:
-            logger.warning(f"Task {task_id} timeout after {timeout}s")
-            return None
-        
+        remaining = deadline - loop.time()
+        if stream_message is not None:
+            task = await queue_service.wait_for_task(task_id, timeout=remaining, progress=True)
+            if task is None or task.status in TERMINAL_STATUSES or loop.time() >= deadline:
+                break
+            # Промежуточный результат, пришедший раньше разрешённой правки,
+            # пропускается: следующий (или итоговый) текст его покроет
+            if task.partial and task.partial != last_partial and loop.time() >= next_edit_at:
+                last_partial = task.partial
+                next_edit_at = loop.time() + await _show_partial(stream_message, task.partial)
+            continue
+        if status_message is None or task_type is None:
+            task = await queue_service.wait_for_task(task_id, timeout=remaining)
+            break
+        task = await queue_service.wait_for_task(task_id, timeout=min(remaining, _STATUS_UPDATE_INTERVAL))
+        if task is None or task.status in TERMINAL_STATUSES:
+            break
+        if loop.time() >= deadline:
+            break
+        try:
+            status, ahead, eta = await admission_controller.progress(task_id, task_type, next_stages)
+            text = format_queue_status(status_title, status, ahead, eta)
+            if text != last_text:
+                await status_message.edit_text(text)
+                last_text = text
+        except Exception as exc:
+            logger.debug(f"Failed to update task status message: {exc}")
+    
+    if not task:
+        logger.warning(f"Task {task_id} not found")
+        return None
+    
+    if task.status in TERMINAL_STATUSES:
+        await queue_service.release_task(task_id)
+    
+    if task.status == TaskStatus.COMPLETED:
+        return task.result
+    
+    if task.status in (TaskStatus.FAILED, TaskStatus.CANCELLED):
+        logger.error(f"Task {task_id} {task.status.value}: {task.error}")
+        return None
+    
+    logger.warning(f"Task {task_id} timeout after {timeout}s")
+    return None
+
+
+async def _show_partial(message: Message, text: str) -> float:
+    """
+    Показывает промежуточный результат правкой сообщения.
+    
+    Returns:
+        Через сколько секунд можно править сообщение снова
+    """
+    from aiogram.exceptions import TelegramRetryAfter
+    
+    try:
+        await message.edit_text(text[:_TELEGRAM_TEXT_LIMIT - len(_STREAM_CURSOR)] + _STREAM_CURSOR)
+    except TelegramRetryAfter as exc:
+        logger.debug(f"Telegram asked to slow down message edits for {exc.retry_after}s")
+        return max(float(exc.retry_after), settings.reply_stream_interval)
+    except Exception as exc:
+        logger.debug(f"Failed to show partial result: {exc}")
+    return settings.reply_stream_interval
+
+
+async def take_over_task(task_id: str, grace: float = 10.0) -> tuple[bool, dict[str, Any] | None]:
+    """
+    Забирает у очереди задачу, результата которой не дождались.
+    
+    Вызывается перед тем, как выполнить работу задачи в обход очереди,
+    чтобы она не выполнилась дважды:
+    - задача ещё в очереди - атомарно отменяется, воркер её не возьмёт;
+    - задача выполняется - ждём до grace секунд (воркер прерывает задачу
+      после её deadline), затем отменяем. Воркер прерывает отменённую
+      задачу и сохраняет результат только при успешном переходе
+      PROCESSING -> COMPLETED, поэтому после отмены результата не будет;
+    - задача успела завершиться - возвращается её результат.
+    
+    Args:
+        task_id: ID задачи
+        grace: Сколько ждать уже выполняющуюся задачу (секунды)
+    
+    Returns:
+        (можно ли выполнить работу в обход очереди, результат задачи или None)
+    """
+    if await queue_service.cancel_task(task_id):
+        return True, None
+    
+    task = await queue_service.wait_for_task(task_id, timeout=grace)
+    if task is not None and task.status == TaskStatus.PROCESSING:
+        if await queue_service.cancel_task(task_id, include_running=True):
+            logger.warning(f"Task {task_id} overran its deadline and was cancelled")
+            await queue_service.release_task(task_id)
+            return True, None
         task = await queue_service.get_task(task_id)
-        if not task:
-            logger.warning(f"Task {task_id} not found")
-            return None
-        
-        if task.status == TaskStatus.COMPLETED:
-            return task.result
-        
-        if task.status == TaskStatus.FAILED:
-            logger.error(f"Task {task_id} failed: {task.error}")
-            return None
-        
-        # Задача еще обрабатывается
-        await asyncio.sleep(check_interval)
+    
+    if task is None:
+        # Записи нет: воркер тоже не сможет сохранить результат
+        return True, None
+    await queue_service.release_task(task_id)
+    if task.status == TaskStatus.COMPLETED:
+        return False, task.result
+    return True, None
 
 
 async def send_image_from_task_result(
@@ -70,18 +413,39 @@ async def send_image_from_task_result(
         task_result: Результат задачи
         girl_name: Имя персонажа для имени файла
     """
+    image_ref = task_result.get("image_ref")
     image_base64 = task_result.get("image_base64")
-    if not image_base64:
+    if not image_ref and not image_base64:
         await message.answer("❌ Ошибка: изображение не найдено в результате.")
         return
     
     try:
-        image_data = base64.b64decode(image_base64)
-        photo = BufferedInputFile(image_data, filename=f"{girl_name}.png")
+        filename = f"{girl_name}.png"
+        if image_ref:
+            local_path = blob_store.local_path(image_ref)
+            if local_path is not None:
+                # Файловое хранилище: aiogram читает файл с диска при отправке
+                photo = FSInputFile(local_path, filename=filename)
+            else:
+                image_data = await blob_store.get(image_ref)
+                if image_data is None:
+                    await message.answer("❌ Ошибка: изображение устарело, попробуй ещё раз.")
+                    return
+                photo = BufferedInputFile(image_data, filename=filename)
+        else:
+            # Результаты, сохранённые до перехода на хранилище изображений
+            photo = BufferedInputFile(base64.b64decode(image_base64), filename=filename)
         await message.answer_photo(photo)
     except Exception as exc:
         logger.exception(f"Error sending image from task result: {exc}")
         await message.answer("❌ Ошибка при отправке изображения.")
+    finally:
+        if image_ref:
+            # Изображение доставлено (или отправить его не удалось) - больше не нужно
+            try:
+                await blob_store.delete(image_ref)
+            except Exception as exc:
+                logger.warning(f"Failed to release image {image_ref}: {exc}")
 
 
 async def enqueue_image_generation(
@@ -90,6 +454,9 @@ async def enqueue_image_generation(
     dialog_id: int | None = None,
     girl_id: int | None = None,
     negative_prompt: str | None = None,
+    lane: str | None = None,
+    deadline: float | None = None,
+    idempotency_key: str | None = None,
 ) -> str:
     """
     Добавляет задачу генерации изображения в очередь.
@@ -100,11 +467,18 @@ async def enqueue_image_generation(
         dialog_id: ID диалога (опционально)
         girl_id: ID персонажа (опционально)
         negative_prompt: Негативный промпт (опционально)
+        lane: Полоса приоритета (по умолчанию - по истории платежей)
+        deadline: Unix-время, после которого изображение уже не нужно
+        idempotency_key: Ключ запроса: повтор присоединяется к уже поставленной задаче
     
     Returns:
         ID задачи
+    
+    Raises:
+        NoWorkerAvailableError: Нет живого воркера для изображений
     """
     await queue_service.connect()
+    await ensure_worker_available(TaskType.GENERATE_IMAGE)
     
     data = {
         "prompt": prompt,
@@ -115,10 +489,16 @@ async def enqueue_image_generation(
     if negative_prompt:
         data["negative_prompt"] = negative_prompt
     
+    if lane is None:
+        lane = await resolve_task_lane(user_id)
+    
     task_id = await queue_service.enqueue_task(
         TaskType.GENERATE_IMAGE,
         user_id=user_id,
-        data=data
+        data=data,
+        lane=lane,
+        deadline=deadline,
+        idempotency_key=idempotency_key,
     )
     
     return task_id
@@ -130,6 +510,9 @@ async def enqueue_reply_generation(
     history: list[dict[str, str]],
     dialog_id: int,
     user_message: str,
+    lane: str | None = None,
+    deadline: float | None = None,
+    idempotency_key: str | None = None,
 ) -> str:
     """
     Добавляет задачу генерации ответа в очередь.
@@ -140,11 +523,21 @@ async def enqueue_reply_generation(
         history: История сообщений
         dialog_id: ID диалога
         user_message: Сообщение пользователя
+        lane: Полоса приоритета (по умолчанию - по истории платежей)
+        deadline: Unix-время, после которого ответ уже не нужен
+        idempotency_key: Ключ запроса: повтор присоединяется к уже поставленной задаче
     
     Returns:
         ID задачи
+    
+    Raises:
+        NoWorkerAvailableError: Нет живого воркера для ответов - стоит ответить напрямую
     """
     await queue_service.connect()
+    await ensure_worker_available(TaskType.GENERATE_REPLY)
+    
+    if lane is None:
+        lane = await resolve_task_lane(user_id)
     
     task_id = await queue_service.enqueue_task(
         TaskType.GENERATE_REPLY,
@@ -154,31 +547,60 @@ async def enqueue_reply_generation(
             "history": history,
             "dialog_id": dialog_id,
             "user_message": user_message,
-        }
+        },
+        lane=lane,
+        deadline=deadline,
+        idempotency_key=idempotency_key,
     )
     
     return task_id
 
 
-async def enqueue_image_prompt_generation(
+async def enqueue_dialog_photo_generation(
     user_id: int,
+    dialog_id: int,
+    girl_id: int,
     girl_name: str,
     girl_description: str,
-    recent_dialogue: list[dict[str, str]],
+    base_prompt: str,
+    undressing_clothing: str | None = None,
+    lane: str | None = None,
+    deadline: float | None = None,
+    idempotency_key: str | None = None,
 ) -> str:
     """
-    Добавляет задачу генерации промпта для изображения в очередь.
+    Ставит в очередь цепочку "промпт по диалогу -> изображение" одной задачей.
+    
+    Воркер сам загружает последние сообщения диалога, дополняет base_prompt
+    контекстом от Venice и без возврата в бот переводит задачу к генерации
+    изображения. Результат (как у enqueue_image_generation) ожидается по
+    возвращённому ID.
     
     Args:
         user_id: ID пользователя
+        dialog_id: ID диалога
+        girl_id: ID персонажа
         girl_name: Имя персонажа
         girl_description: Описание персонажа
-        recent_dialogue: Последние сообщения диалога
+        base_prompt: Промпт внешности персонажа
+        undressing_clothing: Элемент одежды для раздевания (опционально)
+        lane: Полоса приоритета (по умолчанию - по истории платежей)
+        deadline: Unix-время, после которого изображение уже не нужно
+        idempotency_key: Ключ запроса: повтор присоединяется к уже поставленной задаче
     
     Returns:
         ID задачи
+    
+    Raises:
+        NoWorkerAvailableError: Нет живого воркера для одного из этапов цепочки
     """
     await queue_service.connect()
+    # Цепочку выполняют воркеры двух типов: без любого из них она не завершится
+    await ensure_worker_available(TaskType.GENERATE_IMAGE_PROMPT)
+    await ensure_worker_available(TaskType.GENERATE_IMAGE)
+    
+    if lane is None:
+        lane = await resolve_task_lane(user_id)
     
     task_id = await queue_service.enqueue_task(
         TaskType.GENERATE_IMAGE_PROMPT,
@@ -186,9 +608,15 @@ async def enqueue_image_prompt_generation(
         data={
             "girl_name": girl_name,
             "girl_description": girl_description,
-            "recent_dialogue": recent_dialogue,
-        }
+            "base_prompt": base_prompt,
+            "undressing_clothing": undressing_clothing,
+            "dialog_id": dialog_id,
+            "girl_id": girl_id,
+        },
+        lane=lane,
+        deadline=deadline,
+        idempotency_key=idempotency_key,
+        next_stages=[TaskType.GENERATE_IMAGE],
     )
     
     return task_id
-
@@ -41,6 +41,21 @@ class Settings(BaseSettings):
     redis_queue_prefix: str = "ai_girls:queue:"
     redis_result_prefix: str = "ai_girls:result:"
     redis_result_ttl: int = 3600  # Время жизни результатов в секундах (1 час)
+    redis_result_memory_budget: int = 256 * 1024 * 1024  # Лимит памяти недоставленных результатов в байтах (0 - без лимита)
+    queue_backend: str = "list"  # Бэкенд очередей: "list" (списки Redis), "stream" (Redis Streams + consumer groups) или "memory" (в процессе бота, без Redis)
+    queue_stream_group: str = "ai_girls:workers"  # Группа потребителей для бэкенда "stream"
+    queue_reliable: bool = True  # Задачи остаются в списке обработки воркера до подтверждения (at-least-once)
+    queue_visibility_timeout: int = 60  # Через сколько секунд без heartbeat задачи воркера возвращаются в очередь
+    queue_lane_weights: str = "paid:4,free:1"  # Полосы приоритета и их веса (доля выдачи при общей очереди)
+    queue_default_lane: str = "free"  # Полоса для задач без указанного приоритета
+    queue_paid_lane: str = "paid"  # Полоса для пользователей с недавними платежами
+    queue_paid_lane_days: int = 30  # Сколько дней после платежа задачи пользователя идут в платную полосу
+    queue_task_codec: str = "json"  # Формат задач в очередях: "json" или "msgpack" (читаются оба)
+    queue_task_compress_threshold: int = 4096  # Сжимать задачи (zlib) от этого размера в байтах (0 - не сжимать)
+    redis_events_channel: str = "ai_girls:events:task_done"  # Pub/sub канал уведомлений о завершении задач
+    blob_store_backend: str = "redis"  # Где хранить сгенерированные изображения: "redis" (сырые байты), "file" (каталог) или "memory" (для queue_backend="memory")
+    redis_blob_prefix: str = "ai_girls:blob:"  # Префикс ключей изображений для blob_store_backend="redis"
+    blob_store_dir: str = "data/blobs"  # Каталог изображений для blob_store_backend="file" (общий для бота и воркеров)
     
     # Админ настройки
     admin_user_ids: str = ""  # Список ID админов через запятую (например: "123456789,987654321")
@@ -49,9 +64,40 @@ class Settings(BaseSettings):
     image_generation_cost: int = 5  # Стоимость генерации изображения в алмазах
     message_energy_cost: int = 1  # Стоимость сообщения в энергии
     
+    # Пулы HTTP-соединений к Venice, API изображений и Replicate (общие для процесса)
+    http_pool_max_connections: int = 100  # Максимум одновременных соединений к одному upstream
+    http_pool_max_keepalive: int = 20  # Сколько простаивающих keep-alive соединений держать открытыми
+    http_pool_keepalive_expiry: float = 30.0  # Через сколько секунд простоя keep-alive соединение закрывается
+    http_pool_http2: bool = False  # HTTP/2 к upstream (нужен пакет h2: pip install httpx[http2])
+    
     # Настройки параллельной обработки
     max_concurrent_image_generations: int = 5  # Максимальное количество одновременных генераций изображений
     max_concurrent_reply_generations: int = 10  # Максимальное количество одновременных генераций ответов
+    reply_context_tokens: int = 6000  # Бюджет промпта ответа в токенах (системный промпт + история), оценка без токенизатора модели
+    reply_context_model_tokens: str = ""  # Бюджеты промпта для отдельных моделей, "llama-3.3-70b:12000,venice-uncensored:6000"
+    reply_history_max_messages: int = 100  # Сколько последних сообщений диалога загружать для промпта (в него входят помещающиеся в бюджет)
+    reply_streaming: bool = True  # Получать ответ Venice потоком и показывать его в чате по мере генерации
+    reply_stream_interval: float = 1.0  # Не чаще, чем раз в столько секунд, обновлять промежуточный ответ (Telegram ограничивает частоту правок)
+    provider_concurrency_limits: str = ""  # Лимиты одновременных запросов к провайдерам на все воркеры, "local_image:2,venice:10" (не указанные - по MAX_CONCURRENT_*)
+    provider_lease_ttl: float = 30.0  # Через сколько секунд без продления слот провайдера упавшего воркера освобождается
+    provider_adaptive_limits: bool = True  # Подстраивать лимиты провайдеров под время ответа и ошибки (AIMD); PROVIDER_CONCURRENCY_LIMITS - начальные значения
+    provider_latency_targets: str = "local_image:60,replicate:60,live3d:60,venice:20"  # Целевой p95 времени ответа провайдера (сек): ниже - лимит может расти
+    provider_limit_floor: int = 1  # Меньше скольких одновременных запросов адаптивный лимит не опускается
+    provider_limit_ceilings: str = ""  # Потолки адаптивных лимитов, "local_image:4,venice:30" (не указанные - вдвое выше начального лимита)
+    max_user_concurrent_tasks: int = 2  # Сколько задач одного типа от одного пользователя воркер выполняет одновременно
+    admission_max_eta: float = 90.0  # Не принимать задачу, если ожидаемое время до результата больше (сек, 0 - без ограничения)
+    fair_scheduler_window: int = 20  # Сколько задач одного типа воркер может отложить из-за лимита на пользователя
+    queue_retry_attempts: str = "generate_image:3,generate_reply:2,generate_image_prompt:2"  # Попыток на задачу по типам (включая первую) при временных ошибках
+    queue_retry_budget: float = 0.2  # Доля повторов от первых попыток: больше не повторяем, чтобы не усиливать сбой провайдера
+    queue_dead_letter_limit: int = 1000  # Сколько задач, исчерпавших повторы, хранить в dead-letter списке
+    idempotency_key_ttl: int = 300  # Сколько секунд максимум держится ключ идемпотентности запроса (двойные нажатия, повторная доставка)
+    idempotency_key_linger: int = 30  # Сколько секунд после обработки запроса его ключ ещё указывает на задачу: поздний повтор не списывает ресурсы и получает её результат
+    worker_shutdown_grace: float = 30.0  # Сколько секунд при остановке воркер ждёт выполняющиеся задачи, прежде чем вернуть их в очередь
+    worker_processes: int = 0  # Процессов воркера под супервизором worker.py (0 - по числу ядер, 1 - один процесс); MAX_CONCURRENT_* делятся между ними
+    worker_unhealthy_after: int = 5  # После скольких временных ошибок провайдера подряд воркер сообщает, что тип задач ему недоступен
+    worker_unhealthy_cooldown: float = 60.0  # Сколько секунд провайдер считается нездоровым, прежде чем воркер снова пробует задачи
+    worker_heartbeat_interval: float = 5.0  # Как часто воркер обновляет свою запись в реестре (сек, не реже queue_visibility_timeout / 3)
+    worker_stats_interval: float = 60.0  # Как часто воркер пишет в лог метрики очереди и лимиты провайдеров (сек, 0 - не писать)
     energy_regen_amount: int = 1  # Количество энергии, восстанавливаемой за раз
     energy_regen_interval: int = 60  # Интервал регенерации энергии в секундах
 
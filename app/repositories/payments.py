@@ -156,6 +156,28 @@ async def get_user_payments(
     return list(result.scalars().all())
 
 
+async def has_recent_payment(session: AsyncSession, user_id: int, days: int) -> bool:
+    """
+    Проверяет, платил ли пользователь за последние days дней.
+    
+    Args:
+        session: Сессия БД
+        user_id: ID пользователя
+        days: Глубина истории в днях
+    
+    Returns:
+        True, если есть хотя бы один платёж
+    """
+    since = datetime.now() - timedelta(days=days)
+    stmt = (
+        select(Payment.id)
+        .where(Payment.user_id == user_id, Payment.created_at >= since)
+        .limit(1)
+    )
+    result = await session.execute(stmt)
+    return result.scalar() is not None
+
+
 async def get_top_donors(session: AsyncSession, limit: int = 10) -> list[tuple[int, int, int]]:
     """
     Получает топ донатеров по общей сумме платежей.
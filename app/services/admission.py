@@ -0,0 +1,140 @@
+import logging
+from typing import Any
+
+from pydantic import BaseModel
+
+from app.config import settings
+from app.services.queue_service import QueueService, TaskStatus, TaskType, queue_service
+
+logger = logging.getLogger(__name__)
+
+# Время обработки по умолчанию, пока воркеры не накопили статистику (секунды)
+_DEFAULT_SERVICE_TIMES = {
+    TaskType.GENERATE_IMAGE: 20.0,
+    TaskType.GENERATE_REPLY: 5.0,
+    TaskType.GENERATE_IMAGE_PROMPT: 5.0,
+}
+
+# Слоты по умолчанию, если воркеры не сообщают свою ёмкость
+_DEFAULT_CAPACITY = {
+    TaskType.GENERATE_IMAGE: settings.max_concurrent_image_generations,
+    TaskType.GENERATE_REPLY: settings.max_concurrent_reply_generations,
+    TaskType.GENERATE_IMAGE_PROMPT: settings.max_concurrent_reply_generations,
+}
+
+
+class AdmissionDecision(BaseModel):
+    """Решение о приёме задачи в очередь."""
+    admitted: bool
+    ahead: int  # Задач перед новой задачей
+    eta: float  # Ожидаемое время до результата (секунды)
+
+
+class AdmissionController:
+    """
+    Контроль приёма задач по состоянию очереди.
+
+    Оценивает время до результата по глубине очереди, числу слотов живых
+    воркеров и медиане последних времён обработки. Если оценка больше
+    settings.admission_max_eta, задачу лучше не ставить: пользователь всё
+    равно не дождётся результата, а очередь станет ещё длиннее.
+
+    Для цепочки (enqueue_task(..., next_stages=...)) оценка складывается из
+    оценок всех этапов: каждый этап стоит в очереди своего типа.
+    """
+
+    def __init__(self, service: QueueService) -> None:
+        self._service = service
+
+    async def check(self, task_type: TaskType, next_stages: list[TaskType] | None = None) -> AdmissionDecision:
+        """
+        Проверяет, можно ли сейчас поставить задачу типа task_type.
+
+        Args:
+            task_type: Тип задачи (первого этапа цепочки)
+            next_stages: Типы следующих этапов цепочки
+
+        Returns:
+            Решение с оценкой очереди первого этапа и времени до результата всей цепочки
+        """
+        stages = [task_type, *(next_stages or [])]
+        try:
+            loads = [await self._service.get_load(stage) for stage in stages]
+        except Exception as exc:
+            # Без оценки нагрузки не отказываем: очередь работает как раньше
+            logger.warning(f"Failed to estimate queue load: {exc}")
+            return AdmissionDecision(
+                admitted=True, ahead=0, eta=sum(_DEFAULT_SERVICE_TIMES[stage] for stage in stages)
+            )
+
+        ahead = loads[0]["depth"]
+        for stage, load in zip(stages, loads):
+            if load["capacity"] == 0:
+                # Ни один живой воркер не обрабатывает этот этап или у всех
+                # нездоров провайдер: задача ждала бы до таймаута
+                logger.info(f"Rejecting {task_type.value} task: no capacity for {stage.value}")
+                return AdmissionDecision(admitted=False, ahead=ahead, eta=0.0)
+        eta = sum(self._stage_eta(stage, load["depth"], load) for stage, load in zip(stages, loads))
+        admitted = not settings.admission_max_eta or eta <= settings.admission_max_eta
+        if not admitted:
+            logger.info(f"Rejecting {task_type.value} task: {ahead} ahead, ETA {eta:.0f}s")
+        return AdmissionDecision(admitted=admitted, ahead=ahead, eta=eta)
+
+    async def progress(
+        self,
+        task_id: str,
+        task_type: TaskType,
+        next_stages: list[TaskType] | None = None,
+    ) -> tuple[TaskStatus | None, int, float]:
+        """
+        Возвращает статус задачи, число задач перед ней и оценку времени до результата.
+
+        Позиция берётся в очереди текущего этапа цепочки, к оценке добавляются
+        оставшиеся этапы.
+
+        Args:
+            task_id: ID задачи
+            task_type: Тип задачи (первого этапа цепочки)
+            next_stages: Типы следующих этапов цепочки
+
+        Returns:
+            (статус или None, задач впереди на текущем этапе, секунд до результата)
+        """
+        status, current, ahead = await self._service.get_task_position(task_id)
+        if status != TaskStatus.PENDING:
+            return status, 0, 0.0
+        stages = [task_type, *(next_stages or [])]
+        if current in stages:
+            stages = stages[stages.index(current):]
+        eta = 0.0
+        for index, stage in enumerate(stages):
+            load = await self._service.get_load(stage)
+            # Текущий этап - по позиции задачи, следующие - по глубине их очередей сейчас
+            eta += self._stage_eta(stage, ahead if index == 0 else load["depth"], load)
+        return status, ahead, eta
+
+    def _stage_eta(self, task_type: TaskType, ahead: int, load: dict[str, Any]) -> float:
+        return self.estimate_eta(task_type, ahead, load["capacity"], load["service_time"])
+
+    @staticmethod
+    def estimate_eta(
+        task_type: TaskType,
+        ahead: int,
+        capacity: int | None,
+        service_time: float | None,
+    ) -> float:
+        """
+        Оценивает время до результата задачи, перед которой ahead задач.
+
+        Задачи выполняются волнами по capacity штук, новая задача попадает
+        в волну номер ahead // capacity + 1.
+        """
+        if not capacity:
+            capacity = _DEFAULT_CAPACITY[task_type]
+        if service_time is None:
+            service_time = _DEFAULT_SERVICE_TIMES[task_type]
+        return (ahead // capacity + 1) * service_time
+
+
+# Глобальный экземпляр контроллера
+admission_controller = AdmissionController(queue_service)
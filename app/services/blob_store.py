@@ -0,0 +1,218 @@
+import asyncio
+import logging
+import os
+import time
+import uuid
+from abc import ABC, abstractmethod
+from pathlib import Path
+
+import redis.asyncio as redis
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class BlobStore(ABC):
+    """
+    Хранилище бинарных данных (сгенерированных изображений) вне JSON задач.
+
+    Воркер кладёт байты через put и сохраняет в результате задачи только
+    ссылку, бот читает их через get без base64. Данные живут не дольше
+    settings.redis_result_ttl, как и результат задачи.
+    """
+
+    @abstractmethod
+    async def put(self, data: bytes) -> str:
+        """
+        Сохраняет данные.
+
+        Args:
+            data: Байты для сохранения
+
+        Returns:
+            Ссылка на данные
+        """
+
+    @abstractmethod
+    async def get(self, ref: str) -> bytes | None:
+        """
+        Читает данные по ссылке.
+
+        Args:
+            ref: Ссылка, полученная от put
+
+        Returns:
+            Байты или None, если данные не найдены (удалены или истекли)
+        """
+
+    @abstractmethod
+    async def delete(self, ref: str) -> None:
+        """Удаляет данные по ссылке."""
+
+    def local_path(self, ref: str) -> Path | None:
+        """Путь к файлу с данными, если их можно отдать прямо с диска."""
+        return None
+
+    def redis_key(self, ref: str) -> str | None:
+        """Ключ Redis с данными, если они хранятся в Redis (для учёта памяти результатов)."""
+        return None
+
+    async def close(self) -> None:
+        """Освобождает ресурсы хранилища."""
+
+
+class RedisBlobStore(BlobStore):
+    """Хранит данные как сырые байты в отдельных ключах Redis."""
+
+    def __init__(self) -> None:
+        self._redis: redis.Redis | None = None
+        self._prefix = settings.redis_blob_prefix
+        self._ttl = settings.redis_result_ttl
+
+    async def _client(self) -> redis.Redis:
+        if self._redis is None:
+            # Без decode_responses: значения - бинарные данные
+            self._redis = await redis.from_url(settings.redis_url)
+        return self._redis
+
+    def _key(self, ref: str) -> str:
+        return f"{self._prefix}{ref}"
+
+    def redis_key(self, ref: str) -> str | None:
+        return self._key(ref)
+
+    async def put(self, data: bytes) -> str:
+        ref = uuid.uuid4().hex
+        client = await self._client()
+        await client.set(self._key(ref), data, ex=self._ttl)
+        return ref
+
+    async def get(self, ref: str) -> bytes | None:
+        client = await self._client()
+        return await client.get(self._key(ref))
+
+    async def delete(self, ref: str) -> None:
+        client = await self._client()
+        await client.delete(self._key(ref))
+
+    async def close(self) -> None:
+        if self._redis is not None:
+            await self._redis.close()
+            self._redis = None
+
+
+class FileBlobStore(BlobStore):
+    """
+    Хранит данные файлами в каталоге (локальном или общем для бота и воркеров).
+
+    Файлы старше settings.redis_result_ttl удаляются при очередной записи,
+    не чаще раза в минуту.
+    """
+
+    _PURGE_INTERVAL = 60.0
+
+    def __init__(self, directory: str) -> None:
+        self._dir = Path(directory)
+        self._ttl = settings.redis_result_ttl
+        self._last_purge = 0.0
+
+    def _path(self, ref: str) -> Path:
+        # Ссылка - только hex-имя, поэтому выйти за пределы каталога нельзя
+        if not ref.isalnum():
+            raise ValueError(f"Invalid blob reference: {ref!r}")
+        return self._dir / f"{ref}.bin"
+
+    def _write(self, path: Path, data: bytes) -> None:
+        self._dir.mkdir(parents=True, exist_ok=True)
+        # Пишем во временный файл и переименовываем, чтобы читатель
+        # никогда не увидел недописанный файл
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+
+    def _read(self, path: Path) -> bytes | None:
+        try:
+            return path.read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def _purge_expired(self) -> None:
+        deadline = time.time() - self._ttl
+        for path in self._dir.glob("*.bin"):
+            try:
+                if path.stat().st_mtime < deadline:
+                    path.unlink()
+            except FileNotFoundError:
+                pass
+
+    async def put(self, data: bytes) -> str:
+        ref = uuid.uuid4().hex
+        await asyncio.to_thread(self._write, self._path(ref), data)
+        now = time.monotonic()
+        if now - self._last_purge >= self._PURGE_INTERVAL:
+            self._last_purge = now
+            try:
+                await asyncio.to_thread(self._purge_expired)
+            except OSError as exc:
+                logger.warning(f"Failed to purge expired blobs: {exc}")
+        return ref
+
+    async def get(self, ref: str) -> bytes | None:
+        return await asyncio.to_thread(self._read, self._path(ref))
+
+    async def delete(self, ref: str) -> None:
+        await asyncio.to_thread(self._path(ref).unlink, missing_ok=True)
+
+    def local_path(self, ref: str) -> Path | None:
+        path = self._path(ref)
+        return path if path.exists() else None
+
+
+class MemoryBlobStore(BlobStore):
+    """
+    Хранит данные в памяти процесса.
+
+    Годится только вместе с queue_backend="memory", когда бот и воркер
+    работают в одном процессе. Истёкшие данные удаляются при очередной записи.
+    """
+
+    def __init__(self) -> None:
+        self._ttl = settings.redis_result_ttl
+        # Ссылка -> (данные, момент истечения)
+        self._blobs: dict[str, tuple[bytes, float]] = {}
+
+    def _purge_expired(self) -> None:
+        now = time.monotonic()
+        for ref in [ref for ref, (_, expires) in self._blobs.items() if expires <= now]:
+            del self._blobs[ref]
+
+    async def put(self, data: bytes) -> str:
+        self._purge_expired()
+        ref = uuid.uuid4().hex
+        self._blobs[ref] = (data, time.monotonic() + self._ttl)
+        return ref
+
+    async def get(self, ref: str) -> bytes | None:
+        entry = self._blobs.get(ref)
+        if entry is None or entry[1] <= time.monotonic():
+            return None
+        return entry[0]
+
+    async def delete(self, ref: str) -> None:
+        self._blobs.pop(ref, None)
+
+
+def create_blob_store() -> BlobStore:
+    """Создаёт хранилище с бэкендом, выбранным в settings.blob_store_backend."""
+    if settings.blob_store_backend == "redis":
+        return RedisBlobStore()
+    if settings.blob_store_backend == "file":
+        return FileBlobStore(settings.blob_store_dir)
+    if settings.blob_store_backend == "memory":
+        return MemoryBlobStore()
+    raise ValueError(f"Unknown blob store backend: {settings.blob_store_backend}")
+
+
+# Глобальный экземпляр хранилища
+blob_store = create_blob_store()
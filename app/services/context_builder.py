@@ -0,0 +1,100 @@
+import logging
+import math
+
+from pydantic import BaseModel
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Символов на токен в BPE-токенизаторах моделей Venice (Llama, Qwen): латиница
+# и знаки кодируются плотнее, кириллица и прочие алфавиты - почти вдвое хуже
+_CHARS_PER_TOKEN_ASCII = 4.0
+_CHARS_PER_TOKEN_OTHER = 2.5
+# Служебные токены сообщения в chat-шаблоне (роль, разделители)
+_MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Оценивает число токенов текста без токенизатора модели.
+
+    Точность - около 10-15% для русского и английского текста: этого
+    достаточно, чтобы держать размер промпта в пределах бюджета.
+    """
+    ascii_chars = sum(1 for char in text if char.isascii())
+    other_chars = len(text) - ascii_chars
+    return math.ceil(ascii_chars / _CHARS_PER_TOKEN_ASCII + other_chars / _CHARS_PER_TOKEN_OTHER)
+
+
+def estimate_message_tokens(message: dict[str, str]) -> int:
+    """Оценивает число токенов сообщения чата вместе со служебными."""
+    return estimate_tokens(message.get("content", "")) + _MESSAGE_OVERHEAD_TOKENS
+
+
+def get_context_budget(model: str) -> int:
+    """
+    Возвращает бюджет промпта модели в токенах.
+
+    Бюджет берётся из settings.reply_context_model_tokens ("модель:токены"
+    через запятую), для остальных моделей - settings.reply_context_tokens.
+    """
+    for item in settings.reply_context_model_tokens.split(","):
+        # Имя модели может содержать двоеточие: бюджет - после последнего
+        name, _, tokens = item.strip().rpartition(":")
+        if name and name == model:
+            return int(tokens)
+    return settings.reply_context_tokens
+
+
+class ReplyContext(BaseModel):
+    """Собранный промпт ответа."""
+    messages: list[dict[str, str]]  # Системный промпт и вошедшая в бюджет история
+    tokens: int  # Оценка токенов промпта
+    budget: int  # Бюджет промпта модели
+    history_used: int  # Сообщений истории в промпте
+    history_dropped: int  # Старых сообщений, не вошедших в бюджет
+
+
+def build_reply_context(
+    system_prompt: str,
+    history: list[dict[str, str]],
+    model: str,
+) -> ReplyContext:
+    """
+    Собирает промпт ответа в пределах бюджета токенов модели.
+
+    История добавляется от новых сообщений к старым, пока помещается в
+    бюджет вместе с системным промптом. Последнее сообщение (реплика
+    пользователя) входит всегда, даже если бюджета не хватает.
+
+    Args:
+        system_prompt: Системный промпт (с динамическими инструкциями)
+        history: История диалога от старых сообщений к новым
+        model: Модель, для которой собирается промпт
+
+    Returns:
+        Промпт с оценкой токенов
+    """
+    budget = get_context_budget(model)
+    system_message = {"role": "system", "content": system_prompt}
+    tokens = estimate_message_tokens(system_message)
+
+    kept: list[dict[str, str]] = []
+    for message in reversed(history):
+        message_tokens = estimate_message_tokens(message)
+        if kept and tokens + message_tokens > budget:
+            break
+        kept.append(message)
+        tokens += message_tokens
+    kept.reverse()
+
+    if tokens > budget:
+        logger.warning(f"Reply prompt exceeds the {model} context budget: ~{tokens} > {budget} tokens")
+    return ReplyContext(
+        messages=[system_message, *kept],
+        tokens=tokens,
+        budget=budget,
+        history_used=len(kept),
+        history_dropped=len(history) - len(kept),
+    )
@@ -0,0 +1,103 @@
+"""Общие для процесса пулы HTTP-соединений к внешним API."""
+import asyncio
+import importlib.util
+import logging
+from typing import Any
+
+import httpx
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Пулы по upstream: имя -> (event loop, клиент или транспорт)
+_clients: dict[str, tuple[asyncio.AbstractEventLoop | None, httpx.AsyncClient]] = {}
+_transports: dict[str, tuple[asyncio.AbstractEventLoop | None, httpx.AsyncHTTPTransport]] = {}
+_http2_warned = False
+
+
+def pool_limits() -> httpx.Limits:
+    """Возвращает лимиты пула соединений из настроек."""
+    return httpx.Limits(
+        max_connections=settings.http_pool_max_connections,
+        max_keepalive_connections=settings.http_pool_max_keepalive,
+        keepalive_expiry=settings.http_pool_keepalive_expiry,
+    )
+
+
+def http2_enabled() -> bool:
+    """Проверяет, включён ли HTTP/2 и установлен ли для него пакет h2."""
+    global _http2_warned
+    if not settings.http_pool_http2:
+        return False
+    if importlib.util.find_spec("h2") is None:
+        if not _http2_warned:
+            logger.warning("HTTP_POOL_HTTP2 is set but the h2 package is not installed (pip install httpx[http2]), using HTTP/1.1")
+            _http2_warned = True
+        return False
+    return True
+
+
+def _current_loop() -> asyncio.AbstractEventLoop | None:
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+def get_http_client(name: str, **kwargs: Any) -> httpx.AsyncClient:
+    """
+    Возвращает общий для процесса HTTP-клиент upstream'а.
+
+    Клиент создаётся при первом обращении и дальше переиспользуется:
+    запросы идут по уже открытым keep-alive соединениям, без нового
+    TCP/TLS-рукопожатия. Соединения привязаны к event loop, поэтому в
+    новом loop (повторный asyncio.run) клиент создаётся заново.
+
+    Args:
+        name: Имя upstream'а (например, "venice")
+        **kwargs: Параметры httpx.AsyncClient (base_url, headers, timeout);
+            применяются только при создании клиента
+
+    Returns:
+        Клиент; закрывать его не нужно - это делает close_http_clients
+    """
+    loop = _current_loop()
+    entry = _clients.get(name)
+    if entry is not None and entry[0] is loop and not entry[1].is_closed:
+        return entry[1]
+    client = httpx.AsyncClient(limits=pool_limits(), http2=http2_enabled(), **kwargs)
+    _clients[name] = (loop, client)
+    return client
+
+
+def get_http_transport(name: str) -> httpx.AsyncHTTPTransport:
+    """
+    Возвращает общий для процесса пул соединений upstream'а в виде транспорта.
+
+    Для библиотек, которые сами создают httpx-клиент и принимают transport
+    (replicate.Client).
+
+    Args:
+        name: Имя upstream'а (например, "replicate")
+    """
+    loop = _current_loop()
+    entry = _transports.get(name)
+    if entry is not None and entry[0] is loop:
+        return entry[1]
+    transport = httpx.AsyncHTTPTransport(limits=pool_limits(), http2=http2_enabled())
+    _transports[name] = (loop, transport)
+    return transport
+
+
+async def close_http_clients() -> None:
+    """Закрывает все общие клиенты и пулы соединений (при остановке бота или воркера)."""
+    clients = [client for _, client in _clients.values()]
+    transports = [transport for _, transport in _transports.values()]
+    _clients.clear()
+    _transports.clear()
+    for pooled in (*clients, *transports):
+        try:
+            await pooled.aclose()
+        except Exception as exc:
+            logger.warning(f"Failed to close HTTP pool: {exc}")
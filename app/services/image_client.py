@@ -3,10 +3,10 @@ import json
 import logging
 from io import BytesIO
 
-import httpx
 from PIL import Image
 
 from app.config import settings
+from app.services.http_pool import get_http_client
 
 logger = logging.getLogger(__name__)
 
@@ -15,7 +15,9 @@ class ImageClient:
     """Клиент для работы с локальным API генерации изображений."""
 
     def __init__(self) -> None:
-        self._client = httpx.AsyncClient(
+        # Общий пул соединений процесса: запросы не открывают новых соединений
+        self._client = get_http_client(
+            "local_image",
             base_url=settings.image_api_url,
             timeout=120.0,  # Генерация изображений может занимать больше времени
         )
@@ -299,6 +301,5 @@ class ImageClient:
             raise ValueError(f"Не удалось обработать изображение: {e}")
 
     async def close(self) -> None:
-        """Закрывает HTTP клиент."""
-        await self._client.aclose()
+        """Ничего не делает: соединения общего пула закрывает close_http_clients."""
 
@@ -0,0 +1,433 @@
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+import time
+import uuid
+from collections import Counter, OrderedDict, deque
+from typing import Any
+
+from app.config import settings
+from app.services.queue_service import (
+    TERMINAL_STATUSES,
+    QueueService,
+    QueueTask,
+    TaskStatus,
+    TaskType,
+    WorkerInfo,
+    _SERVICE_TIME_SAMPLES,
+)
+
+logger = logging.getLogger(__name__)
+
+# Как часто удалять истёкшие записи задач и ключи идемпотентности (секунды)
+_PURGE_INTERVAL = 60.0
+
+
+class MemoryQueueService(QueueService):
+    """
+    Бэкенд очередей в памяти процесса, без Redis.
+
+    Очереди - deque по типам и полосам, записи задач - словари, ожидание
+    задач и результатов - asyncio.Event и futures, поэтому постановка и
+    выдача задачи не требуют ни одного сетевого запроса. Воркер работает
+    в том же процессе и event loop, что и бот (см. main.py), и получает
+    этот же экземпляр сервиса.
+
+    Подходит для установки на одной машине и для тестов полного пути
+    "постановка -> обработка -> доставка". Задачи не переживают перезапуск
+    процесса, поэтому бэкенд не надёжный: ack_task и heartbeat ничего не
+    делают, а requeue_expired ничего не возвращает.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._reliable = False
+        # Записи задач (то, что в Redis лежит в хэшах), их номера и сроки жизни
+        self._tasks: dict[str, QueueTask] = {}
+        self._tickets: dict[str, int] = {}
+        self._expires: dict[str, float] = {}
+        self._last_purge = 0.0
+        # Очереди по (тип, полоса): задачи встают в конец, выдаются из начала
+        self._queues: dict[tuple[TaskType, str], deque[QueueTask]] = {
+            (task_type, lane): deque()
+            for task_type in TaskType
+            for lane in self._lane_weights
+        }
+        # Срабатывает при постановке задачи и при interrupt_wait
+        self._available = asyncio.Event()
+        self._interrupted = False
+        # Повторы ждут своего времени в куче (Unix-время готовности, порядок, задача)
+        self._delayed: list[tuple[float, int, QueueTask]] = []
+        self._delayed_order = itertools.count()
+        self._dead_letters: deque[dict[str, Any]] = deque(maxlen=settings.queue_dead_letter_limit)
+        # Ключ идемпотентности -> (ID задачи, момент истечения)
+        self._idempotency: dict[str, tuple[str, float]] = {}
+        # Счётчики поставленных и начатых задач по типам (позиция в очереди)
+        self._enqueued: Counter[TaskType] = Counter()
+        self._started: Counter[TaskType] = Counter()
+        self._service_times: dict[TaskType, deque[float]] = {
+            task_type: deque(maxlen=_SERVICE_TIME_SAMPLES) for task_type in TaskType
+        }
+        # Финальные результаты в порядке завершения -> учтённый размер
+        self._results: OrderedDict[str, int] = OrderedDict()
+        self._result_bytes = 0
+        self._evicted = 0
+
+    async def connect(self) -> None:
+        """Бэкенду в памяти подключаться не к чему."""
+
+    async def disconnect(self) -> None:
+        """Бэкенду в памяти отключаться не от чего: задачи остаются до конца процесса."""
+
+    async def _ensure_listener(self) -> None:
+        # Финальные статусы будят ожидающих прямо из update_task_status
+        return None
+
+    async def enqueue_task(
+        self,
+        task_type: TaskType,
+        user_id: int,
+        data: dict[str, Any],
+        lane: str | None = None,
+        deadline: float | None = None,
+        idempotency_key: str | None = None,
+        next_stages: list[TaskType] | None = None,
+    ) -> str:
+        if lane is None:
+            lane = self._default_lane
+        elif lane not in self._lane_weights:
+            logger.warning(f"Unknown queue lane {lane!r}, using {self._default_lane!r}")
+            lane = self._default_lane
+
+        if idempotency_key is None:
+            task_id = str(uuid.uuid4())
+        else:
+            task_id, _ = await self.reserve_task_id(idempotency_key)
+            if self._get_record(task_id) is not None:
+                logger.info(f"Duplicate request {idempotency_key!r} attached to task {task_id}")
+                return task_id
+        task = QueueTask(
+            task_id=task_id,
+            task_type=task_type,
+            user_id=user_id,
+            data=data,
+            status=TaskStatus.PENDING,
+            created_at=time.time(),
+            lane=lane,
+            deadline=deadline,
+            next_stages=next_stages or [],
+        )
+
+        self._purge_expired()
+        self._enqueued[task_type] += 1
+        self._tickets[task_id] = self._enqueued[task_type]
+        self._tasks[task_id] = task
+        self._touch(task_id)
+        self._push(task.model_copy())
+        if idempotency_key is not None:
+            self._wake_waiters(task_id)
+        return task_id
+
+    async def notify_task(self, task_id: str) -> None:
+        self._wake_waiters(task_id)
+
+    async def reserve_task_id(self, idempotency_key: str) -> tuple[str, bool]:
+        now = time.monotonic()
+        entry = self._idempotency.get(idempotency_key)
+        if entry is not None and entry[1] > now:
+            return entry[0], False
+        task_id = str(uuid.uuid4())
+        self._idempotency[idempotency_key] = (task_id, now + settings.idempotency_key_ttl)
+        return task_id, True
+
+    async def release_idempotency_key(self, idempotency_key: str, task_id: str, linger: int = 0) -> None:
+        entry = self._idempotency.get(idempotency_key)
+        if entry is not None and entry[0] == task_id:
+            if linger > 0:
+                self._idempotency[idempotency_key] = (task_id, time.monotonic() + linger)
+            else:
+                del self._idempotency[idempotency_key]
+
+    async def get_task(self, task_id: str) -> QueueTask | None:
+        record = self._get_record(task_id)
+        # Копия: как и задача из Redis, она не меняется вместе с записью
+        return record.model_copy(deep=True) if record is not None else None
+
+    async def update_task_status(
+        self,
+        task_id: str,
+        status: TaskStatus,
+        result: dict[str, Any] | None = None,
+        error: str | None = None,
+        expected: TaskStatus | None = None,
+        attachment_key: str | None = None,
+        attachment_size: int = 0,
+    ) -> bool:
+        # Тот же переход, что _TRANSITION_SCRIPT; атомарен, так как не ждёт
+        # ничего между проверкой и записью. Вложения в памяти хранит
+        # MemoryBlobStore, поэтому attachment_key здесь не используется
+        record = self._get_record(task_id)
+        if record is None:
+            return False
+        current = record.status
+        if expected is not None and current != expected:
+            return False
+        if current in TERMINAL_STATUSES:
+            return False
+        if current == TaskStatus.PENDING and status == TaskStatus.PROCESSING:
+            self._started[record.task_type] += 1
+        elif current == TaskStatus.PROCESSING and status == TaskStatus.PENDING:
+            # Повтор встаёт в конец очереди и получает новый номер
+            self._enqueued[record.task_type] += 1
+            self._tickets[task_id] = self._enqueued[record.task_type]
+        record.status = status
+        if status != TaskStatus.PROCESSING:
+            record.partial = None
+        if result is not None:
+            record.result = result
+        if error:
+            record.error = error
+        self._touch(task_id)
+        if status in TERMINAL_STATUSES:
+            self._account_result(task_id, record, attachment_size)
+            self._wake_waiters(task_id)
+        return True
+
+    async def retry_task(self, task: QueueTask, error: str, delay: float) -> bool:
+        if not await self.update_task_status(
+            task.task_id,
+            TaskStatus.PENDING,
+            error=error,
+            expected=TaskStatus.PROCESSING,
+        ):
+            return False
+        retry = task.model_copy(update={
+            "status": TaskStatus.PENDING,
+            "error": error,
+            "attempt": task.attempt + 1,
+        })
+        heapq.heappush(self._delayed, (time.time() + delay, next(self._delayed_order), retry))
+        return True
+
+    async def advance_task(self, task: QueueTask, data: dict[str, Any]) -> bool:
+        record = self._get_record(task.task_id)
+        if record is None or record.status != TaskStatus.PROCESSING:
+            return False
+        next_type, *rest = task.next_stages
+        self._enqueued[next_type] += 1
+        self._tickets[task.task_id] = self._enqueued[next_type]
+        record.status = TaskStatus.PENDING
+        record.task_type = next_type
+        record.data = data
+        record.error = None
+        self._touch(task.task_id)
+        self._push(task.model_copy(update={
+            "task_type": next_type,
+            "data": data,
+            "status": TaskStatus.PENDING,
+            "error": None,
+            "attempt": 0,
+            "next_stages": rest,
+        }))
+        return True
+
+    async def publish_progress(self, task_id: str, partial: str) -> bool:
+        record = self._get_record(task_id)
+        if record is None or record.status != TaskStatus.PROCESSING:
+            return False
+        record.partial = partial
+        self._wake_waiters(task_id)
+        return True
+
+    async def return_task(self, task: QueueTask) -> bool:
+        returned = await self.update_task_status(
+            task.task_id,
+            TaskStatus.PENDING,
+            expected=TaskStatus.PROCESSING,
+        )
+        if returned:
+            self._push(task.model_copy(update={"status": TaskStatus.PENDING}))
+        return returned
+
+    async def promote_delayed_tasks(self, limit: int = 100) -> int:
+        now = time.time()
+        promoted = 0
+        while self._delayed and self._delayed[0][0] <= now and promoted < limit:
+            _, _, task = heapq.heappop(self._delayed)
+            self._push(task)
+            promoted += 1
+        return promoted
+
+    async def dead_letter_task(self, task: QueueTask, error: str) -> None:
+        self._dead_letters.appendleft({
+            "task": task.model_dump(mode="json"),
+            "error": error,
+            "failed_at": time.time(),
+        })
+
+    async def get_dead_letters(self, limit: int | None = 100) -> list[dict[str, Any]]:
+        entries = self._dead_letters if limit is None else itertools.islice(self._dead_letters, limit)
+        return [dict(entry) for entry in entries]
+
+    async def requeue_dead_letter(self, task_id: str) -> bool:
+        for entry in self._dead_letters:
+            if entry["task"]["task_id"] != task_id:
+                continue
+            record = self._get_record(task_id)
+            if record is None or record.status != TaskStatus.FAILED:
+                return False
+            if record.deadline is not None and record.deadline <= time.time():
+                return False
+            self._dead_letters.remove(entry)
+            task = QueueTask.model_validate(entry["task"])
+            self._enqueued[task.task_type] += 1
+            self._tickets[task_id] = self._enqueued[task.task_type]
+            record.status = TaskStatus.PENDING
+            record.error = None
+            self._touch(task_id)
+            self._push(task.model_copy(update={"status": TaskStatus.PENDING, "error": None, "attempt": 0}))
+            return True
+        return False
+
+    async def release_task(self, task_id: str) -> bool:
+        deleted = task_id in self._tasks
+        self._forget(task_id)
+        return deleted
+
+    async def get_result_stats(self) -> dict[str, int]:
+        self._purge_expired(force=True)
+        return {
+            "bytes": self._result_bytes,
+            "count": len(self._results),
+            "budget": self._result_budget,
+            "evicted": self._evicted,
+        }
+
+    async def _accept_task(self, payload: QueueTask, receipt: Any) -> QueueTask | None:
+        # В очередях лежат сами задачи: разбирать нечего
+        return await self._claim_task(payload, receipt)
+
+    def _push(self, task: QueueTask) -> None:
+        """Ставит задачу в конец очереди её типа и полосы и будит ожидающих."""
+        self._queues[(task.task_type, task.lane or self._default_lane)].append(task)
+        self._available.set()
+
+    async def interrupt_wait(self) -> None:
+        self._interrupted = True
+        self._available.set()
+
+    async def _pop_tasks(self, task_types: list[TaskType], timeout: float) -> list[tuple[QueueTask, Any]]:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            for lane in self._lanes.order():
+                for task_type in task_types:
+                    queue = self._queues[(task_type, lane)]
+                    if queue:
+                        self._lanes.served(lane)
+                        return [(queue.popleft(), None)]
+            if self._interrupted:
+                self._interrupted = False
+                return []
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return []
+            self._available.clear()
+            try:
+                await asyncio.wait_for(self._available.wait(), timeout=remaining)
+            except asyncio.TimeoutError:
+                return []
+
+    async def _ack_receipt(self, receipt: Any) -> None:
+        return None
+
+    async def heartbeat(self) -> None:
+        # Состояние воркера (set_capacity, set_worker_state) читается get_workers напрямую
+        self._consumer_registered = True
+
+    async def unregister(self) -> None:
+        self._capacity = {}
+
+    async def get_workers(self) -> list[WorkerInfo]:
+        # Единственный воркер - тот, что работает в этом процессе
+        return [self._worker_info()] if self._capacity else []
+
+    async def record_service_time(self, task_type: TaskType, seconds: float) -> None:
+        self._service_times[task_type].appendleft(round(seconds, 3))
+
+    async def get_load(self, task_type: TaskType) -> dict[str, Any]:
+        depth = await self.get_queue_length(task_type)
+        samples = sorted(self._service_times[task_type])
+        return self._summarize_load(task_type, depth, await self.get_workers(), samples)
+
+    async def get_task_position(self, task_id: str) -> tuple[TaskStatus | None, TaskType | None, int]:
+        record = self._get_record(task_id)
+        if record is None:
+            return None, None, 0
+        if record.status != TaskStatus.PENDING:
+            return record.status, record.task_type, 0
+        ticket = self._tickets.get(task_id, 0)
+        return TaskStatus.PENDING, record.task_type, max(0, ticket - self._started[record.task_type] - 1)
+
+    async def requeue_expired(self) -> int:
+        return 0
+
+    async def get_queue_length(self, task_type: TaskType, lane: str | None = None) -> int:
+        lanes = [lane] if lane is not None else list(self._lane_weights)
+        return sum(len(self._queues.get((task_type, name), ())) for name in lanes)
+
+    async def clear_queue(self, task_type: TaskType) -> None:
+        for lane in self._lane_weights:
+            self._queues[(task_type, lane)].clear()
+        await self._clear_delayed(task_type)
+        await self._reset_positions(task_type)
+
+    async def _clear_delayed(self, task_type: TaskType) -> None:
+        self._delayed = [entry for entry in self._delayed if entry[2].task_type != task_type]
+        heapq.heapify(self._delayed)
+
+    async def _reset_positions(self, task_type: TaskType) -> None:
+        self._started[task_type] = self._enqueued[task_type]
+
+    def _get_record(self, task_id: str) -> QueueTask | None:
+        """Возвращает запись задачи, если её срок жизни не истёк."""
+        record = self._tasks.get(task_id)
+        if record is not None and self._expires[task_id] <= time.monotonic():
+            self._forget(task_id)
+            return None
+        return record
+
+    def _touch(self, task_id: str) -> None:
+        """Продлевает срок жизни записи задачи (аналог EXPIRE)."""
+        self._expires[task_id] = time.monotonic() + self._result_ttl
+
+    def _forget(self, task_id: str) -> None:
+        """Удаляет запись задачи и снимает её результат с учёта в бюджете памяти."""
+        self._tasks.pop(task_id, None)
+        self._tickets.pop(task_id, None)
+        self._expires.pop(task_id, None)
+        self._result_bytes -= self._results.pop(task_id, 0)
+
+    def _account_result(self, task_id: str, record: QueueTask, attachment_size: int) -> None:
+        """Учитывает финальный результат и вытесняет самые старые сверх бюджета."""
+        size = len(json.dumps(record.data, ensure_ascii=False)) + len(record.error or "") + attachment_size
+        if record.result is not None:
+            size += len(json.dumps(record.result, ensure_ascii=False))
+        self._result_bytes += size - self._results.pop(task_id, 0)
+        self._results[task_id] = size
+        while self._result_budget and self._result_bytes > self._result_budget and self._results:
+            self._forget(next(iter(self._results)))
+            self._evicted += 1
+
+    def _purge_expired(self, force: bool = False) -> None:
+        """Удаляет истёкшие записи задач и ключи идемпотентности (не чаще _PURGE_INTERVAL)."""
+        now = time.monotonic()
+        if not force and now - self._last_purge < _PURGE_INTERVAL:
+            return
+        self._last_purge = now
+        for task_id in [task_id for task_id, expires in self._expires.items() if expires <= now]:
+            self._forget(task_id)
+        for key in [key for key, (_, expires) in self._idempotency.items() if expires <= now]:
+            del self._idempotency[key]
@@ -0,0 +1,478 @@
+import asyncio
+import logging
+import math
+import random
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator
+
+import redis.asyncio as redis
+
+from app.config import settings
+from app.services.retry_policy import is_transient_error
+
+logger = logging.getLogger(__name__)
+
+# Провайдеры, к которым обращаются воркеры
+PROVIDER_LOCAL_IMAGE = "local_image"
+PROVIDER_REPLICATE = "replicate"
+PROVIDER_LIVE3D = "live3d"
+PROVIDER_VENICE = "venice"
+
+# Пауза между попытками занять слот: растёт от минимальной до максимальной (секунды)
+_MIN_POLL_INTERVAL = 0.05
+_MAX_POLL_INTERVAL = 0.5
+# Сколько успешных запросов набрать, прежде чем решать об увеличении лимита
+_ADAPTIVE_WINDOW = 20
+# Во сколько раз уменьшается лимит при перегрузке провайдера
+_DECREASE_FACTOR = 0.5
+
+# Занимает слот провайдера, если свободные есть.
+# KEYS[1] - ZSET аренд (ID аренды -> момент истечения, мс), KEYS[2] - HASH текущих лимитов
+# ARGV[1] - текущее время (мс), ARGV[2] - ID аренды, ARGV[3] - исходный лимит,
+# ARGV[4] - срок аренды (мс), ARGV[5] - поле лимита в KEYS[2] ("" - лимит не адаптивный),
+# ARGV[6] - нижняя граница лимита, ARGV[7] - верхняя граница
+# Возвращает {1 - слот занят / 0 - нет, занято слотов, текущий лимит}
+_ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local limit = tonumber(ARGV[3])
+if ARGV[5] ~= '' then
+    limit = tonumber(redis.call('HGET', KEYS[2], ARGV[5]) or limit)
+end
+limit = math.max(tonumber(ARGV[6]), math.min(tonumber(ARGV[7]), limit))
+-- Аренды упавших воркеров истекают и перестают занимать слоты
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+local held = redis.call('ZCARD', KEYS[1])
+if held >= math.floor(limit) then
+    return {0, held, tostring(limit)}
+end
+redis.call('ZADD', KEYS[1], now + tonumber(ARGV[4]), ARGV[2])
+redis.call('PEXPIRE', KEYS[1], ARGV[4])
+return {1, held + 1, tostring(limit)}
+"""
+
+# Изменяет адаптивный лимит провайдера (AIMD): +1 или умножение на коэффициент.
+# KEYS[1] - HASH текущих лимитов
+# ARGV[1] - поле лимита, ARGV[2] - текущее время (мс), ARGV[3] - исходный лимит,
+# ARGV[4] - нижняя граница, ARGV[5] - верхняя граница, ARGV[6] - "1" увеличить / "0" уменьшить,
+# ARGV[7] - коэффициент уменьшения, ARGV[8] - не уменьшать чаще, чем раз в столько мс
+# Возвращает новый лимит
+_ADJUST_SCRIPT = """
+local now = tonumber(ARGV[2])
+local floor = tonumber(ARGV[4])
+local ceiling = tonumber(ARGV[5])
+local limit = tonumber(redis.call('HGET', KEYS[1], ARGV[1]) or ARGV[3])
+if ARGV[6] == '1' then
+    limit = limit + 1
+else
+    -- Ошибки одного всплеска видят все воркеры: уменьшаем один раз за период
+    local decreased_at = tonumber(redis.call('HGET', KEYS[1], ARGV[1] .. ':decreased_at') or '0')
+    if now - decreased_at >= tonumber(ARGV[8]) then
+        limit = limit * tonumber(ARGV[7])
+        redis.call('HSET', KEYS[1], ARGV[1] .. ':decreased_at', now)
+    end
+end
+limit = math.max(floor, math.min(ceiling, limit))
+redis.call('HSET', KEYS[1], ARGV[1], tostring(limit))
+return tostring(limit)
+"""
+
+# Продлевает аренду слота.
+# KEYS[1] - ZSET аренд, ARGV[1] - текущее время (мс), ARGV[2] - ID аренды, ARGV[3] - срок аренды (мс)
+# Возвращает 0, если аренда уже истекла и слот мог достаться другому
+_RENEW_SCRIPT = """
+local expires = redis.call('ZSCORE', KEYS[1], ARGV[2])
+if not expires or tonumber(expires) <= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], tonumber(ARGV[1]) + tonumber(ARGV[3]), ARGV[2])
+redis.call('PEXPIRE', KEYS[1], ARGV[3])
+return 1
+"""
+
+
+def image_provider() -> str:
+    """Возвращает провайдера изображений, выбранного в настройках."""
+    if settings.use_live3d:
+        return PROVIDER_LIVE3D
+    if settings.use_replicate:
+        return PROVIDER_REPLICATE
+    return PROVIDER_LOCAL_IMAGE
+
+
+def parse_provider_values(raw: str, defaults: dict[str, float]) -> dict[str, float]:
+    """
+    Разбирает значения по провайдерам из строки вида "venice:10,replicate:5".
+
+    Args:
+        raw: Строка настройки
+        defaults: Значения для провайдеров, не указанных в строке
+
+    Returns:
+        Значения по провайдерам
+    """
+    values = dict(defaults)
+    for item in raw.split(","):
+        if not item.strip():
+            continue
+        name, _, value = item.partition(":")
+        values[name.strip()] = float(value)
+    return values
+
+
+def parse_provider_limits(raw: str) -> dict[str, int]:
+    """
+    Разбирает лимиты провайдеров из строки вида "venice:10,replicate:5".
+
+    Провайдеры, не указанные в строке, получают лимит по MAX_CONCURRENT_*:
+    провайдеры изображений - max_concurrent_image_generations, Venice -
+    max_concurrent_reply_generations.
+    """
+    defaults = {
+        PROVIDER_LOCAL_IMAGE: settings.max_concurrent_image_generations,
+        PROVIDER_REPLICATE: settings.max_concurrent_image_generations,
+        PROVIDER_LIVE3D: settings.max_concurrent_image_generations,
+        PROVIDER_VENICE: settings.max_concurrent_reply_generations,
+    }
+    return {name: max(1, int(value)) for name, value in parse_provider_values(raw, defaults).items()}
+
+
+class ProviderLimiter(ABC):
+    """
+    Ограничение одновременных запросов к провайдерам (локальный API
+    изображений, Replicate, Live3D, Venice).
+
+    Воркер держит слот провайдера, пока ждёт его ответа:
+
+        async with provider_limiter.slot(PROVIDER_VENICE):
+            reply = await venice_client.generate_reply(...)
+
+    Слот ждёт своей очереди, если лимит провайдера исчерпан.
+
+    С settings.provider_adaptive_limits лимит подстраивается под провайдера
+    (AIMD): растёт на единицу, когда слоты были заняты все, а p95 времени
+    ответа за последние _ADAPTIVE_WINDOW запросов не выше цели
+    (provider_latency_targets); уменьшается вдвое на временных ошибках
+    (429/5xx, таймауты, сбои сети), не чаще раза за целевое время ответа.
+    Лимит остаётся в границах provider_limit_floor..provider_limit_ceilings.
+    """
+
+    def __init__(self) -> None:
+        self._base_limits = parse_provider_limits(settings.provider_concurrency_limits)
+        self._floor = max(1, settings.provider_limit_floor)
+        # По умолчанию лимит может вырасти вдвое от исходного
+        self._ceilings = parse_provider_values(
+            settings.provider_limit_ceilings,
+            {name: limit * 2 for name, limit in self._base_limits.items()},
+        )
+        self._latency_targets = parse_provider_values(settings.provider_latency_targets, {})
+        # Текущие лимиты (для Redis - последние известные этому процессу)
+        self._limits: dict[str, float] = {
+            name: self._clamp(name, limit) for name, limit in self._base_limits.items()
+        }
+        # Время ответа успешных запросов с последнего решения об увеличении
+        self._latencies: dict[str, deque[float]] = {}
+        # Упирались ли запросы в лимит с последнего решения об увеличении
+        self._saturated: dict[str, bool] = {}
+        self._p95: dict[str, float] = {}
+
+    def _clamp(self, provider: str, limit: float) -> float:
+        return max(float(self._floor), min(self._ceilings[provider], limit))
+
+    def _adaptive(self, provider: str) -> bool:
+        return settings.provider_adaptive_limits and provider in self._latency_targets
+
+    def get_limit(self, provider: str) -> int:
+        """Возвращает лимит одновременных запросов к провайдеру."""
+        return math.floor(self._limits[provider])
+
+    @asynccontextmanager
+    async def slot(self, provider: str) -> AsyncIterator[None]:
+        """
+        Занимает слот провайдера на время блока (ждёт, если свободных нет).
+
+        Время выполнения блока и временные ошибки в нём учитываются
+        адаптивным лимитом провайдера.
+
+        Args:
+            provider: Провайдер (PROVIDER_*)
+        """
+        lease = await self.acquire(provider)
+        started_at = time.monotonic()
+        try:
+            yield
+        except Exception as exc:
+            if self._adaptive(provider) and is_transient_error(exc):
+                await self._record_overload(provider)
+            raise
+        else:
+            if self._adaptive(provider):
+                await self._record_latency(provider, time.monotonic() - started_at)
+        finally:
+            try:
+                await self.release(provider, lease)
+            except Exception as exc:
+                # Слот освободится сам по истечении аренды
+                logger.warning(f"Failed to release {provider} slot: {exc}")
+
+    async def _record_latency(self, provider: str, latency: float) -> None:
+        """Учитывает успешный запрос; по заполнении окна решает об увеличении лимита."""
+        latencies = self._latencies.setdefault(provider, deque())
+        latencies.append(latency)
+        if len(latencies) < _ADAPTIVE_WINDOW:
+            return
+        ordered = sorted(latencies)
+        p95 = ordered[min(len(ordered) - 1, math.ceil(len(ordered) * 0.95) - 1)]
+        self._p95[provider] = p95
+        saturated = self._saturated.get(provider, False)
+        latencies.clear()
+        self._saturated[provider] = False
+        # Лимит, в который запросы не упирались, ничего не говорит о
+        # возможностях провайдера: растить его незачем
+        if saturated and p95 <= self._latency_targets[provider]:
+            await self._adjust_guarded(provider, increase=True)
+
+    async def _record_overload(self, provider: str) -> None:
+        """Учитывает временную ошибку провайдера: уменьшает лимит."""
+        self._latencies.pop(provider, None)
+        self._saturated[provider] = False
+        await self._adjust_guarded(provider, increase=False)
+
+    async def _adjust_guarded(self, provider: str, increase: bool) -> None:
+        previous = self.get_limit(provider)
+        try:
+            await self._adjust(provider, increase)
+        except Exception as exc:
+            # Сбой учёта не должен влиять на задачу: лимит останется прежним
+            logger.warning(f"Failed to adjust {provider} concurrency limit: {exc}")
+            return
+        if self.get_limit(provider) != previous:
+            logger.info(f"{provider} concurrency limit {previous} -> {self.get_limit(provider)}")
+
+    @abstractmethod
+    async def _adjust(self, provider: str, increase: bool) -> None:
+        """Изменяет лимит провайдера на шаг AIMD."""
+
+    async def _current_limit(self, provider: str) -> int:
+        """Возвращает актуальный лимит провайдера."""
+        return self.get_limit(provider)
+
+    async def get_stats(self) -> dict[str, dict[str, Any]]:
+        """
+        Возвращает состояние лимитов по провайдерам.
+
+        Returns:
+            {провайдер: {"limit": текущий лимит, "in_use": занято слотов,
+            "floor"/"ceiling": границы лимита, "p95": p95 времени ответа
+            по последнему окну этого процесса (секунды) или None}}
+        """
+        stats = {}
+        for provider in self._base_limits:
+            stats[provider] = {
+                "limit": await self._current_limit(provider),
+                "in_use": await self.get_usage(provider),
+                "floor": self._floor,
+                "ceiling": math.floor(self._ceilings[provider]),
+                "p95": self._p95.get(provider),
+            }
+        return stats
+
+    @abstractmethod
+    async def acquire(self, provider: str) -> str:
+        """
+        Занимает слот провайдера, дожидаясь свободного.
+
+        Returns:
+            ID аренды (нужен для release)
+        """
+
+    @abstractmethod
+    async def release(self, provider: str, lease: str) -> None:
+        """Освобождает слот, занятый acquire."""
+
+    @abstractmethod
+    async def get_usage(self, provider: str) -> int:
+        """Возвращает число занятых слотов провайдера."""
+
+    async def close(self) -> None:
+        """Освобождает ресурсы."""
+
+
+class RedisProviderLimiter(ProviderLimiter):
+    """
+    Лимиты провайдеров на весь парк воркеров, в Redis.
+
+    Слот - аренда в ZSET `provider:<имя>:leases` с моментом истечения.
+    Держатель продлевает аренду каждую треть settings.provider_lease_ttl;
+    аренда упавшего воркера истекает, и слот освобождается без его участия.
+    Лимит соблюдается при любом числе процессов и хостов воркеров.
+
+    Адаптивный лимит общий для парка: хранится в HASH `provider:limits`, и
+    его меняет любой воркер, заметивший повод.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._redis: redis.Redis | None = None
+        self._prefix = f"{settings.redis_queue_prefix}provider:"
+        self._lease_ttl_ms = int(settings.provider_lease_ttl * 1000)
+        self._limits_key = f"{self._prefix}limits"
+        self._acquire_script = None
+        self._renew_script = None
+        self._adjust_script = None
+        # Продление аренд, которые держит этот процесс: ID аренды -> задача продления
+        self._renewals: dict[str, asyncio.Task] = {}
+
+    async def _client(self) -> redis.Redis:
+        if self._redis is None:
+            self._redis = await redis.from_url(settings.redis_url, encoding="utf-8", decode_responses=True)
+            self._acquire_script = self._redis.register_script(_ACQUIRE_SCRIPT)
+            self._renew_script = self._redis.register_script(_RENEW_SCRIPT)
+            self._adjust_script = self._redis.register_script(_ADJUST_SCRIPT)
+        return self._redis
+
+    def _key(self, provider: str) -> str:
+        return f"{self._prefix}{provider}:leases"
+
+    async def acquire(self, provider: str) -> str:
+        await self._client()
+        lease = uuid.uuid4().hex
+        interval = _MIN_POLL_INTERVAL
+        waited_since = time.monotonic()
+        while True:
+            acquired, held, limit = await self._acquire_script(
+                keys=[self._key(provider), self._limits_key],
+                args=[
+                    int(time.time() * 1000),
+                    lease,
+                    self._base_limits[provider],
+                    self._lease_ttl_ms,
+                    provider if self._adaptive(provider) else "",
+                    self._floor,
+                    self._ceilings[provider],
+                ],
+            )
+            self._limits[provider] = float(limit)
+            if held >= self.get_limit(provider):
+                self._saturated[provider] = True
+            if acquired:
+                break
+            # Случайная пауза: воркеры, ждущие один провайдер, не опрашивают Redis хором
+            await asyncio.sleep(random.uniform(interval / 2, interval))
+            interval = min(_MAX_POLL_INTERVAL, interval * 2)
+        waited = time.monotonic() - waited_since
+        if waited >= 1.0:
+            logger.info(f"Waited {waited:.1f}s for a {provider} slot")
+        self._renewals[lease] = asyncio.create_task(self._renew(provider, lease))
+        return lease
+
+    async def _renew(self, provider: str, lease: str) -> None:
+        """Продлевает аренду, пока слот не освобождён."""
+        while True:
+            await asyncio.sleep(settings.provider_lease_ttl / 3)
+            try:
+                renewed = await self._renew_script(
+                    keys=[self._key(provider)],
+                    args=[int(time.time() * 1000), lease, self._lease_ttl_ms],
+                )
+            except Exception as exc:
+                logger.warning(f"Failed to renew {provider} slot lease: {exc}")
+                continue
+            if not renewed:
+                # Запрос идёт дольше, чем аренда могла прожить без продления:
+                # лимит провайдера может быть кратковременно превышен
+                logger.warning(f"{provider} slot lease {lease} expired while held")
+                return
+
+    async def release(self, provider: str, lease: str) -> None:
+        renewal = self._renewals.pop(lease, None)
+        if renewal is not None:
+            renewal.cancel()
+        client = await self._client()
+        await client.zrem(self._key(provider), lease)
+
+    async def _adjust(self, provider: str, increase: bool) -> None:
+        await self._client()
+        limit = await self._adjust_script(
+            keys=[self._limits_key],
+            args=[
+                provider,
+                int(time.time() * 1000),
+                self._base_limits[provider],
+                self._floor,
+                self._ceilings[provider],
+                "1" if increase else "0",
+                _DECREASE_FACTOR,
+                int(self._latency_targets[provider] * 1000),
+            ],
+        )
+        self._limits[provider] = float(limit)
+
+    async def _current_limit(self, provider: str) -> int:
+        if self._adaptive(provider):
+            client = await self._client()
+            stored = await client.hget(self._limits_key, provider)
+            if stored is not None:
+                self._limits[provider] = self._clamp(provider, float(stored))
+        return self.get_limit(provider)
+
+    async def get_usage(self, provider: str) -> int:
+        client = await self._client()
+        return await client.zcount(self._key(provider), int(time.time() * 1000), "+inf")
+
+    async def close(self) -> None:
+        for renewal in self._renewals.values():
+            renewal.cancel()
+        self._renewals.clear()
+        if self._redis is not None:
+            await self._redis.close()
+            self._redis = None
+
+
+class MemoryProviderLimiter(ProviderLimiter):
+    """Лимиты провайдеров в памяти процесса (для queue_backend="memory")."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._held: dict[str, int] = {}
+        self._changed = asyncio.Condition()
+        self._decreased_at: dict[str, float] = {}
+
+    async def acquire(self, provider: str) -> str:
+        async with self._changed:
+            if self._held.get(provider, 0) >= self.get_limit(provider):
+                self._saturated[provider] = True
+            await self._changed.wait_for(lambda: self._held.get(provider, 0) < self.get_limit(provider))
+            self._held[provider] = self._held.get(provider, 0) + 1
+            if self._held[provider] >= self.get_limit(provider):
+                self._saturated[provider] = True
+        return uuid.uuid4().hex
+
+    async def _adjust(self, provider: str, increase: bool) -> None:
+        async with self._changed:
+            if increase:
+                self._limits[provider] = self._clamp(provider, self._limits[provider] + 1)
+                self._changed.notify_all()
+                return
+            now = time.monotonic()
+            if now - self._decreased_at.get(provider, 0.0) >= self._latency_targets[provider]:
+                self._decreased_at[provider] = now
+                self._limits[provider] = self._clamp(provider, self._limits[provider] * _DECREASE_FACTOR)
+
+    async def release(self, provider: str, lease: str) -> None:
+        async with self._changed:
+            self._held[provider] = max(0, self._held.get(provider, 0) - 1)
+            self._changed.notify_all()
+
+    async def get_usage(self, provider: str) -> int:
+        return self._held.get(provider, 0)
+
+
+def create_provider_limiter() -> ProviderLimiter:
+    """Создаёт ограничитель провайдеров: в Redis или, для queue_backend="memory", в памяти."""
+    if settings.queue_backend == "memory":
+        return MemoryProviderLimiter()
+    return RedisProviderLimiter()
@@ -1,4 +1,9 @@
+import asyncio
 import json
+import logging
+import os
+import socket
+import time
 import uuid
 from enum import Enum
 from typing import Any
@@ -7,6 +12,9 @@ import redis.asyncio as redis
 from pydantic import BaseModel
 
 from app.config import settings
+from app.services.task_codec import create_task_codec, decode_task, encode_task
+
+logger = logging.getLogger(__name__)
 
 
 class TaskType(str, Enum):
@@ -22,6 +30,304 @@ class TaskStatus(str, Enum):
     PROCESSING = "processing"
     COMPLETED = "completed"
     FAILED = "failed"
+    CANCELLED = "cancelled"
+
+
+# Статусы, после которых задача больше не меняется
+TERMINAL_STATUSES = frozenset({TaskStatus.COMPLETED, TaskStatus.FAILED, TaskStatus.CANCELLED})
+
+# Возвращает в очереди задачи из списков обработки воркеров, чей heartbeat истёк.
+# Ключи списков вычисляются внутри скрипта, поэтому он рассчитан на одиночный Redis.
+# KEYS[1] - множество зарегистрированных воркеров
+# ARGV[1] - префикс очередей, ARGV[2] - полоса по умолчанию
+_REQUEUE_EXPIRED_SCRIPT = """
+local requeued = 0
+for _, consumer in ipairs(redis.call('SMEMBERS', KEYS[1])) do
+    if redis.call('EXISTS', ARGV[1] .. 'consumer:' .. consumer) == 0 then
+        local processing = ARGV[1] .. 'processing:' .. consumer
+        while true do
+            local item = redis.call('LPOP', processing)
+            if not item then
+                break
+            end
+            -- Тип и полоса берутся из заголовка payload (см. task_codec),
+            -- у payload старого формата (JSON без заголовка) - из тела
+            local task_type, lane = string.match(item, '^qt%d+:[^:]*:([^:]*):([^:\\n]*)\\n')
+            if not task_type then
+                local ok, task = pcall(cjson.decode, item)
+                if ok and type(task) == 'table' then
+                    task_type = task['task_type']
+                    lane = task['lane']
+                end
+            end
+            if type(task_type) == 'string' then
+                local queue = ARGV[1] .. task_type
+                if type(lane) == 'string' and lane ~= '' and lane ~= ARGV[2] then
+                    queue = queue .. ':' .. lane
+                end
+                -- RPUSH: воркеры забирают задачи справа, возвращённая задача пойдёт первой
+                redis.call('RPUSH', queue, item)
+                redis.call('LPUSH', ARGV[1] .. 'wakeup:' .. task_type, '1')
+                requeued = requeued + 1
+            end
+        end
+        redis.call('SREM', KEYS[1], consumer)
+    end
+end
+return requeued
+"""
+
+# Убирает из реестра воркеры без heartbeat, у которых не осталось задач в списке
+# обработки (непустые списки разбирает _REQUEUE_EXPIRED_SCRIPT).
+# KEYS[1] - множество зарегистрированных воркеров
+# ARGV[1] - префикс очередей, ARGV[2..] - ID воркеров
+# Возвращает количество убранных воркеров
+_PRUNE_CONSUMERS_SCRIPT = """
+local removed = 0
+for i = 2, #ARGV do
+    local consumer = ARGV[i]
+    if redis.call('EXISTS', ARGV[1] .. 'consumer:' .. consumer) == 0
+        and redis.call('LLEN', ARGV[1] .. 'processing:' .. consumer) == 0 then
+        removed = removed + redis.call('SREM', KEYS[1], consumer)
+    end
+end
+return removed
+"""
+
+# Атомарно перекладывает первую задачу из первой непустой очереди в список обработки.
+# KEYS[1] - список обработки воркера, KEYS[2..] - очереди в порядке опроса
+# Возвращает {номер очереди с нуля, задача}
+_POP_ANY_SCRIPT = """
+for i = 2, #KEYS do
+    local item = redis.call('LMOVE', KEYS[i], KEYS[1], 'RIGHT', 'LEFT')
+    if item then
+        return {i - 2, item}
+    end
+end
+return false
+"""
+
+# Атомарно меняет статус задачи в её хэше, не перезаписывая остальные поля.
+# KEYS[1] - хэш задачи, KEYS[2] - индекс результатов (ZSET по времени завершения),
+# KEYS[3] - размеры результатов (HASH), KEYS[4] - счётчик байт, KEYS[5] - счётчик вытеснений
+# ARGV[1] - новый статус, ARGV[2] - TTL, ARGV[3] - результат (JSON или ''),
+# ARGV[4] - ошибка (или ''), ARGV[5] - ожидаемый текущий статус (или ''),
+# ARGV[6] - канал событий (или '', если статус не финальный), ARGV[7] - task_id,
+# ARGV[8] - ключ вложения результата (или ''), ARGV[9] - размер вложения в байтах,
+# ARGV[10] - текущее время (мс), ARGV[11] - бюджет памяти результатов в байтах (0 - без лимита)
+# ARGV[12] - префикс счётчиков очереди (для учёта начатых задач)
+# ARGV[13..] - финальные статусы, из которых переход запрещён
+# Возвращает 1, если статус изменён, иначе 0
+_TRANSITION_SCRIPT = """
+if redis.call('TYPE', KEYS[1]).ok ~= 'hash' then
+    return 0
+end
+local current = redis.call('HGET', KEYS[1], 'status')
+if ARGV[5] ~= '' and current ~= ARGV[5] then
+    return 0
+end
+for i = 13, #ARGV do
+    if current == ARGV[i] then
+        return 0
+    end
+end
+if current == 'pending' and ARGV[1] == 'processing' then
+    -- Счётчик начатых задач: по нему считается позиция в очереди
+    redis.call('INCR', ARGV[12] .. redis.call('HGET', KEYS[1], 'task_type') .. ':started')
+elseif current == 'processing' and ARGV[1] == 'pending' then
+    -- Повтор встаёт в конец очереди и получает новый номер
+    local ticket = redis.call('INCR', ARGV[12] .. redis.call('HGET', KEYS[1], 'task_type') .. ':enqueued')
+    redis.call('HSET', KEYS[1], 'ticket', ticket)
+end
+redis.call('HSET', KEYS[1], 'status', ARGV[1])
+if ARGV[1] ~= 'processing' then
+    -- Промежуточный результат нужен, только пока задача выполняется
+    redis.call('HDEL', KEYS[1], 'partial')
+end
+if ARGV[3] ~= '' then
+    redis.call('HSET', KEYS[1], 'result', ARGV[3])
+end
+if ARGV[4] ~= '' then
+    redis.call('HSET', KEYS[1], 'error', ARGV[4])
+end
+if ARGV[8] ~= '' then
+    redis.call('HSET', KEYS[1], 'attachment', ARGV[8])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+if ARGV[6] ~= '' then
+    -- Учитываем финальный результат в бюджете памяти
+    local size = #ARGV[3] + #ARGV[4] + redis.call('HSTRLEN', KEYS[1], 'data') + tonumber(ARGV[9])
+    local now = tonumber(ARGV[10])
+    redis.call('ZADD', KEYS[2], now, ARGV[7])
+    redis.call('HSET', KEYS[3], ARGV[7], size)
+    local total = redis.call('INCRBY', KEYS[4], size)
+    -- Записи, истёкшие по TTL, просто перестают учитываться
+    local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now - tonumber(ARGV[2]) * 1000)
+    for _, task_id in ipairs(expired) do
+        total = redis.call('DECRBY', KEYS[4], tonumber(redis.call('HGET', KEYS[3], task_id) or '0'))
+        redis.call('HDEL', KEYS[3], task_id)
+        redis.call('ZREM', KEYS[2], task_id)
+    end
+    -- Сверх бюджета вытесняем самые старые недоставленные результаты
+    local budget = tonumber(ARGV[11])
+    while budget > 0 and total > budget do
+        local oldest = redis.call('ZPOPMIN', KEYS[2])
+        if #oldest == 0 then
+            break
+        end
+        local task_id = oldest[1]
+        local task_key = string.sub(KEYS[1], 1, #KEYS[1] - #ARGV[7]) .. task_id
+        local attachment = redis.call('HGET', task_key, 'attachment')
+        if attachment then
+            redis.call('DEL', attachment)
+        end
+        redis.call('DEL', task_key)
+        total = redis.call('DECRBY', KEYS[4], tonumber(redis.call('HGET', KEYS[3], task_id) or '0'))
+        redis.call('HDEL', KEYS[3], task_id)
+        redis.call('INCR', KEYS[5])
+    end
+    redis.call('PUBLISH', ARGV[6], ARGV[7])
+end
+return 1
+"""
+
+# Создаёт хэш задачи и выдаёт ей номер в очереди её типа.
+# KEYS[1] - хэш задачи, KEYS[2] - счётчик поставленных задач типа
+# ARGV[1] - TTL, ARGV[2..] - пары поле/значение
+_CREATE_TASK_SCRIPT = """
+local ticket = redis.call('INCR', KEYS[2])
+redis.call('HSET', KEYS[1], 'ticket', ticket, unpack(ARGV, 2))
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return ticket
+"""
+
+# Удаляет доставленный результат задачи и снимает его с учёта в бюджете памяти.
+# Вложение (изображение) не удаляется: его освобождает тот, кто его отправил.
+# KEYS[1] - хэш задачи, KEYS[2] - индекс результатов, KEYS[3] - размеры, KEYS[4] - счётчик байт
+# ARGV[1] - task_id
+# Возвращает 1, если запись задачи удалена этим вызовом
+_RELEASE_SCRIPT = """
+local deleted = redis.call('DEL', KEYS[1])
+if redis.call('ZREM', KEYS[2], ARGV[1]) == 1 then
+    redis.call('DECRBY', KEYS[4], tonumber(redis.call('HGET', KEYS[3], ARGV[1]) or '0'))
+end
+redis.call('HDEL', KEYS[3], ARGV[1])
+return deleted
+"""
+
+# Переводит выполняющуюся задачу к следующему этапу цепочки.
+# KEYS[1] - хэш задачи, KEYS[2] - счётчик поставленных задач нового типа
+# ARGV[1] - TTL, ARGV[2] - тип следующего этапа, ARGV[3] - данные этапа (JSON)
+# Возвращает 1, если задача переведена (0 - её отменили или она завершена)
+_ADVANCE_TASK_SCRIPT = """
+if redis.call('TYPE', KEYS[1]).ok ~= 'hash' or redis.call('HGET', KEYS[1], 'status') ~= 'processing' then
+    return 0
+end
+local ticket = redis.call('INCR', KEYS[2])
+redis.call('HSET', KEYS[1], 'status', 'pending', 'task_type', ARGV[2], 'data', ARGV[3], 'ticket', ticket)
+redis.call('HDEL', KEYS[1], 'error')
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return 1
+"""
+
+# Возвращает в очередь задачу из dead-letter списка под тем же ID, пока её ещё ждут.
+# KEYS[1] - dead-letter список, KEYS[2] - хэш задачи, KEYS[3] - счётчик поставленных задач типа
+# ARGV[1] - запись dead-letter списка, ARGV[2] - TTL, ARGV[3] - текущее Unix-время
+# Возвращает 1, если задача снова PENDING (0 - запись задачи освобождена или deadline прошёл)
+_REVIVE_TASK_SCRIPT = """
+if redis.call('TYPE', KEYS[2]).ok ~= 'hash' or redis.call('HGET', KEYS[2], 'status') ~= 'failed' then
+    return 0
+end
+local deadline = redis.call('HGET', KEYS[2], 'deadline')
+if deadline and tonumber(deadline) <= tonumber(ARGV[3]) then
+    return 0
+end
+if redis.call('LREM', KEYS[1], 1, ARGV[1]) == 0 then
+    return 0
+end
+local ticket = redis.call('INCR', KEYS[3])
+redis.call('HSET', KEYS[2], 'status', 'pending', 'ticket', ticket)
+redis.call('HDEL', KEYS[2], 'error')
+redis.call('EXPIRE', KEYS[2], ARGV[2])
+return 1
+"""
+
+# Сохраняет промежуточный результат выполняющейся задачи и будит ожидающих.
+# KEYS[1] - хэш задачи, ARGV[1] - промежуточный результат, ARGV[2] - канал событий, ARGV[3] - task_id
+# Возвращает 1, если результат сохранён (0 - задачу отменили или она завершена)
+_PROGRESS_SCRIPT = """
+if redis.call('TYPE', KEYS[1]).ok ~= 'hash' or redis.call('HGET', KEYS[1], 'status') ~= 'processing' then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'partial', ARGV[1])
+redis.call('PUBLISH', ARGV[2], ARGV[3])
+return 1
+"""
+
+# Снимает ключ идемпотентности (или сокращает его TTL), если он всё ещё принадлежит задаче.
+# KEYS[1] - ключ идемпотентности, ARGV[1] - ID задачи, ARGV[2] - сколько секунд ключ ещё живёт (0 - удалить)
+_RELEASE_IDEMPOTENCY_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    if tonumber(ARGV[2]) > 0 then
+        return redis.call('EXPIRE', KEYS[1], ARGV[2])
+    end
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# Сколько сигналов пробуждения хранить в списке wakeup:<тип>. Лишние сигналы
+# приводят лишь к холостому вызову _POP_ANY_SCRIPT, поэтому список обрезается.
+_WAKEUP_LIST_LIMIT = 64
+
+# Сколько последних времён обработки хранить для оценки времени ожидания
+_SERVICE_TIME_SAMPLES = 50
+
+
+def parse_lane_weights(raw: str) -> dict[str, int]:
+    """
+    Разбирает веса полос приоритета из строки вида "paid:4,free:1".
+    
+    Порядок полос в строке задаёт их приоритет при равных накопленных весах.
+    """
+    weights: dict[str, int] = {}
+    for item in raw.split(","):
+        if not item.strip():
+            continue
+        name, _, weight = item.partition(":")
+        weights[name.strip()] = max(1, int(weight or 1))
+    if not weights:
+        raise ValueError("At least one queue lane is required")
+    return weights
+
+
+class LaneScheduler:
+    """
+    Smooth weighted round-robin по полосам приоритета.
+    
+    Пока все полосы непусты, полоса с весом w получает w / sum(weights) всех
+    выдач, поэтому бесплатная полоса с весом 1 не голодает даже при постоянном
+    потоке платных задач. Пустые полосы свою долю не копят.
+    """
+    
+    def __init__(self, weights: dict[str, int]) -> None:
+        self._weights = weights
+        self._total = sum(weights.values())
+        self._current = {lane: 0 for lane in weights}
+    
+    def order(self) -> list[str]:
+        """Возвращает полосы в порядке, в котором их стоит опросить сейчас."""
+        return sorted(
+            self._weights,
+            key=lambda lane: self._current[lane] + self._weights[lane],
+            reverse=True,
+        )
+    
+    def served(self, lane: str) -> None:
+        """Учитывает, что задача была выдана из полосы lane."""
+        for name, weight in self._weights.items():
+            self._current[name] += weight
+        self._current[lane] -= self._total
 
 
 class QueueTask(BaseModel):
@@ -34,16 +340,151 @@ class QueueTask(BaseModel):
     created_at: float | None = None
     result: dict[str, Any] | None = None
     error: str | None = None
+    lane: str | None = None  # Полоса приоритета (None - полоса по умолчанию)
+    deadline: float | None = None  # Unix-время, после которого результат уже не нужен
+    attempt: int = 0  # Номер попытки выполнения (0 - первая)
+    # Следующие этапы цепочки: по завершении этапа задача с тем же ID
+    # переходит к следующему типу (см. QueueService.advance_task)
+    next_stages: list[TaskType] = []
+    # Промежуточный результат выполняющейся задачи (текст ответа по мере генерации)
+    partial: str | None = None
+    
+    def to_hash(self) -> dict[str, str]:
+        """Раскладывает задачу по полям хэша Redis (вложенные словари - в JSON)."""
+        fields = {
+            "task_id": self.task_id,
+            "task_type": self.task_type.value,
+            "user_id": str(self.user_id),
+            "data": json.dumps(self.data, ensure_ascii=False),
+            "status": self.status.value,
+        }
+        if self.created_at is not None:
+            fields["created_at"] = repr(self.created_at)
+        if self.result is not None:
+            fields["result"] = json.dumps(self.result, ensure_ascii=False)
+        if self.error is not None:
+            fields["error"] = self.error
+        if self.lane is not None:
+            fields["lane"] = self.lane
+        if self.deadline is not None:
+            fields["deadline"] = repr(self.deadline)
+        if self.partial is not None:
+            fields["partial"] = self.partial
+        return fields
+    
+    @classmethod
+    def from_hash(cls, fields: dict[str, str]) -> "QueueTask":
+        """Собирает задачу из полей хэша Redis (обратное к to_hash)."""
+        return cls(
+            task_id=fields["task_id"],
+            task_type=fields["task_type"],
+            user_id=int(fields["user_id"]),
+            data=json.loads(fields.get("data") or "{}"),
+            status=fields.get("status", TaskStatus.PENDING),
+            created_at=float(fields["created_at"]) if fields.get("created_at") else None,
+            result=json.loads(fields["result"]) if fields.get("result") else None,
+            error=fields.get("error"),
+            lane=fields.get("lane"),
+            deadline=float(fields["deadline"]) if fields.get("deadline") else None,
+            partial=fields.get("partial"),
+        )
+
+
+class WorkerInfo(BaseModel):
+    """Запись живого воркера в реестре (публикуется воркером в heartbeat)."""
+    worker_id: str
+    # Слоты, занятые слоты и здоровье провайдера по типам задач (ключи - TaskType.value)
+    capacity: dict[str, int] = {}
+    load: dict[str, int] = {}
+    healthy: dict[str, bool] = {}
+    host: str | None = None
+    pid: int | None = None
+    started_at: float | None = None
+    updated_at: float | None = None
+    
+    def is_healthy(self, task_type: TaskType) -> bool:
+        """Может ли воркер сейчас выполнять задачи типа task_type."""
+        return self.capacity.get(task_type.value, 0) > 0 and self.healthy.get(task_type.value, True)
+    
+    def free_slots(self, task_type: TaskType) -> int:
+        """Свободные слоты воркера для задач типа task_type."""
+        return max(0, self.capacity.get(task_type.value, 0) - self.load.get(task_type.value, 0))
 
 
 class QueueService:
     """Сервис для работы с очередями Redis."""
     
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        queue_prefix: str | None = None,
+        result_prefix: str | None = None,
+        events_channel: str | None = None,
+    ) -> None:
+        # Префиксы и канал по умолчанию - из настроек; отдельные значения
+        # изолируют все ключи сервиса (бенчмарк, тесты)
         self._redis: redis.Redis | None = None
-        self._queue_prefix = settings.redis_queue_prefix
-        self._result_prefix = settings.redis_result_prefix
+        self._queue_prefix = queue_prefix or settings.redis_queue_prefix
+        self._result_prefix = result_prefix or settings.redis_result_prefix
         self._result_ttl = settings.redis_result_ttl
+        self._lane_weights = parse_lane_weights(settings.queue_lane_weights)
+        self._default_lane = settings.queue_default_lane
+        if self._default_lane not in self._lane_weights:
+            raise ValueError(f"Default queue lane {self._default_lane!r} is missing in queue_lane_weights")
+        self._lanes = LaneScheduler(self._lane_weights)
+        self._reliable = settings.queue_reliable
+        # Кодек тела задач в очередях (читаются задачи любого кодека)
+        self._codec = create_task_codec()
+        self._compress_threshold = settings.queue_task_compress_threshold
+        self._visibility_timeout = settings.queue_visibility_timeout
+        # Уникальный ID потребителя: у каждого процесса свой список обработки
+        self.consumer_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._processing_key = f"{self._queue_prefix}processing:{self.consumer_id}"
+        self._consumers_key = f"{self._queue_prefix}consumers"
+        self._heartbeat_key = f"{self._queue_prefix}consumer:{self.consumer_id}"
+        # Личный список пробуждения: позволяет прервать блокирующее ожидание задач
+        self._interrupt_key = f"{self._queue_prefix}wakeup:consumer:{self.consumer_id}"
+        self._consumer_registered = False
+        # Квитанции задач, взятых в работу этим процессом (нужны для ack):
+        # для списков - исходный payload, для Streams - (stream, entry_id)
+        self._inflight: dict[str, Any] = {}
+        self._requeue_expired_script: Any = None
+        self._prune_consumers_script: Any = None
+        self._pop_any_script: Any = None
+        self._transition_script: Any = None
+        self._release_script: Any = None
+        self._create_task_script: Any = None
+        self._release_idempotency_script: Any = None
+        self._advance_task_script: Any = None
+        self._revive_task_script: Any = None
+        self._progress_script: Any = None
+        # Ключ идемпотентности запроса -> ID его задачи
+        self._idempotency_prefix = f"{self._queue_prefix}idempotency:"
+        # Повторы задач после временных ошибок ждут своего времени в ZSET
+        # (payload -> Unix-время готовности), исчерпавшие повторы - в dead-letter списке
+        self._delayed_key = f"{self._queue_prefix}delayed"
+        self._dead_letter_key = f"{self._queue_prefix}dead"
+        # Счётчики поставленных и начатых задач по типам (позиция в очереди)
+        self._seq_prefix = f"{self._queue_prefix}seq:"
+        # Слоты, загрузка и здоровье провайдеров этого воркера по типам задач,
+        # публикуются в heartbeat (реестр воркеров, см. get_workers)
+        self._capacity: dict[str, int] = {}
+        self._load: dict[str, int] = {}
+        self._healthy: dict[str, bool] = {}
+        self._started_at = time.time()
+        # Учёт памяти, занятой финальными результатами задач
+        self._result_budget = settings.redis_result_memory_budget
+        self._result_index_key = f"{self._result_prefix}index"
+        self._result_sizes_key = f"{self._result_prefix}sizes"
+        self._result_bytes_key = f"{self._result_prefix}bytes"
+        self._result_evicted_key = f"{self._result_prefix}evicted"
+        # Сдвиг порядка опроса очередей, чтобы ни один тип не имел постоянного приоритета
+        self._rotation = 0
+        self._events_channel = events_channel or settings.redis_events_channel
+        # Ожидающие завершения задач: task_id -> futures ожидающих корутин
+        self._waiters: dict[str, list[asyncio.Future[None]]] = {}
+        self._pubsub: Any = None
+        self._listener: asyncio.Task | None = None
+        self._listener_lock = asyncio.Lock()
     
     async def connect(self) -> None:
         """Подключается к Redis."""
@@ -51,11 +492,25 @@ class QueueService:
             self._redis = await redis.from_url(
                 settings.redis_url,
                 encoding="utf-8",
+                # Бинарные payload задач (msgpack, zlib) проходят через str без потерь
+                encoding_errors="surrogateescape",
                 decode_responses=True
             )
+            # Скрипты регистрируются заново на новом клиенте
+            self._requeue_expired_script = None
+            self._prune_consumers_script = None
+            self._pop_any_script = None
+            self._transition_script = None
+            self._release_script = None
+            self._create_task_script = None
+            self._release_idempotency_script = None
+            self._advance_task_script = None
+            self._revive_task_script = None
+            self._progress_script = None
     
     async def disconnect(self) -> None:
         """Отключается от Redis."""
+        await self._stop_listener()
         if self._redis:
             await self._redis.close()
             self._redis = None
@@ -65,14 +520,29 @@ class QueueService:
         task_type: TaskType,
         user_id: int,
         data: dict[str, Any],
+        lane: str | None = None,
+        deadline: float | None = None,
+        idempotency_key: str | None = None,
+        next_stages: list[TaskType] | None = None,
     ) -> str:
         """
         Добавляет задачу в очередь.
         
+        Повторный вызов с тем же idempotency_key, пока ключ занят
+        (см. reserve_task_id), не создаёт новую задачу, а возвращает ID уже
+        поставленной.
+        
         Args:
             task_type: Тип задачи
             user_id: ID пользователя
             data: Данные задачи
+            lane: Полоса приоритета (по умолчанию settings.queue_default_lane)
+            deadline: Unix-время, после которого воркер не начинает задачу
+                и прерывает её выполнение (None - без ограничения)
+            idempotency_key: Ключ запроса, породившего задачу
+            next_stages: Типы следующих этапов цепочки. Результат каждого
+                этапа дополняет данные следующего, ожидающие получают
+                результат последнего этапа по тому же ID
         
         Returns:
             ID задачи
@@ -80,8 +550,16 @@ class QueueService:
         if self._redis is None:
             await self.connect()
         
-        task_id = str(uuid.uuid4())
-        import time
+        if lane is None:
+            lane = self._default_lane
+        elif lane not in self._lane_weights:
+            logger.warning(f"Unknown queue lane {lane!r}, using {self._default_lane!r}")
+            lane = self._default_lane
+        
+        if idempotency_key is None:
+            task_id = str(uuid.uuid4())
+        else:
+            task_id, _ = await self.reserve_task_id(idempotency_key)
         task = QueueTask(
             task_id=task_id,
             task_type=task_type,
@@ -89,23 +567,89 @@ class QueueService:
             data=data,
             status=TaskStatus.PENDING,
             created_at=time.time(),
+            lane=lane,
+            deadline=deadline,
+            next_stages=next_stages or [],
         )
         
-        # Добавляем задачу в очередь
-        queue_name = f"{self._queue_prefix}{task_type.value}"
-        task_json = task.model_dump_json()
-        await self._redis.lpush(queue_name, task_json)
-        
-        # Сохраняем задачу для отслеживания статуса
-        result_key = f"{self._result_prefix}{task_id}"
-        await self._redis.setex(
-            result_key,
-            self._result_ttl,
-            task_json
-        )
+        # Хэш задачи и сама задача в очереди пишутся одной транзакцией:
+        # воркер не может забрать задачу раньше, чем появится её статус
+        if self._create_task_script is None:
+            self._create_task_script = self._redis.register_script(_CREATE_TASK_SCRIPT)
+        fields = [item for pair in task.to_hash().items() for item in pair]
+        task_key = self._task_key(task_id)
+        async with self._redis.pipeline(transaction=True) as pipe:
+            if idempotency_key is not None:
+                # Задача по этому ключу уже поставлена - присоединяемся к ней
+                await pipe.watch(task_key)
+                if await pipe.exists(task_key):
+                    logger.info(f"Duplicate request {idempotency_key!r} attached to task {task_id}")
+                    return task_id
+                pipe.multi()
+            await self._create_task_script(
+                keys=[task_key, self._seq_key(task_type, "enqueued")],
+                args=[self._result_ttl, *fields],
+                client=pipe,
+            )
+            await self._push_task(pipe, task_type, self._encode_task(task), lane)
+            if idempotency_key is not None:
+                # Повтор запроса ждёт появления задачи (wait_for_task(created=True))
+                pipe.publish(self._events_channel, task_id)
+            try:
+                await pipe.execute()
+            except redis.WatchError:
+                # Задачу с этим ID только что поставил параллельный запрос
+                logger.info(f"Duplicate request {idempotency_key!r} attached to task {task_id}")
         
         return task_id
     
+    async def reserve_task_id(self, idempotency_key: str) -> tuple[str, bool]:
+        """
+        Закрепляет ID задачи за ключом идемпотентности запроса.
+        
+        Ключ держится, пока запрос не обработан (release_idempotency_key),
+        но не дольше settings.idempotency_key_ttl, и ещё
+        settings.idempotency_key_linger секунд после обработки. Повторы запроса (двойное
+        нажатие, повторная доставка update от Telegram) получают тот же ID
+        и created=False.
+        
+        Args:
+            idempotency_key: Ключ запроса (пользователь, диалог, сообщение)
+        
+        Returns:
+            (ID задачи, закреплён ли ключ этим вызовом)
+        """
+        if self._redis is None:
+            await self.connect()
+        key = self._idempotency_prefix + idempotency_key
+        while True:
+            task_id = str(uuid.uuid4())
+            if await self._redis.set(key, task_id, nx=True, ex=settings.idempotency_key_ttl):
+                return task_id, True
+            existing = await self._redis.get(key)
+            # Ключ мог истечь между SET и GET - пробуем занять его снова
+            if existing:
+                return existing, False
+    
+    async def release_idempotency_key(self, idempotency_key: str, task_id: str, linger: int = 0) -> None:
+        """
+        Освобождает ключ идемпотентности после обработки запроса.
+        
+        Args:
+            idempotency_key: Ключ запроса
+            task_id: ID задачи, за которой закреплён ключ
+            linger: Сколько секунд ключ ещё указывает на задачу, чтобы поздний
+                повтор запроса присоединился к ней (0 - удалить сразу)
+        """
+        if self._redis is None:
+            await self.connect()
+        if self._release_idempotency_script is None:
+            self._release_idempotency_script = self._redis.register_script(_RELEASE_IDEMPOTENCY_SCRIPT)
+        await self._release_idempotency_script(
+            keys=[self._idempotency_prefix + idempotency_key],
+            args=[task_id, linger],
+        )
+    
     async def get_task(self, task_id: str) -> QueueTask | None:
         """
         Получает задачу по ID.
@@ -119,17 +663,22 @@ class QueueService:
         if self._redis is None:
             await self.connect()
         
-        result_key = f"{self._result_prefix}{task_id}"
-        task_json = await self._redis.get(result_key)
-        
-        if not task_json:
-            return None
+        try:
+            fields = await self._redis.hgetall(self._task_key(task_id))
+        except redis.ResponseError:
+            # Ключ в старом формате (JSON-строка), записанный до перехода на хэши
+            fields = None
         
         try:
-            task_dict = json.loads(task_json)
-            return QueueTask(**task_dict)
+            if fields:
+                return QueueTask.from_hash(fields)
+            if fields is None:
+                task_json = await self._redis.get(self._task_key(task_id))
+                if task_json:
+                    return QueueTask(**json.loads(task_json))
         except Exception:
-            return None
+            pass
+        return None
     
     async def update_task_status(
         self,
@@ -137,36 +686,542 @@ class QueueService:
         status: TaskStatus,
         result: dict[str, Any] | None = None,
         error: str | None = None,
-    ) -> None:
+        expected: TaskStatus | None = None,
+        attachment_key: str | None = None,
+        attachment_size: int = 0,
+    ) -> bool:
         """
         Обновляет статус задачи.
         
+        Переход выполняется атомарно на стороне Redis и меняет только
+        переданные поля. Задача в финальном статусе (COMPLETED/FAILED/CANCELLED)
+        больше не меняется, поэтому конкурентные писатели не затирают
+        друг друга.
+        
+        Финальные результаты учитываются в бюджете памяти
+        settings.redis_result_memory_budget: при его превышении самые старые
+        недоставленные результаты (вместе с вложениями) удаляются.
+        
         Args:
             task_id: ID задачи
             status: Новый статус
             result: Результат выполнения (если есть)
             error: Ошибка (если есть)
+            expected: Менять статус, только если текущий равен expected
+            attachment_key: Ключ Redis с данными результата (удаляется вместе с ним при вытеснении)
+            attachment_size: Размер вложения в байтах (для бюджета памяти)
+        
+        Returns:
+            True, если статус изменён
         """
         if self._redis is None:
             await self.connect()
+        if self._transition_script is None:
+            self._transition_script = self._redis.register_script(_TRANSITION_SCRIPT)
         
-        task = await self.get_task(task_id)
-        if not task:
-            return
+        changed = await self._transition_script(
+            keys=[
+                self._task_key(task_id),
+                self._result_index_key,
+                self._result_sizes_key,
+                self._result_bytes_key,
+                self._result_evicted_key,
+            ],
+            args=[
+                status.value,
+                self._result_ttl,
+                json.dumps(result, ensure_ascii=False) if result is not None else "",
+                error or "",
+                expected.value if expected is not None else "",
+                # Финальный статус будит ожидающих в боте без поллинга
+                self._events_channel if status in TERMINAL_STATUSES else "",
+                task_id,
+                attachment_key or "",
+                attachment_size,
+                int(time.time() * 1000),
+                self._result_budget,
+                self._seq_prefix,
+                *(terminal.value for terminal in TERMINAL_STATUSES),
+            ],
+        )
+        return bool(changed)
+    
+    async def cancel_task(self, task_id: str, include_running: bool = False) -> bool:
+        """
+        Отменяет задачу.
+        
+        Отмена - атомарный переход PENDING -> CANCELLED: если метод вернул
+        True, воркер задачу уже не выполнит, и её можно выполнить другим
+        способом без дублирования.
+        
+        С include_running отменяется и задача, которую воркер уже выполняет
+        (PROCESSING -> CANCELLED). Воркер получает событие отмены, прерывает
+        обработку и не сохраняет результат.
         
-        task.status = status
-        if result is not None:
-            task.result = result
-        if error is not None:
-            task.error = error
+        Args:
+            task_id: ID задачи
+            include_running: Отменять ли уже выполняющуюся задачу
         
-        result_key = f"{self._result_prefix}{task_id}"
-        task_json = task.model_dump_json()
-        await self._redis.setex(
-            result_key,
-            self._result_ttl,
-            task_json
+        Returns:
+            True, если задача отменена; False, если она уже завершена,
+            не найдена или выполняется (без include_running)
+        """
+        if await self.update_task_status(
+            task_id,
+            TaskStatus.CANCELLED,
+            error="Cancelled",
+            expected=TaskStatus.PENDING,
+        ):
+            return True
+        if not include_running:
+            return False
+        return await self.update_task_status(
+            task_id,
+            TaskStatus.CANCELLED,
+            error="Cancelled",
+            expected=TaskStatus.PROCESSING,
+        )
+    
+    async def retry_task(self, task: QueueTask, error: str, delay: float) -> bool:
+        """
+        Возвращает выполняющуюся задачу в очередь для повтора через delay секунд.
+        
+        Задача снова становится PENDING (её можно отменить, пока она ждёт)
+        и попадает в очередь своего типа, когда подойдёт время
+        (promote_delayed_tasks).
+        
+        Args:
+            task: Задача, взятая этим воркером
+            error: Ошибка неудавшейся попытки
+            delay: Задержка перед повтором (секунды)
+        
+        Returns:
+            True, если повтор запланирован; False, если задача уже не
+            выполняется (отменена)
+        """
+        if not await self.update_task_status(
+            task.task_id,
+            TaskStatus.PENDING,
+            error=error,
+            expected=TaskStatus.PROCESSING,
+        ):
+            return False
+        retry = task.model_copy(update={
+            "status": TaskStatus.PENDING,
+            "error": error,
+            "attempt": task.attempt + 1,
+        })
+        await self._redis.zadd(self._delayed_key, {self._encode_task(retry): time.time() + delay})
+        return True
+    
+    async def advance_task(self, task: QueueTask, data: dict[str, Any]) -> bool:
+        """
+        Завершает этап цепочки и ставит в очередь следующий этап той же задачи.
+        
+        Задача сохраняет ID, полосу и deadline, получает тип следующего этапа
+        и новые данные и снова становится PENDING. Ожидающие задачу видят
+        только результат последнего этапа. Квитанция завершённого этапа
+        подтверждается здесь же - повторный ack_task после перехода не нужен.
+        
+        Args:
+            task: Выполняющаяся задача с непустым next_stages
+            data: Данные следующего этапа
+        
+        Returns:
+            True, если следующий этап поставлен; False, если задачу отменили
+        """
+        if self._redis is None:
+            await self.connect()
+        if self._advance_task_script is None:
+            self._advance_task_script = self._redis.register_script(_ADVANCE_TASK_SCRIPT)
+        
+        next_type, *rest = task.next_stages
+        stage = task.model_copy(update={
+            "task_type": next_type,
+            "data": data,
+            "status": TaskStatus.PENDING,
+            "error": None,
+            "attempt": 0,
+            "next_stages": rest,
+        })
+        # Квитанцию этапа забираем до постановки следующего: его может взять
+        # этот же процесс, и квитанции с одним task_id не должны перепутаться
+        receipt = self._inflight.pop(task.task_id, None)
+        # Этап в очереди без перехода хэша (задачу отменили) воркер пропустит
+        async with self._redis.pipeline(transaction=True) as pipe:
+            await self._advance_task_script(
+                keys=[self._task_key(task.task_id), self._seq_key(next_type, "enqueued")],
+                args=[self._result_ttl, next_type.value, json.dumps(data, ensure_ascii=False)],
+                client=pipe,
+            )
+            await self._push_task(pipe, next_type, self._encode_task(stage), task.lane or self._default_lane)
+            advanced, *_ = await pipe.execute()
+        if receipt is not None:
+            await self._ack_receipt(receipt)
+        return bool(advanced)
+    
+    async def publish_progress(self, task_id: str, partial: str) -> bool:
+        """
+        Публикует промежуточный результат выполняющейся задачи.
+        
+        Результат сохраняется в поле partial задачи, а ожидающие с
+        wait_for_task(progress=True) просыпаются. При переходе задачи в
+        другой статус поле удаляется.
+        
+        Args:
+            task_id: ID задачи
+            partial: Промежуточный результат (весь накопленный текст)
+        
+        Returns:
+            True, если результат сохранён; False, если задачу отменили или она завершена
+        """
+        if self._redis is None:
+            await self.connect()
+        if self._progress_script is None:
+            self._progress_script = self._redis.register_script(_PROGRESS_SCRIPT)
+        
+        published = await self._progress_script(
+            keys=[self._task_key(task_id)],
+            args=[partial, self._events_channel, task_id],
+        )
+        return bool(published)
+    
+    async def return_task(self, task: QueueTask) -> bool:
+        """
+        Возвращает взятую этим процессом задачу в очередь, не выполнив её.
+        
+        Используется при остановке воркера: задача снова становится PENDING
+        (попытка не расходуется) и попадает в очередь своего типа, а её
+        квитанция подтверждается. Результат прерываемой попытки после этого
+        не сохранится - воркеры сохраняют его только из PROCESSING.
+        
+        Args:
+            task: Задача, взятая этим воркером
+        
+        Returns:
+            True, если задача возвращена; False, если она уже завершена или отменена
+        """
+        returned = await self.update_task_status(
+            task.task_id,
+            TaskStatus.PENDING,
+            expected=TaskStatus.PROCESSING,
+        )
+        if returned:
+            pending = task.model_copy(update={"status": TaskStatus.PENDING})
+            async with self._redis.pipeline(transaction=True) as pipe:
+                await self._push_task(
+                    pipe,
+                    task.task_type,
+                    self._encode_task(pending),
+                    task.lane or self._default_lane,
+                )
+                await pipe.execute()
+        await self.ack_task(task.task_id)
+        return returned
+    
+    async def promote_delayed_tasks(self, limit: int = 100) -> int:
+        """
+        Переносит в очереди задачи, время повтора которых подошло.
+        
+        Args:
+            limit: Сколько задач переносить за вызов
+        
+        Returns:
+            Количество перенесённых задач
+        """
+        if self._redis is None:
+            await self.connect()
+        
+        payloads = await self._redis.zrangebyscore(self._delayed_key, "-inf", time.time(), start=0, num=limit)
+        promoted = 0
+        for payload in payloads:
+            # Задачу переносит тот воркер, чей ZREM её удалил
+            if not await self._redis.zrem(self._delayed_key, payload):
+                continue
+            try:
+                task = decode_task(payload, QueueTask)
+            except Exception as exc:
+                logger.error(f"Dropping malformed delayed task payload: {exc}")
+                continue
+            try:
+                async with self._redis.pipeline(transaction=True) as pipe:
+                    await self._push_task(pipe, task.task_type, payload, task.lane or self._default_lane)
+                    await pipe.execute()
+            except Exception:
+                # Не удалось положить в очередь - вернём при следующем вызове
+                await self._redis.zadd(self._delayed_key, {payload: time.time()})
+                raise
+            promoted += 1
+        return promoted
+    
+    async def dead_letter_task(self, task: QueueTask, error: str) -> None:
+        """
+        Сохраняет задачу, исчерпавшую повторы, в dead-letter список.
+        
+        Хранятся последние settings.queue_dead_letter_limit задач.
+        
+        Args:
+            task: Задача
+            error: Последняя ошибка
+        """
+        if self._redis is None:
+            await self.connect()
+        entry = json.dumps(
+            {
+                "task": task.model_dump(mode="json"),
+                "error": error,
+                "failed_at": time.time(),
+            },
+            ensure_ascii=False,
+        )
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.lpush(self._dead_letter_key, entry)
+            pipe.ltrim(self._dead_letter_key, 0, settings.queue_dead_letter_limit - 1)
+            await pipe.execute()
+    
+    async def get_dead_letters(self, limit: int | None = 100) -> list[dict[str, Any]]:
+        """
+        Возвращает последние задачи из dead-letter списка.
+        
+        Args:
+            limit: Сколько задач вернуть (None - все)
+        
+        Returns:
+            Записи {"task": задача, "error": ошибка, "failed_at": Unix-время}, новые первыми
+        """
+        if self._redis is None:
+            await self.connect()
+        end = -1 if limit is None else limit - 1
+        entries = await self._redis.lrange(self._dead_letter_key, 0, end)
+        return [json.loads(entry) for entry in entries]
+    
+    async def requeue_dead_letter(self, task_id: str) -> bool:
+        """
+        Ставит задачу из dead-letter списка в очередь заново под тем же ID.
+        
+        Результат получает только тот, кто ждёт задачу по её ID, поэтому
+        задача возвращается, лишь пока её запись жива (ожидающий не освободил
+        её после FAILED) и не прошёл её deadline. Задача получает полный
+        набор попыток, а её запись убирается из списка.
+        
+        Args:
+            task_id: ID задачи в dead-letter списке
+        
+        Returns:
+            True, если задача снова в очереди; False, если её нет в списке
+            или её результат уже некому доставить
+        """
+        if self._redis is None:
+            await self.connect()
+        if self._revive_task_script is None:
+            self._revive_task_script = self._redis.register_script(_REVIVE_TASK_SCRIPT)
+        for entry in await self._redis.lrange(self._dead_letter_key, 0, -1):
+            task = QueueTask.model_validate(json.loads(entry)["task"])
+            if task.task_id != task_id:
+                continue
+            current = await self.get_task(task_id)
+            if current is None or current.status != TaskStatus.FAILED:
+                return False
+            retry = task.model_copy(update={"status": TaskStatus.PENDING, "error": None, "attempt": 0})
+            # Задачу в очереди без перехода хэша (запись освобождена в этот
+            # момент или requeue запущен дважды) воркер пропустит
+            async with self._redis.pipeline(transaction=True) as pipe:
+                await self._revive_task_script(
+                    keys=[self._dead_letter_key, self._task_key(task_id), self._seq_key(task.task_type, "enqueued")],
+                    args=[entry, self._result_ttl, time.time()],
+                    client=pipe,
+                )
+                await self._push_task(pipe, task.task_type, self._encode_task(retry), task.lane or self._default_lane)
+                revived, *_ = await pipe.execute()
+            return bool(revived)
+        return False
+    
+    async def release_task(self, task_id: str) -> bool:
+        """
+        Удаляет запись задачи после того, как её результат доставлен.
+        
+        Вложения результата (изображения) не удаляются - их освобождает
+        отправитель после отправки.
+        
+        Args:
+            task_id: ID задачи
+        
+        Returns:
+            True, если запись удалена этим вызовом (False - её уже не было)
+        """
+        if self._redis is None:
+            await self.connect()
+        if self._release_script is None:
+            self._release_script = self._redis.register_script(_RELEASE_SCRIPT)
+        deleted = await self._release_script(
+            keys=[
+                self._task_key(task_id),
+                self._result_index_key,
+                self._result_sizes_key,
+                self._result_bytes_key,
+            ],
+            args=[task_id],
         )
+        return bool(deleted)
+    
+    async def get_result_stats(self) -> dict[str, int]:
+        """
+        Возвращает метрики памяти, занятой недоставленными результатами.
+        
+        Returns:
+            Словарь: bytes (учтённый объём), count (число результатов),
+            budget (лимит, 0 - без лимита), evicted (всего вытеснено результатов)
+        """
+        if self._redis is None:
+            await self.connect()
+        async with self._redis.pipeline(transaction=False) as pipe:
+            pipe.get(self._result_bytes_key)
+            pipe.zcard(self._result_index_key)
+            pipe.get(self._result_evicted_key)
+            result_bytes, count, evicted = await pipe.execute()
+        return {
+            "bytes": int(result_bytes or 0),
+            "count": int(count or 0),
+            "budget": self._result_budget,
+            "evicted": int(evicted or 0),
+        }
+    
+    async def wait_for_task(
+        self,
+        task_id: str,
+        timeout: float,
+        progress: bool = False,
+        created: bool = False,
+    ) -> QueueTask | None:
+        """
+        Ожидает перехода задачи в финальный статус (COMPLETED/FAILED/CANCELLED).
+        
+        Вместо периодического опроса подписывается на канал событий,
+        в который воркер публикует ID завершённых задач.
+        
+        Args:
+            task_id: ID задачи
+            timeout: Таймаут ожидания (секунды)
+            progress: Вернуться и при публикации промежуточного результата
+                (см. publish_progress)
+            created: Ждать только появления задачи: вернуться, как только она
+                поставлена с ключом идемпотентности (или по notify_task)
+        
+        Returns:
+            Задача в текущем состоянии (после таймаута может быть не финальной)
+            или None, если задача не найдена
+        """
+        if self._redis is None:
+            await self.connect()
+        
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        
+        while True:
+            future: asyncio.Future[None] = loop.create_future()
+            self._waiters.setdefault(task_id, []).append(future)
+            try:
+                await self._ensure_listener()
+                # Проверяем статус уже после подписки, чтобы не пропустить событие
+                task = await self.get_task(task_id)
+                if created:
+                    if task is not None:
+                        return task
+                elif task is None or task.status in TERMINAL_STATUSES:
+                    return task
+                
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    return task
+                try:
+                    await asyncio.wait_for(future, timeout=remaining)
+                except asyncio.TimeoutError:
+                    return await self.get_task(task_id)
+                if progress or created:
+                    # Событие о промежуточном результате, о постановке или о завершении
+                    return await self.get_task(task_id)
+            finally:
+                self._discard_waiter(task_id, future)
+    
+    async def notify_task(self, task_id: str) -> None:
+        """Будит ожидающих задачи task_id во всех процессах: они перепроверят её состояние."""
+        if self._redis is None:
+            await self.connect()
+        await self._redis.publish(self._events_channel, task_id)
+    
+    def _discard_waiter(self, task_id: str, future: asyncio.Future[None]) -> None:
+        """Удаляет future ожидающего из реестра."""
+        futures = self._waiters.get(task_id)
+        if not futures:
+            return
+        if future in futures:
+            futures.remove(future)
+        if not futures:
+            self._waiters.pop(task_id, None)
+    
+    def _wake_waiters(self, task_id: str | None = None) -> None:
+        """Будит ожидающих задачи task_id (или всех, если task_id не указан)."""
+        if task_id is None:
+            groups = list(self._waiters.values())
+        else:
+            groups = [self._waiters.get(task_id, [])]
+        for futures in groups:
+            for future in futures:
+                if not future.done():
+                    future.set_result(None)
+    
+    async def _ensure_listener(self) -> None:
+        """Запускает (один на процесс) слушатель канала событий о завершении задач."""
+        if self._listener is not None and not self._listener.done():
+            return
+        async with self._listener_lock:
+            if self._listener is not None and not self._listener.done():
+                return
+            if self._pubsub is not None:
+                try:
+                    await self._pubsub.aclose()
+                except Exception:
+                    pass
+            self._pubsub = self._redis.pubsub()
+            await self._pubsub.subscribe(self._events_channel)
+            self._listener = asyncio.create_task(self._listen_events())
+    
+    async def _listen_events(self) -> None:
+        """Читает канал событий и будит ожидающих соответствующих задач."""
+        try:
+            async for message in self._pubsub.listen():
+                if message.get("type") != "message":
+                    continue
+                self._wake_waiters(message.get("data"))
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            logger.warning(f"Task events listener stopped: {exc}")
+        finally:
+            # Без слушателя ожидающие не узнают о завершении: будим всех,
+            # они перепроверят статус и переподпишутся
+            self._wake_waiters()
+    
+    async def _stop_listener(self) -> None:
+        """Останавливает слушатель канала событий."""
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._listener = None
+        if self._pubsub is not None:
+            try:
+                await self._pubsub.aclose()
+            except Exception:
+                pass
+            self._pubsub = None
+    
+    @property
+    def is_reliable(self) -> bool:
+        """Требует ли бэкенд ack_task/heartbeat для взятых в работу задач."""
+        return self._reliable
     
     async def dequeue_task(self, task_type: TaskType, timeout: int = 0) -> QueueTask | None:
         """
@@ -174,42 +1229,452 @@ class QueueService:
         
         Args:
             task_type: Тип задачи
-            timeout: Таймаут в секундах (0 = бесконечно)
+            timeout: Таймаут в секундах (0 = неблокирующий вызов)
         
         Returns:
             Задача или None
         """
+        tasks = await self.dequeue_tasks([task_type], timeout=timeout)
+        return tasks[0] if tasks else None
+    
+    async def dequeue_tasks(self, task_types: list[TaskType], timeout: float = 0) -> list[QueueTask]:
+        """
+        Ждёт задачи сразу из нескольких очередей (одно блокирующее ожидание).
+        
+        Возвращает не больше одной задачи каждого типа, поэтому воркер может
+        передавать сюда только типы, для которых у него есть свободный слот.
+        
+        В надёжном режиме (settings.queue_reliable) задача атомарно
+        перекладывается в список обработки этого воркера и остаётся там до
+        ack_task. Если воркер упадёт, задача вернётся в очередь после истечения
+        visibility timeout (см. heartbeat и requeue_expired).
+        
+        Ожидание можно прервать раньше таймаута вызовом interrupt_wait
+        (например, когда у воркера освободился слот для другого типа).
+        
+        Args:
+            task_types: Типы задач
+            timeout: Таймаут в секундах (0 = неблокирующий вызов)
+        
+        Returns:
+            Список задач (пустой, если задач нет или ожидание прервано)
+        """
+        if not task_types:
+            return []
         if self._redis is None:
             await self.connect()
         
-        queue_name = f"{self._queue_prefix}{task_type.value}"
+        if self.is_reliable and not self._consumer_registered:
+            await self.heartbeat()
         
-        # Используем блокирующий pop
-        if timeout > 0:
-            result = await self._redis.brpop(queue_name, timeout=timeout)
-            if result is None:
-                return None
-            _, task_json = result
-        else:
-            task_json = await self._redis.rpop(queue_name)
-            if task_json is None:
-                return None
+        self._rotation = (self._rotation + 1) % len(task_types)
+        ordered = task_types[self._rotation:] + task_types[:self._rotation]
         
+        tasks = []
+        for payload, receipt in await self._pop_tasks(ordered, timeout):
+            task = await self._accept_task(payload, receipt)
+            if task is not None:
+                tasks.append(task)
+        return tasks
+    
+    async def _accept_task(self, payload: str, receipt: Any) -> QueueTask | None:
+        """Разбирает извлечённую задачу и переводит её в PROCESSING."""
         try:
-            task_dict = json.loads(task_json)
-            task = QueueTask(**task_dict)
-            task.status = TaskStatus.PROCESSING
-            await self.update_task_status(task.task_id, TaskStatus.PROCESSING)
-            return task
-        except Exception:
+            task = decode_task(payload, QueueTask)
+        except Exception as exc:
+            logger.error(f"Dropping malformed task payload: {exc}")
+            if receipt is not None:
+                await self._ack_receipt(receipt)
+            return None
+        return await self._claim_task(task, receipt)
+    
+    async def _claim_task(self, task: QueueTask, receipt: Any) -> QueueTask | None:
+        """Переводит извлечённую задачу в PROCESSING, если её ещё нужно выполнять."""
+        if task.deadline is not None and time.time() >= task.deadline:
+            # Результат уже никто не ждёт
+            logger.info(f"Skipping task {task.task_id}: deadline exceeded")
+            await self.update_task_status(task.task_id, TaskStatus.CANCELLED, error="Deadline exceeded")
+            if receipt is not None:
+                await self._ack_receipt(receipt)
+            return None
+        
+        # Переход в PROCESSING не удаётся, если задачу отменили или её запись
+        # удалена (бот перестал ждать) - такую задачу не выполняем
+        if not await self.update_task_status(task.task_id, TaskStatus.PROCESSING):
+            current = await self.get_task(task.task_id)
+            # Запись старого формата (до хэшей) статус не меняет, но задача жива
+            if current is None or current.status in TERMINAL_STATUSES:
+                logger.info(f"Skipping task {task.task_id}: cancelled or expired")
+                if receipt is not None:
+                    await self._ack_receipt(receipt)
+                return None
+        
+        if receipt is not None:
+            self._inflight[task.task_id] = receipt
+        task.status = TaskStatus.PROCESSING
+        return task
+    
+    async def ack_task(self, task_id: str) -> None:
+        """
+        Подтверждает завершение обработки задачи и убирает её из списка обработки.
+        
+        Вызывается воркером после финального статуса (COMPLETED/FAILED/CANCELLED).
+        В ненадёжном режиме ничего не делает.
+        
+        Args:
+            task_id: ID задачи
+        """
+        receipt = self._inflight.pop(task_id, None)
+        if receipt is None:
+            return
+        if self._redis is None:
+            await self.connect()
+        await self._ack_receipt(receipt)
+    
+    def _encode_task(self, task: QueueTask) -> str:
+        """Упаковывает задачу в payload очереди кодеком из настроек."""
+        return encode_task(task, self._codec, self._compress_threshold)
+    
+    def _task_key(self, task_id: str) -> str:
+        return f"{self._result_prefix}{task_id}"
+    
+    def _seq_key(self, task_type: TaskType, counter: str) -> str:
+        return f"{self._seq_prefix}{task_type.value}:{counter}"
+    
+    def _service_times_key(self, task_type: TaskType) -> str:
+        return f"{self._queue_prefix}service_times:{task_type.value}"
+    
+    def _queue_key(self, task_type: TaskType, lane: str | None = None) -> str:
+        # Полоса по умолчанию живёт в прежнем ключе очереди
+        if lane is None or lane == self._default_lane:
+            return f"{self._queue_prefix}{task_type.value}"
+        return f"{self._queue_prefix}{task_type.value}:{lane}"
+    
+    def _wakeup_key(self, task_type: TaskType) -> str:
+        return f"{self._queue_prefix}wakeup:{task_type.value}"
+    
+    async def _push_task(self, pipe: Any, task_type: TaskType, payload: str, lane: str) -> None:
+        """Добавляет в pipeline команды, кладущие задачу в очередь своего типа и полосы."""
+        pipe.lpush(self._queue_key(task_type, lane), payload)
+        if self._reliable:
+            # Сигнал для воркеров, ждущих задачи этого типа (см. _pop_tasks)
+            wakeup_key = self._wakeup_key(task_type)
+            pipe.lpush(wakeup_key, "1")
+            pipe.ltrim(wakeup_key, 0, _WAKEUP_LIST_LIMIT - 1)
+    
+    async def interrupt_wait(self) -> None:
+        """Прерывает текущее (или ближайшее) ожидание dequeue_tasks этого процесса."""
+        if self._redis is None:
+            await self.connect()
+        async with self._redis.pipeline(transaction=False) as pipe:
+            pipe.lpush(self._interrupt_key, "1")
+            pipe.ltrim(self._interrupt_key, 0, 0)
+            pipe.expire(self._interrupt_key, self._visibility_timeout)
+            await pipe.execute()
+    
+    async def _pop_tasks(self, task_types: list[TaskType], timeout: float) -> list[tuple[str, Any]]:
+        """
+        Забирает сериализованную задачу из первой непустой очереди.
+        
+        Очереди опрашиваются по полосам в порядке LaneScheduler, внутри полосы -
+        в порядке task_types.
+        
+        Returns:
+            Список пар (payload, квитанция для ack); квитанция None - ack не нужен
+        """
+        lanes = self._lanes.order()
+        queue_lanes = {
+            self._queue_key(task_type, lane): lane
+            for lane in lanes
+            for task_type in task_types
+        }
+        queue_names = list(queue_lanes)
+        
+        if not self._reliable:
+            # Используем блокирующий pop сразу по всем очередям
+            if timeout > 0:
+                result = await self._redis.brpop([*queue_names, self._interrupt_key], timeout=timeout)
+                if result is None:
+                    return []
+                queue_name, payload = result
+                if queue_name == self._interrupt_key:
+                    return []
+                self._lanes.served(queue_lanes[queue_name])
+                return [(payload, None)]
+            for queue_name in queue_names:
+                payload = await self._redis.rpop(queue_name)
+                if payload is not None:
+                    self._lanes.served(queue_lanes[queue_name])
+                    return [(payload, None)]
+            return []
+        
+        # BLMOVE умеет ждать только одну очередь, поэтому забираем задачу
+        # скриптом, а ждём сигналов пробуждения сразу всех нужных типов
+        if self._pop_any_script is None:
+            self._pop_any_script = self._redis.register_script(_POP_ANY_SCRIPT)
+        wakeup_keys = [self._wakeup_key(task_type) for task_type in task_types]
+        wakeup_keys.append(self._interrupt_key)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            popped = await self._pop_any_script(keys=[self._processing_key, *queue_names])
+            if popped:
+                index, payload = popped
+                self._lanes.served(queue_lanes[queue_names[int(index)]])
+                return [(payload, payload)]
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return []
+            # timeout=0 у BRPOP означает "ждать бесконечно", поэтому не меньше 10 мс
+            woke = await self._redis.brpop(wakeup_keys, timeout=max(remaining, 0.01))
+            if woke is None or woke[0] == self._interrupt_key:
+                return []
+    
+    async def _ack_receipt(self, receipt: Any) -> None:
+        """Убирает задачу из списка обработки воркера."""
+        await self._redis.lrem(self._processing_key, 1, receipt)
+    
+    async def heartbeat(self) -> None:
+        """
+        Продлевает аренду задач этого воркера на visibility timeout.
+        
+        Воркер должен вызывать метод чаще, чем раз в queue_visibility_timeout,
+        иначе его задачи будут возвращены в очередь другим воркером.
+        Заодно обновляет запись воркера в реестре (см. get_workers).
+        """
+        if self._redis is None:
+            await self.connect()
+        # В значении ключа - состояние воркера (по нему бот оценивает очередь
+        # и не ставит задачи, которые некому выполнить)
+        value = self._worker_info().model_dump_json() if self._capacity else "1"
+        # MULTI: иначе между SADD и SET успеет отработать чистка реестра
+        # (_prune_consumers) и уберёт воркер, у которого ещё нет heartbeat
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.sadd(self._consumers_key, self.consumer_id)
+            pipe.set(self._heartbeat_key, value, ex=self._visibility_timeout)
+            await pipe.execute()
+        self._consumer_registered = True
+    
+    async def unregister(self) -> None:
+        """
+        Убирает воркер из реестра при остановке, не дожидаясь истечения heartbeat.
+        
+        Задачи, оставшиеся в списке обработки, другие воркеры вернут в очередь
+        (requeue_expired), как после падения: до этого воркер остаётся в
+        множестве реестра.
+        """
+        self._capacity = {}
+        if self._redis is None:
+            await self.connect()
+        await self._redis.delete(self._heartbeat_key)
+        await self._prune_consumers([self.consumer_id])
+    
+    async def _prune_consumers(self, consumers: list[str]) -> int:
+        """Убирает из реестра воркеры без heartbeat и без задач в обработке."""
+        if self._prune_consumers_script is None:
+            self._prune_consumers_script = self._redis.register_script(_PRUNE_CONSUMERS_SCRIPT)
+        removed = await self._prune_consumers_script(
+            keys=[self._consumers_key],
+            args=[self._queue_prefix, *consumers],
+        )
+        return int(removed or 0)
+    
+    def set_capacity(self, capacity: dict[TaskType, int]) -> None:
+        """
+        Задаёт число слотов этого воркера по типам задач.
+        
+        Публикуется со следующим heartbeat и учитывается при оценке
+        времени ожидания (см. get_load).
+        """
+        self._capacity = {task_type.value: slots for task_type, slots in capacity.items()}
+    
+    def set_worker_state(self, load: dict[TaskType, int], healthy: dict[TaskType, bool]) -> None:
+        """
+        Задаёт текущую загрузку воркера и здоровье провайдеров по типам задач.
+        
+        Публикуется со следующим heartbeat. Слоты типа с нездоровым
+        провайдером не учитываются в ёмкости очереди (см. get_load).
+        
+        Args:
+            load: Выполняющихся задач по типам
+            healthy: Отвечает ли провайдер задач этого типа
+        """
+        self._load = {task_type.value: count for task_type, count in load.items()}
+        self._healthy = {task_type.value: ok for task_type, ok in healthy.items()}
+    
+    def _worker_info(self) -> WorkerInfo:
+        """Собирает запись этого воркера для реестра."""
+        return WorkerInfo(
+            worker_id=self.consumer_id,
+            capacity=self._capacity,
+            load=self._load,
+            healthy=self._healthy,
+            host=socket.gethostname(),
+            pid=os.getpid(),
+            started_at=self._started_at,
+            updated_at=time.time(),
+        )
+    
+    async def get_workers(self) -> list[WorkerInfo]:
+        """
+        Возвращает живые воркеры (heartbeat не старше visibility timeout).
+        
+        Returns:
+            Записи воркеров; воркеры старых версий, не сообщающие слоты,
+            возвращаются с пустым capacity
+        """
+        if self._redis is None:
+            await self.connect()
+        consumers = list(await self._redis.smembers(self._consumers_key))
+        if not consumers:
+            return []
+        values = await self._redis.mget(
+            [f"{self._queue_prefix}consumer:{consumer}" for consumer in consumers]
+        )
+        workers = []
+        expired = []
+        for consumer, value in zip(consumers, values):
+            if not value:
+                expired.append(consumer)
+                continue
+            try:
+                if not value.startswith("{"):
+                    workers.append(WorkerInfo(worker_id=consumer))
+                    continue
+                fields = json.loads(value)
+                if "worker_id" not in fields:
+                    # Прежний формат heartbeat: только слоты по типам
+                    fields = {"worker_id": consumer, "capacity": fields}
+                workers.append(WorkerInfo.model_validate(fields))
+            except Exception as exc:
+                logger.warning(f"Ignoring malformed heartbeat of worker {consumer}: {exc}")
+        if expired:
+            # Иначе множество растёт с каждым перезапуском воркеров
+            await self._prune_consumers(expired)
+        return workers
+    
+    async def get_capacity(self, task_type: TaskType) -> int | None:
+        """
+        Возвращает число слотов живых воркеров со здоровым провайдером для типа задач.
+        
+        Returns:
+            Число слотов (0 - выполнить задачу некому) или None, если
+            воркеры не сообщают слоты
+        """
+        return self._sum_capacity(await self.get_workers(), task_type)
+    
+    @staticmethod
+    def _sum_capacity(workers: list[WorkerInfo], task_type: TaskType) -> int | None:
+        """Суммирует слоты воркеров, здоровых для task_type (None - слоты не сообщаются)."""
+        reporting = [worker for worker in workers if worker.capacity]
+        if not reporting:
             return None
+        return sum(
+            worker.capacity.get(task_type.value, 0)
+            for worker in reporting
+            if worker.is_healthy(task_type)
+        )
     
-    async def get_queue_length(self, task_type: TaskType) -> int:
+    async def record_service_time(self, task_type: TaskType, seconds: float) -> None:
+        """Запоминает время обработки задачи (хранятся последние _SERVICE_TIME_SAMPLES)."""
+        if self._redis is None:
+            await self.connect()
+        key = self._service_times_key(task_type)
+        async with self._redis.pipeline(transaction=False) as pipe:
+            pipe.lpush(key, round(seconds, 3))
+            pipe.ltrim(key, 0, _SERVICE_TIME_SAMPLES - 1)
+            await pipe.execute()
+    
+    async def get_load(self, task_type: TaskType) -> dict[str, Any]:
+        """
+        Возвращает текущую нагрузку на очередь типа задач.
+        
+        Args:
+            task_type: Тип задачи
+        
+        Returns:
+            Словарь: depth (задач ждёт в очереди), capacity (слотов у живых
+            воркеров со здоровым провайдером; None - воркеры не сообщают слоты),
+            free (из них свободных), service_time (медиана последних времён
+            обработки в секундах; None - нет данных)
+        """
+        if self._redis is None:
+            await self.connect()
+        
+        depth = await self.get_queue_length(task_type)
+        workers = await self.get_workers()
+        samples = sorted(float(sample) for sample in await self._redis.lrange(
+            self._service_times_key(task_type), 0, -1
+        ))
+        return self._summarize_load(task_type, depth, workers, samples)
+    
+    def _summarize_load(
+        self,
+        task_type: TaskType,
+        depth: int,
+        workers: list[WorkerInfo],
+        samples: list[float],
+    ) -> dict[str, Any]:
+        """Собирает результат get_load из глубины очереди, реестра и времён обработки."""
+        capacity = self._sum_capacity(workers, task_type)
+        free = None
+        if capacity is not None:
+            free = sum(worker.free_slots(task_type) for worker in workers if worker.is_healthy(task_type))
+        service_time = samples[len(samples) // 2] if samples else None
+        return {"depth": depth, "capacity": capacity, "free": free, "service_time": service_time}
+    
+    async def get_task_position(self, task_id: str) -> tuple[TaskStatus | None, TaskType | None, int]:
+        """
+        Возвращает статус задачи, тип, под которым она сейчас в очереди, и
+        примерное число задач перед ней.
+        
+        Позиция считается по номеру задачи и счётчику начатых задач её типа,
+        поэтому приоритетные полосы и возвращённые в очередь задачи делают
+        её приблизительной. У цепочки тип - тип текущего этапа.
+        
+        Args:
+            task_id: ID задачи
+        
+        Returns:
+            (статус или None, если задача не найдена; тип текущего этапа; задач впереди)
+        """
+        if self._redis is None:
+            await self.connect()
+        status, task_type, ticket = await self._redis.hmget(
+            self._task_key(task_id), ["status", "task_type", "ticket"]
+        )
+        if status is None:
+            return None, None, 0
+        stage = TaskType(task_type) if task_type else None
+        if status != TaskStatus.PENDING.value or not ticket or stage is None:
+            return TaskStatus(status), stage, 0
+        started = await self._redis.get(self._seq_key(stage, "started"))
+        return TaskStatus.PENDING, stage, max(0, int(ticket) - int(started or 0) - 1)
+    
+    async def requeue_expired(self) -> int:
+        """
+        Возвращает в очереди задачи воркеров, переставших присылать heartbeat.
+        
+        Returns:
+            Количество возвращённых задач
+        """
+        if self._redis is None:
+            await self.connect()
+        if self._requeue_expired_script is None:
+            self._requeue_expired_script = self._redis.register_script(_REQUEUE_EXPIRED_SCRIPT)
+        requeued = await self._requeue_expired_script(
+            keys=[self._consumers_key],
+            args=[self._queue_prefix, self._default_lane],
+        )
+        return int(requeued or 0)
+    
+    async def get_queue_length(self, task_type: TaskType, lane: str | None = None) -> int:
         """
         Возвращает длину очереди.
         
         Args:
             task_type: Тип задачи
+            lane: Полоса приоритета (None - сумма по всем полосам)
         
         Returns:
             Количество задач в очереди
@@ -217,8 +1682,12 @@ class QueueService:
         if self._redis is None:
             await self.connect()
         
-        queue_name = f"{self._queue_prefix}{task_type.value}"
-        return await self._redis.llen(queue_name)
+        if lane is not None:
+            return await self._redis.llen(self._queue_key(task_type, lane))
+        total = 0
+        for name in self._lane_weights:
+            total += await self._redis.llen(self._queue_key(task_type, name))
+        return total
     
     async def clear_queue(self, task_type: TaskType) -> None:
         """
@@ -230,10 +1699,42 @@ class QueueService:
         if self._redis is None:
             await self.connect()
         
-        queue_name = f"{self._queue_prefix}{task_type.value}"
-        await self._redis.delete(queue_name)
+        await self._redis.delete(
+            *(self._queue_key(task_type, lane) for lane in self._lane_weights),
+            self._wakeup_key(task_type),
+        )
+        await self._clear_delayed(task_type)
+        await self._reset_positions(task_type)
+    
+    async def _clear_delayed(self, task_type: TaskType) -> None:
+        """Удаляет ожидающие повтора задачи типа task_type."""
+        for payload in await self._redis.zrange(self._delayed_key, 0, -1):
+            try:
+                task = decode_task(payload, QueueTask)
+            except Exception:
+                continue
+            if task.task_type == task_type:
+                await self._redis.zrem(self._delayed_key, payload)
+    
+    async def _reset_positions(self, task_type: TaskType) -> None:
+        """Считает все поставленные задачи типа начатыми (после очистки очереди)."""
+        enqueued = await self._redis.get(self._seq_key(task_type, "enqueued"))
+        await self._redis.set(self._seq_key(task_type, "started"), int(enqueued or 0))
+
+
+def create_queue_service() -> QueueService:
+    """Создаёт сервис очередей с бэкендом, выбранным в settings.queue_backend."""
+    if settings.queue_backend == "stream":
+        from app.services.stream_queue_service import RedisStreamQueueService
+        return RedisStreamQueueService()
+    if settings.queue_backend == "memory":
+        from app.services.memory_queue_service import MemoryQueueService
+        return MemoryQueueService()
+    if settings.queue_backend != "list":
+        raise ValueError(f"Unknown queue backend: {settings.queue_backend}")
+    return QueueService()
 
 
 # Глобальный экземпляр сервиса
-queue_service = QueueService()
+queue_service = create_queue_service()
 
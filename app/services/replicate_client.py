@@ -8,6 +8,7 @@ import replicate
 from PIL import Image
 
 from app.config import settings
+from app.services.http_pool import get_http_client, get_http_transport
 
 # Импортируем settings для доступа к параметрам по умолчанию
 
@@ -22,16 +23,58 @@ class ReplicateImageClient:
         if not settings.replicate_api_token:
             raise ValueError("REPLICATE_API_TOKEN не установлен в настройках")
         
-        # Создаем клиент Replicate с токеном
-        self._replicate_client = replicate.Client(api_token=settings.replicate_api_token)
+        # Создаем клиент Replicate с токеном; соединения к API берутся из общего пула процесса
+        self._replicate_client = replicate.Client(
+            api_token=settings.replicate_api_token,
+            transport=get_http_transport("replicate"),
+        )
         self._model = settings.replicate_model
-        self._http_client: httpx.AsyncClient | None = None
 
     async def _get_http_client(self) -> httpx.AsyncClient:
-        """Получает или создает HTTP клиент для загрузки изображений."""
-        if self._http_client is None:
-            self._http_client = httpx.AsyncClient(timeout=60.0)
-        return self._http_client
+        """Возвращает общий HTTP клиент для загрузки изображений."""
+        return get_http_client("replicate_delivery", timeout=60.0)
+
+    async def _run_prediction(self, input_params: dict[str, any]) -> any:
+        """
+        Запускает prediction на Replicate и ждёт его результата.
+        
+        Если ожидание прервано (задачу отменили или истёк её deadline),
+        prediction отменяется и на стороне Replicate, чтобы он не занимал GPU.
+        
+        Args:
+            input_params: Входные параметры модели
+        
+        Returns:
+            Выход модели
+        
+        Raises:
+            ValueError: Prediction завершился ошибкой или был отменён
+        """
+        predictions = self._replicate_client.predictions
+        if ":" in self._model:
+            # owner/name:version
+            version_id = self._model.split(":", 1)[1]
+            prediction = await predictions.async_create(version=version_id, input=input_params)
+        else:
+            owner, name = self._model.split("/", 1)
+            prediction = await self._replicate_client.models.predictions.async_create(
+                model=(owner, name),
+                input=input_params,
+            )
+        
+        try:
+            await prediction.async_wait()
+        except asyncio.CancelledError:
+            logger.info(f"Отменяем prediction {prediction.id} на Replicate")
+            try:
+                await prediction.async_cancel()
+            except Exception as exc:
+                logger.warning(f"Не удалось отменить prediction {prediction.id}: {exc}")
+            raise
+        
+        if prediction.status != "succeeded":
+            raise ValueError(f"Prediction на Replicate завершился со статусом {prediction.status}: {prediction.error}")
+        return prediction.output
 
     async def generate_image(
         self,
@@ -137,12 +180,7 @@ class ReplicateImageClient:
         logger.debug(f"Параметры: {input_params}")
         
         try:
-            # Запускаем генерацию в отдельном потоке (Replicate синхронный)
-            loop = asyncio.get_event_loop()
-            output = await loop.run_in_executor(
-                None,
-                lambda: self._replicate_client.run(self._model, input=input_params)
-            )
+            output = await self._run_prediction(input_params)
             
             logger.info(f"Replicate вернул результат: {type(output)}")
             logger.debug(f"Replicate результат repr: {repr(output)}")
@@ -340,8 +378,5 @@ class ReplicateImageClient:
             raise ValueError(f"Ошибка генерации изображения через Replicate: {e}")
 
     async def close(self) -> None:
-        """Закрывает HTTP клиент."""
-        if self._http_client:
-            await self._http_client.aclose()
-            self._http_client = None
+        """Ничего не делает: соединения общего пула закрывает close_http_clients."""
 
@@ -0,0 +1,195 @@
+import asyncio
+import random
+import time
+
+import httpx
+import redis.exceptions
+from pydantic import BaseModel
+
+from app.config import settings
+from app.services.queue_service import TaskType
+
+# HTTP-статусы, после которых запрос имеет смысл повторить
+_TRANSIENT_STATUS_CODES = frozenset({408, 425, 429, 500, 502, 503, 504})
+
+# Ошибки сети и таймауты: провайдер не ответил, но может ответить позже
+_TRANSIENT_ERRORS = (
+    httpx.TransportError,
+    asyncio.TimeoutError,
+    TimeoutError,
+    ConnectionError,
+    redis.exceptions.ConnectionError,
+    redis.exceptions.TimeoutError,
+)
+
+# Сколько звеньев цепочки исключений просматривать (клиенты оборачивают
+# исходную ошибку в ValueError)
+_MAX_CHAIN_DEPTH = 10
+
+
+class RetryPolicy(BaseModel):
+    """Политика повторов задач одного типа."""
+    max_attempts: int  # Всего попыток, включая первую
+    base_delay: float  # Задержка перед первым повтором (секунды)
+    max_delay: float  # Потолок задержки (секунды)
+
+    def backoff(self, attempt: int, retry_after: float | None = None) -> float:
+        """
+        Возвращает задержку перед следующей попыткой.
+
+        Экспоненциальная задержка со случайной половиной ("equal jitter"):
+        повторы задач, упавших одновременно, расходятся во времени и не
+        бьют в провайдера одной волной.
+
+        Args:
+            attempt: Номер неудавшейся попытки (0 - первая)
+            retry_after: Сколько просил подождать провайдер (Retry-After)
+
+        Returns:
+            Задержка в секундах
+        """
+        ceiling = min(self.max_delay, self.base_delay * 2 ** attempt)
+        delay = random.uniform(ceiling / 2, ceiling)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+        return delay
+
+
+# Задержки по типам: фото генерируется долго и провайдер восстанавливается
+# дольше, ответ пользователь ждёт не больше минуты
+_DEFAULT_DELAYS = {
+    TaskType.GENERATE_IMAGE: (5.0, 60.0),
+    TaskType.GENERATE_REPLY: (1.0, 10.0),
+    TaskType.GENERATE_IMAGE_PROMPT: (1.0, 10.0),
+}
+
+
+def parse_retry_attempts(raw: str) -> dict[TaskType, int]:
+    """
+    Разбирает число попыток по типам задач из строки вида "generate_image:3,generate_reply:2".
+
+    Типы, не указанные в строке, выполняются один раз (без повторов).
+    """
+    attempts = {task_type: 1 for task_type in TaskType}
+    for item in raw.split(","):
+        if not item.strip():
+            continue
+        name, _, value = item.partition(":")
+        attempts[TaskType(name.strip())] = max(1, int(value or 1))
+    return attempts
+
+
+_RETRY_ATTEMPTS = parse_retry_attempts(settings.queue_retry_attempts)
+
+
+def get_retry_policy(task_type: TaskType) -> RetryPolicy:
+    """Возвращает политику повторов для типа задач."""
+    base_delay, max_delay = _DEFAULT_DELAYS[task_type]
+    return RetryPolicy(
+        max_attempts=_RETRY_ATTEMPTS[task_type],
+        base_delay=base_delay,
+        max_delay=max_delay,
+    )
+
+
+def _exception_chain(exc: BaseException) -> list[BaseException]:
+    """Возвращает исключение и его причины (__cause__/__context__)."""
+    chain: list[BaseException] = []
+    current: BaseException | None = exc
+    while current is not None and current not in chain and len(chain) < _MAX_CHAIN_DEPTH:
+        chain.append(current)
+        current = current.__cause__ or current.__context__
+    return chain
+
+
+def is_transient_error(exc: BaseException) -> bool:
+    """
+    Проверяет, временная ли ошибка (таймаут, сбой сети, 429/5xx).
+
+    Остальные ошибки (неверные данные задачи, 4xx, отказ модели) считаются
+    постоянными: повтор дал бы тот же результат.
+    """
+    for error in _exception_chain(exc):
+        if isinstance(error, httpx.HTTPStatusError):
+            return error.response.status_code in _TRANSIENT_STATUS_CODES
+        if isinstance(error, _TRANSIENT_ERRORS):
+            return True
+        # ReplicateError и подобные ошибки API хранят HTTP-статус в status
+        status = getattr(error, "status", None)
+        if isinstance(status, int):
+            return status in _TRANSIENT_STATUS_CODES
+    return False
+
+
+def get_retry_after(exc: BaseException) -> float | None:
+    """Возвращает Retry-After (секунды) из HTTP-ответа в цепочке исключений."""
+    for error in _exception_chain(exc):
+        if isinstance(error, httpx.HTTPStatusError):
+            value = error.response.headers.get("Retry-After")
+            try:
+                return float(value) if value else None
+            except ValueError:
+                # HTTP-дата вместо секунд - обходимся своей задержкой
+                return None
+    return None
+
+
+class RetryBudget:
+    """
+    Ограничивает число повторов долей от первых попыток.
+
+    Каждая первая попытка задачи пополняет бюджет на ratio, каждый повтор
+    тратит единицу. Пока провайдер отвечает, бюджета хватает на редкие
+    сбои; при массовом сбое повторов не больше ratio от входящего потока,
+    и они не умножают нагрузку на упавшего провайдера.
+    """
+
+    def __init__(self, ratio: float, reserve: float = 10.0) -> None:
+        self._ratio = ratio
+        # Запас на повторы сразу после старта и при малом потоке задач
+        self._reserve = reserve
+        self._balance = reserve
+
+    def deposit(self) -> None:
+        """Учитывает первую попытку задачи."""
+        self._balance = min(self._reserve, self._balance + self._ratio)
+
+    def try_withdraw(self) -> bool:
+        """Тратит единицу бюджета на повтор; False, если бюджет исчерпан."""
+        if self._balance < 1:
+            return False
+        self._balance -= 1
+        return True
+
+
+class ProviderHealth:
+    """
+    Здоровье провайдера по временным ошибкам подряд.
+
+    После threshold временных ошибок подряд провайдер считается нездоровым
+    на cooldown секунд: воркер сообщает это в реестре, и бот не ставит
+    задачи, которые некому выполнить. После cooldown провайдер снова
+    считается здоровым до первой ошибки - так проверяется, восстановился ли он.
+    """
+
+    def __init__(self, threshold: int, cooldown: float) -> None:
+        self._threshold = threshold
+        self._cooldown = cooldown
+        self._failures = 0
+        self._failed_at = 0.0
+
+    @property
+    def healthy(self) -> bool:
+        """Можно ли сейчас отправлять задачи провайдеру."""
+        if self._failures < self._threshold:
+            return True
+        return time.monotonic() - self._failed_at >= self._cooldown
+
+    def record_success(self) -> None:
+        """Учитывает успешный ответ провайдера."""
+        self._failures = 0
+
+    def record_failure(self) -> None:
+        """Учитывает временную ошибку провайдера (сеть, таймаут, 429/5xx)."""
+        self._failures += 1
+        self._failed_at = time.monotonic()
@@ -0,0 +1,281 @@
+import logging
+from typing import Any
+
+import redis.asyncio as redis
+
+from app.config import settings
+from app.services.queue_service import QueueService, TaskType
+
+logger = logging.getLogger(__name__)
+
+
+class RedisStreamQueueService(QueueService):
+    """
+    Бэкенд очередей на Redis Streams с группой потребителей.
+
+    Каждый тип задач - отдельный stream, все воркеры читают его через общую
+    группу (settings.queue_stream_group). Взятые задачи числятся в PEL группы
+    до ack_task, поэтому бэкенд всегда работает в надёжном режиме: задачи,
+    которые дольше visibility timeout не подтверждались и не продлевались
+    heartbeat, возвращаются в stream через XAUTOCLAIM.
+
+    Статусы и результаты задач хранятся так же, как в QueueService.
+    """
+
+    def __init__(
+        self,
+        queue_prefix: str | None = None,
+        result_prefix: str | None = None,
+        events_channel: str | None = None,
+    ) -> None:
+        super().__init__(queue_prefix, result_prefix, events_channel)
+        self._reliable = True
+        self._group = settings.queue_stream_group
+        self._groups_ready: set[str] = set()
+        # Личный stream пробуждения: позволяет прервать блокирующий XREADGROUP
+        self._interrupt_stream = f"{self._queue_prefix}stream:wakeup:{self.consumer_id}"
+
+    def _stream_key(self, task_type: TaskType, lane: str | None = None) -> str:
+        # Полоса по умолчанию живёт в прежнем stream
+        if lane is None or lane == self._default_lane:
+            return f"{self._queue_prefix}stream:{task_type.value}"
+        return f"{self._queue_prefix}stream:{task_type.value}:{lane}"
+
+    async def _ensure_group(self, stream: str) -> None:
+        """Создаёт группу потребителей (и сам stream), если их ещё нет."""
+        if stream in self._groups_ready:
+            return
+        try:
+            # id="0": группа получит и задачи, добавленные до её создания
+            await self._redis.xgroup_create(stream, self._group, id="0", mkstream=True)
+        except redis.ResponseError as exc:
+            if "BUSYGROUP" not in str(exc):
+                raise
+        self._groups_ready.add(stream)
+
+    async def _push_task(self, pipe: Any, task_type: TaskType, payload: str, lane: str) -> None:
+        stream = self._stream_key(task_type, lane)
+        await self._ensure_group(stream)
+        pipe.xadd(stream, {"task": payload})
+
+    async def interrupt_wait(self) -> None:
+        """Прерывает текущее (или ближайшее) ожидание dequeue_tasks этого процесса."""
+        if self._redis is None:
+            await self.connect()
+        await self._ensure_group(self._interrupt_stream)
+        # Без TTL: истёкший ключ унёс бы группу, и XREADGROUP падал бы с NOGROUP.
+        # Stream держит одну запись и удаляется в unregister
+        await self._redis.xadd(self._interrupt_stream, {"wakeup": "1"}, maxlen=1)
+
+    async def unregister(self) -> None:
+        await super().unregister()
+        await self._redis.delete(self._interrupt_stream)
+        self._groups_ready.discard(self._interrupt_stream)
+
+    async def _read_streams(self, streams: list[str], timeout: float) -> list[tuple[str, str, dict]]:
+        """Читает по одной новой записи из каждого stream (с ожиданием, если timeout > 0)."""
+        for stream in streams:
+            await self._ensure_group(stream)
+        try:
+            response = await self._xreadgroup(streams, timeout)
+        except redis.ResponseError as exc:
+            if "NOGROUP" not in str(exc):
+                raise
+            # Stream удалили вместе с группой (clear_queue в другом процессе):
+            # создаём группы заново и повторяем чтение
+            self._groups_ready.difference_update(streams)
+            for stream in streams:
+                await self._ensure_group(stream)
+            response = await self._xreadgroup(streams, timeout)
+        return [
+            (stream, entry_id, fields)
+            for stream, entries in response or []
+            for entry_id, fields in entries
+        ]
+
+    async def _xreadgroup(self, streams: list[str], timeout: float) -> Any:
+        return await self._redis.xreadgroup(
+            self._group,
+            self.consumer_id,
+            streams={stream: ">" for stream in streams},
+            count=1,
+            block=max(int(timeout * 1000), 1) if timeout > 0 else None,
+        )
+
+    async def _pop_tasks(self, task_types: list[TaskType], timeout: float) -> list[tuple[str, Any]]:
+        popped: list[tuple[str, Any]] = []
+        remaining = list(task_types)
+        lanes = self._lanes.order()
+
+        # Сначала без ожидания проходим полосы по приоритету: не больше
+        # одной задачи каждого типа, из самой приоритетной непустой полосы
+        for lane in lanes:
+            if not remaining:
+                break
+            stream_types = {self._stream_key(task_type, lane): task_type for task_type in remaining}
+            for stream, entry_id, fields in await self._read_streams(list(stream_types), 0):
+                popped.append((fields.get("task", ""), (stream, entry_id)))
+                remaining.remove(stream_types[stream])
+                self._lanes.served(lane)
+        if popped or timeout <= 0:
+            return popped
+
+        # Все очереди пусты - один XREADGROUP ждёт все streams и stream пробуждения
+        stream_lanes = {
+            self._stream_key(task_type, lane): (task_type, lane)
+            for lane in lanes
+            for task_type in task_types
+        }
+        taken: set[TaskType] = set()
+        entries = await self._read_streams([*stream_lanes, self._interrupt_stream], timeout)
+        # Записи идут в порядке переданных streams, то есть по приоритету полос
+        for stream, entry_id, fields in entries:
+            if stream == self._interrupt_stream:
+                await self._ack_receipt((stream, entry_id))
+                continue
+            task_type, lane = stream_lanes[stream]
+            if task_type in taken:
+                # Задачи одновременно пришли в несколько полос: лишнюю возвращаем
+                await self._requeue_entry(stream, entry_id, fields)
+                continue
+            taken.add(task_type)
+            popped.append((fields.get("task", ""), (stream, entry_id)))
+            self._lanes.served(lane)
+        return popped
+
+    async def _requeue_entry(self, stream: str, entry_id: str, fields: dict) -> None:
+        """Перекладывает запись из PEL в конец stream как новую задачу."""
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.xadd(stream, fields)
+            pipe.xack(stream, self._group, entry_id)
+            pipe.xdel(stream, entry_id)
+            await pipe.execute()
+
+    async def _ack_receipt(self, receipt: Any) -> None:
+        stream, entry_id = receipt
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.xack(stream, self._group, entry_id)
+            # Подтверждённые записи удаляем, чтобы XLEN отражал только живые задачи
+            pipe.xdel(stream, entry_id)
+            await pipe.execute()
+
+    async def heartbeat(self) -> None:
+        """
+        Продлевает аренду задач этого воркера.
+
+        Помимо регистрации воркера сбрасывает idle-время его записей в PEL,
+        чтобы XAUTOCLAIM других воркеров их не забрал.
+        """
+        await super().heartbeat()
+        by_stream: dict[str, list[str]] = {}
+        for stream, entry_id in list(self._inflight.values()):
+            by_stream.setdefault(stream, []).append(entry_id)
+        for stream, entry_ids in by_stream.items():
+            await self._redis.xclaim(
+                stream, self._group, self.consumer_id, 0, entry_ids, justid=True
+            )
+
+    async def requeue_expired(self) -> int:
+        """
+        Возвращает в streams задачи, которые дольше visibility timeout
+        висят в PEL без подтверждения, и удаляет из группы простаивающих
+        потребителей без задач.
+
+        Returns:
+            Количество возвращённых задач
+        """
+        if self._redis is None:
+            await self.connect()
+
+        min_idle_ms = self._visibility_timeout * 1000
+        requeued = 0
+        streams = [
+            self._stream_key(task_type, lane)
+            for task_type in TaskType
+            for lane in self._lane_weights
+        ]
+        for stream in streams:
+            await self._ensure_group(stream)
+            start_id = "0-0"
+            while True:
+                response = await self._redis.xautoclaim(
+                    stream, self._group, self.consumer_id, min_idle_ms, start_id=start_id, count=100
+                )
+                start_id, entries = response[0], response[1]
+                for entry_id, fields in entries:
+                    if not fields:
+                        continue
+                    await self._requeue_entry(stream, entry_id, fields)
+                    requeued += 1
+                if start_id == "0-0":
+                    break
+
+            for consumer in await self._redis.xinfo_consumers(stream, self._group):
+                if consumer["pending"] == 0 and consumer["idle"] > min_idle_ms:
+                    await self._redis.xgroup_delconsumer(stream, self._group, consumer["name"])
+        return requeued
+
+    async def get_queue_length(self, task_type: TaskType, lane: str | None = None) -> int:
+        """
+        Возвращает количество задач, ещё не выданных ни одному воркеру.
+
+        Args:
+            task_type: Тип задачи
+            lane: Полоса приоритета (None - сумма по всем полосам)
+
+        Returns:
+            Количество задач в очереди
+        """
+        lanes = [lane] if lane is not None else list(self._lane_weights)
+        total = 0
+        for name in lanes:
+            info = await self.get_consumer_group_info(task_type, name)
+            total += info["lag"]
+        return total
+
+    async def get_consumer_group_info(self, task_type: TaskType, lane: str | None = None) -> dict[str, Any]:
+        """
+        Возвращает состояние группы потребителей из XINFO.
+
+        Args:
+            task_type: Тип задачи
+            lane: Полоса приоритета (None - полоса по умолчанию)
+
+        Returns:
+            Словарь: lag (ещё не выданные задачи), pending (в обработке),
+            consumers (список {name, pending, idle_ms})
+        """
+        if self._redis is None:
+            await self.connect()
+
+        stream = self._stream_key(task_type, lane)
+        await self._ensure_group(stream)
+        groups = await self._redis.xinfo_groups(stream)
+        group = next((g for g in groups if g["name"] == self._group), {})
+        pending = int(group.get("pending") or 0)
+        lag = group.get("lag")
+        if lag is None:
+            # Redis < 7.0 не отдаёт lag: подтверждённые записи удаляются,
+            # поэтому всё, что не в PEL, ещё ждёт в очереди
+            lag = await self._redis.xlen(stream) - pending
+        consumers = [
+            {"name": c["name"], "pending": c["pending"], "idle_ms": c["idle"]}
+            for c in await self._redis.xinfo_consumers(stream, self._group)
+        ]
+        return {"lag": int(lag), "pending": pending, "consumers": consumers}
+
+    async def clear_queue(self, task_type: TaskType) -> None:
+        """
+        Очищает очередь вместе с группой потребителей.
+
+        Args:
+            task_type: Тип задачи
+        """
+        if self._redis is None:
+            await self.connect()
+
+        streams = [self._stream_key(task_type, lane) for lane in self._lane_weights]
+        await self._redis.delete(*streams)
+        self._groups_ready.difference_update(streams)
+        await self._clear_delayed(task_type)
+        await self._reset_positions(task_type)
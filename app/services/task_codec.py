@@ -0,0 +1,174 @@
+import json
+import logging
+import zlib
+from abc import ABC, abstractmethod
+from typing import Any
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Версия схемы QueueTask в заголовке payload. Увеличивается при несовместимых
+# изменениях модели; новые необязательные поля версию не меняют - читатель
+# старой версии их просто игнорирует.
+TASK_SCHEMA_VERSION = 1
+
+# Заголовок payload: "qt<версия>:<кодек>[+zlib]:<тип задачи>:<полоса>\n".
+# Тип и полоса дублируются в заголовке, чтобы Lua-скрипты могли
+# маршрутизировать задачу, не разбирая тело.
+_HEADER_PREFIX = "qt"
+_COMPRESSION = "zlib"
+
+# Payload в очередях - str: бинарное тело передаётся в Redis через
+# surrogateescape и восстанавливается без потерь
+_BINARY_ERRORS = "surrogateescape"
+
+
+class TaskCodec(ABC):
+    """Формат тела задачи в очереди."""
+
+    name = ""
+    # Текстовые кодеки отдают str и обходятся без перекодирования в байты
+    binary = True
+
+    @abstractmethod
+    def encode(self, task: Any) -> bytes | str:
+        """Сериализует QueueTask."""
+
+    @abstractmethod
+    def decode(self, body: bytes | str, model: Any) -> Any:
+        """Разбирает тело в экземпляр model (QueueTask)."""
+
+
+class JsonTaskCodec(TaskCodec):
+    """JSON (формат по умолчанию, понятен любой версии воркера)."""
+
+    name = "json"
+    binary = False
+
+    def encode(self, task: Any) -> str:
+        return task.model_dump_json()
+
+    def decode(self, body: bytes | str, model: Any) -> Any:
+        # json.loads + model_validate заметно быстрее model_validate_json
+        # на произвольном словаре data (история диалога)
+        return model.model_validate(json.loads(body))
+
+
+class MsgpackTaskCodec(TaskCodec):
+    """Бинарный MessagePack (требует пакет msgpack)."""
+
+    name = "msgpack"
+
+    def __init__(self) -> None:
+        import msgpack
+
+        self._msgpack = msgpack
+
+    def encode(self, task: Any) -> bytes:
+        return self._msgpack.packb(task.model_dump(mode="json"))
+
+    def decode(self, body: bytes, model: Any) -> Any:
+        return model.model_validate(self._msgpack.unpackb(body))
+
+
+_CODECS: dict[str, type[TaskCodec]] = {
+    JsonTaskCodec.name: JsonTaskCodec,
+    MsgpackTaskCodec.name: MsgpackTaskCodec,
+}
+_codec_instances: dict[str, TaskCodec] = {}
+
+
+def get_task_codec(name: str) -> TaskCodec:
+    """
+    Возвращает кодек по имени.
+
+    Raises:
+        ValueError: Неизвестный кодек
+        ImportError: Кодек требует неустановленную библиотеку (msgpack)
+    """
+    codec = _codec_instances.get(name)
+    if codec is None:
+        codec_class = _CODECS.get(name)
+        if codec_class is None:
+            raise ValueError(f"Unknown task codec: {name}")
+        codec = _codec_instances[name] = codec_class()
+    return codec
+
+
+def create_task_codec() -> TaskCodec:
+    """Создаёт кодек для записи задач, выбранный в settings.queue_task_codec."""
+    try:
+        return get_task_codec(settings.queue_task_codec)
+    except ImportError:
+        logger.warning(f"Task codec {settings.queue_task_codec!r} is not installed, using json")
+        return get_task_codec(JsonTaskCodec.name)
+
+
+def encode_task(task: Any, codec: TaskCodec, compress_threshold: int = 0) -> str:
+    """
+    Упаковывает задачу в payload очереди.
+
+    Args:
+        task: QueueTask
+        codec: Кодек тела
+        compress_threshold: Сжимать тело не меньше этого размера в байтах (0 - не сжимать)
+
+    Returns:
+        Payload с заголовком версии
+    """
+    body = codec.encode(task)
+    codec_name = codec.name
+    if compress_threshold and len(body) >= compress_threshold:
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        # Уровень 1: история диалога хорошо сжимается и на самом быстром уровне
+        body = zlib.compress(body, 1)
+        codec_name = f"{codec_name}+{_COMPRESSION}"
+    if isinstance(body, bytes):
+        body = body.decode("utf-8", _BINARY_ERRORS)
+    lane = task.lane or ""
+    header = f"{_HEADER_PREFIX}{TASK_SCHEMA_VERSION}:{codec_name}:{task.task_type.value}:{lane}\n"
+    return header + body
+
+
+def decode_task(payload: str | bytes, model: Any) -> Any:
+    """
+    Разбирает payload очереди в задачу.
+
+    Понимает payload любого известного кодека (независимо от настроек
+    этого процесса) и JSON без заголовка, записанный до появления кодеков.
+
+    Args:
+        payload: Payload из очереди
+        model: Класс задачи (QueueTask)
+
+    Returns:
+        Экземпляр model
+
+    Raises:
+        ValueError: Payload повреждён или записан неизвестным кодеком
+    """
+    if isinstance(payload, bytes):
+        payload = payload.decode("utf-8", _BINARY_ERRORS)
+    if payload[:1] == "{":
+        return model.model_validate(json.loads(payload))
+
+    header, separator, body = payload.partition("\n")
+    if not separator or not header.startswith(_HEADER_PREFIX):
+        raise ValueError("Task payload has no header")
+    version_raw, codec_name = header.split(":")[:2]
+    version = int(version_raw[len(_HEADER_PREFIX):])
+    if version > TASK_SCHEMA_VERSION:
+        # Запись от более новой версии бота: неизвестные поля будут проигнорированы
+        logger.debug(f"Decoding task schema v{version} with v{TASK_SCHEMA_VERSION} reader")
+
+    name, _, compression = codec_name.partition("+")
+    codec = get_task_codec(name)
+    if compression == _COMPRESSION:
+        return codec.decode(zlib.decompress(body.encode("utf-8", _BINARY_ERRORS)), model)
+    if compression:
+        raise ValueError(f"Unknown task compression: {compression}")
+    if codec.binary:
+        return codec.decode(body.encode("utf-8", _BINARY_ERRORS), model)
+    return codec.decode(body, model)
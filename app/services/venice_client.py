@@ -1,8 +1,12 @@
-from typing import Any
-
-import httpx
+import json
+import logging
+from typing import Any, AsyncIterator
 
 from app.config import settings
+from app.services.context_builder import ReplyContext, build_reply_context
+from app.services.http_pool import get_http_client
+
+logger = logging.getLogger(__name__)
 
 
 def _normalize_base_url(url: str) -> str:
@@ -21,7 +25,9 @@ def _normalize_base_url(url: str) -> str:
 class VeniceClient:
     def __init__(self) -> None:
         base_url = _normalize_base_url(settings.venice_api_base_url)
-        self._client = httpx.AsyncClient(
+        # Общий пул соединений процесса: запросы не открывают новых соединений
+        self._client = get_http_client(
+            "venice",
             base_url=base_url,
             headers={
                 "Authorization": f"Bearer {settings.venice_api_key}",
@@ -29,8 +35,48 @@ class VeniceClient:
             },
             timeout=30.0,
         )
+        # Промпт последнего ответа (оценка токенов для отчёта)
+        self.last_context: ReplyContext | None = None
 
     async def generate_reply(self, system_prompt: str, history: list[dict[str, str]]) -> str:
+        payload: dict[str, Any] = {
+            "model": settings.venice_model,
+            "messages": self._build_reply_messages(system_prompt, history),
+        }
+        response = await self._client.post("/chat/completions", json=payload)
+        response.raise_for_status()
+        data = response.json()
+        prompt_tokens = (data.get("usage") or {}).get("prompt_tokens")
+        if prompt_tokens is not None and self.last_context is not None:
+            # Сверка оценки с токенизатором модели
+            logger.debug(f"Reply prompt tokens: estimated {self.last_context.tokens}, actual {prompt_tokens}")
+        return data["choices"][0]["message"]["content"]
+
+    async def stream_reply(self, system_prompt: str, history: list[dict[str, str]]) -> AsyncIterator[str]:
+        """
+        Генерирует ответ потоком (server-sent events): отдаёт фрагменты текста
+        по мере генерации. Склеенные фрагменты - тот же ответ, что generate_reply.
+        """
+        payload: dict[str, Any] = {
+            "model": settings.venice_model,
+            "messages": self._build_reply_messages(system_prompt, history),
+            "stream": True,
+        }
+        async with self._client.stream("POST", "/chat/completions", json=payload) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                # Строки событий: "data: {...}", поток завершает "data: [DONE]"
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                choices = json.loads(data).get("choices") or []
+                content = (choices[0].get("delta") or {}).get("content") if choices else None
+                if content:
+                    yield content
+
+    def _build_reply_messages(self, system_prompt: str, history: list[dict[str, str]]) -> list[dict[str, str]]:
         # Анализируем последние сообщения ассистента, чтобы запретить их повторение
         last_assistant_messages = []
         for msg in reversed(history[-10:]):  # Проверяем последние 10 сообщений
@@ -69,15 +115,14 @@ class VeniceClient:
         # Объединяем system prompt с инструкцией о запрете повторений
         enhanced_system_prompt = system_prompt + anti_repetition_instruction
         
-        messages: list[dict[str, str]] = [{"role": "system", "content": enhanced_system_prompt}, *history]
-        payload: dict[str, Any] = {
-            "model": settings.venice_model,
-            "messages": messages,
-        }
-        response = await self._client.post("/chat/completions", json=payload)
-        response.raise_for_status()
-        data = response.json()
-        return data["choices"][0]["message"]["content"]
+        # Историю ограничивает бюджет токенов модели, а не число сообщений
+        context = build_reply_context(enhanced_system_prompt, history, settings.venice_model)
+        self.last_context = context
+        logger.info(
+            f"Reply prompt: ~{context.tokens}/{context.budget} tokens, "
+            f"{context.history_used} messages ({context.history_dropped} dropped)"
+        )
+        return context.messages
 
     async def generate_image_prompt(
         self,
@@ -179,6 +224,7 @@ class VeniceClient:
         return prompt
 
     async def close(self) -> None:
-        await self._client.aclose()
+        # Соединения общего пула закрывает close_http_clients при остановке
+        pass
 
 
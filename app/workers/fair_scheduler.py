@@ -0,0 +1,76 @@
+from collections import deque
+from typing import Any
+
+
+class FairScheduler:
+    """
+    Справедливый планировщик задач одного типа внутри воркера.
+
+    Задачи раскладываются по очередям пользователей (QueueTask.user_id) и
+    выдаются по кругу: deficit round-robin с единичной стоимостью задачи,
+    то есть каждый пользователь с ожидающими задачами получает слот по
+    очереди. Пользователь, у которого уже per_user_limit задач в работе,
+    пропускается до завершения одной из них, поэтому один активный
+    пользователь не может занять все слоты воркера.
+    """
+
+    def __init__(self, per_user_limit: int) -> None:
+        self._per_user_limit = max(1, per_user_limit)
+        # Ожидающие задачи по пользователям и круг пользователей с задачами
+        self._queues: dict[int, deque[Any]] = {}
+        self._ring: deque[int] = deque()
+        # Задачи в работе по пользователям
+        self._inflight: dict[int, int] = {}
+        self._staged = 0
+
+    def __len__(self) -> int:
+        """Количество задач, ожидающих запуска."""
+        return self._staged
+
+    def push(self, task: Any) -> None:
+        """Добавляет задачу в очередь её пользователя."""
+        queue = self._queues.get(task.user_id)
+        if queue is None:
+            queue = self._queues[task.user_id] = deque()
+            self._ring.append(task.user_id)
+        queue.append(task)
+        self._staged += 1
+
+    def pop_ready(self) -> Any | None:
+        """
+        Возвращает следующую задачу по кругу пользователей и учитывает её как запущенную.
+
+        Returns:
+            Задача или None, если все ожидающие пользователи упёрлись в лимит
+        """
+        for _ in range(len(self._ring)):
+            user_id = self._ring.popleft()
+            if self._inflight.get(user_id, 0) >= self._per_user_limit:
+                self._ring.append(user_id)
+                continue
+            queue = self._queues[user_id]
+            task = queue.popleft()
+            if queue:
+                self._ring.append(user_id)
+            else:
+                del self._queues[user_id]
+            self._inflight[user_id] = self._inflight.get(user_id, 0) + 1
+            self._staged -= 1
+            return task
+        return None
+
+    def done(self, task: Any) -> None:
+        """Отмечает завершение задачи, запущенной через pop_ready."""
+        remaining = self._inflight.get(task.user_id, 0) - 1
+        if remaining > 0:
+            self._inflight[task.user_id] = remaining
+        else:
+            self._inflight.pop(task.user_id, None)
+
+    def drain(self) -> list[Any]:
+        """Забирает все ожидающие задачи (например, при остановке воркера)."""
+        tasks = [task for queue in self._queues.values() for task in queue]
+        self._queues.clear()
+        self._ring.clear()
+        self._staged = 0
+        return tasks
@@ -1,6 +1,8 @@
 import asyncio
-import base64
 import logging
+import signal
+import time
+from collections import Counter
 from typing import Any
 
 from app.config import settings
@@ -10,25 +12,96 @@ from app.repositories.girls import get_girl_by_id
 from app.repositories.messages import add_message, get_recent_messages
 from app.repositories.user_selected_girl import get_user_photos_used, increment_user_photos_used
 from app.config import settings
+from app.services.blob_store import BlobStore, create_blob_store
+from app.services.http_pool import close_http_clients
 from app.services.image_client import ImageClient
+from app.services.provider_limiter import (
+    PROVIDER_LIVE3D,
+    PROVIDER_LOCAL_IMAGE,
+    PROVIDER_REPLICATE,
+    PROVIDER_VENICE,
+    ProviderLimiter,
+    create_provider_limiter,
+)
 from app.services.replicate_client import ReplicateImageClient
-from app.services.queue_service import QueueService, TaskStatus, TaskType
+from app.services.queue_service import TERMINAL_STATUSES, QueueService, TaskStatus, TaskType, create_queue_service
+from app.services.retry_policy import (
+    ProviderHealth,
+    RetryBudget,
+    get_retry_after,
+    get_retry_policy,
+    is_transient_error,
+)
 from app.services.venice_client import VeniceClient
+from app.workers.fair_scheduler import FairScheduler
 
 logger = logging.getLogger(__name__)
 
+# Как часто переносить в очереди задачи, время повтора которых подошло (секунды)
+_RETRY_POLL_INTERVAL = 0.5
+
+
+def default_limits() -> dict[TaskType, int]:
+    """Возвращает лимиты одновременных задач по типам из настроек."""
+    return {
+        TaskType.GENERATE_IMAGE: settings.max_concurrent_image_generations,
+        TaskType.GENERATE_REPLY: settings.max_concurrent_reply_generations,
+        TaskType.GENERATE_IMAGE_PROMPT: settings.max_concurrent_reply_generations,
+    }
+
 
 class QueueWorker:
     """Воркер для обработки задач из очереди Redis."""
     
-    def __init__(self) -> None:
-        self.queue_service = QueueService()
+    def __init__(
+        self,
+        queue_service: QueueService | None = None,
+        blob_store: BlobStore | None = None,
+        limits: dict[TaskType, int] | None = None,
+        provider_limiter: ProviderLimiter | None = None,
+    ) -> None:
+        """
+        Args:
+            queue_service: Сервис очередей (по умолчанию - новый, по settings.queue_backend).
+                Воркеру внутри процесса бота передаётся сервис бота
+            blob_store: Хранилище изображений (по умолчанию - новое, по settings.blob_store_backend)
+            limits: Слоты по типам задач (по умолчанию - default_limits). Процессы
+                под супервизором получают свою долю общих лимитов
+            provider_limiter: Лимиты запросов к провайдерам на весь парк воркеров
+                (по умолчанию - новый, по settings.queue_backend)
+        """
+        self.queue_service = queue_service or create_queue_service()
+        self.limits = limits or default_limits()
+        # Изображения хранятся вне результата задачи, в нём только ссылка
+        self.blob_store = blob_store or create_blob_store()
+        # Слоты провайдеров общие для всех воркеров: семафоры ниже ограничивают
+        # только этот процесс
+        self.provider_limiter = provider_limiter or create_provider_limiter()
         self.running = False
         # Семафоры для ограничения параллелизма (инициализируются в start)
         self.image_semaphore: asyncio.Semaphore | None = None
         self.reply_semaphore: asyncio.Semaphore | None = None
-        # Список активных задач для отслеживания
-        self.active_tasks: set[asyncio.Task] = set()
+        self.image_prompt_semaphore: asyncio.Semaphore | None = None
+        # Выполняющиеся задачи: asyncio-задача обработки -> задача очереди
+        self.active_tasks: dict[asyncio.Task, Any] = {}
+        # Диспетчер задач (запускается в start)
+        self._dispatcher: asyncio.Task | None = None
+        self._stopped = False
+        # Срабатывает, когда освобождается слот обработки
+        self._capacity_freed = asyncio.Event()
+        # Типы, задачи которых диспетчер ждёт прямо сейчас (None - не ждёт)
+        self._waiting_types: set[TaskType] | None = None
+        # Справедливые планировщики по типам задач (инициализируются в start)
+        self._schedulers: dict[TaskType, FairScheduler] = {}
+        # Ограничение повторов при массовых сбоях провайдеров
+        self._retry_budget = RetryBudget(settings.queue_retry_budget)
+        # Здоровье провайдеров по типам задач (публикуется в реестре воркеров)
+        self._health = {
+            task_type: ProviderHealth(settings.worker_unhealthy_after, settings.worker_unhealthy_cooldown)
+            for task_type in TaskType
+        }
+        # Задачи, попытка которых завершилась _fail_task (не считаются успехом провайдера)
+        self._failed_attempts: set[str] = set()
     
     async def start(self) -> None:
         """Запускает воркер."""
@@ -36,288 +109,693 @@ class QueueWorker:
         self.running = True
         
         # Инициализируем семафоры для ограничения параллелизма
-        self.image_semaphore = asyncio.Semaphore(settings.max_concurrent_image_generations)
-        self.reply_semaphore = asyncio.Semaphore(settings.max_concurrent_reply_generations)
+        self.image_semaphore = asyncio.Semaphore(self.limits[TaskType.GENERATE_IMAGE])
+        self.reply_semaphore = asyncio.Semaphore(self.limits[TaskType.GENERATE_REPLY])
+        self.image_prompt_semaphore = asyncio.Semaphore(self.limits[TaskType.GENERATE_IMAGE_PROMPT])
+        self._schedulers = {
+            task_type: FairScheduler(settings.max_user_concurrent_tasks)
+            for task_type in TaskType
+        }
+        # Слоты публикуются в heartbeat: по ним бот оценивает время ожидания
+        self.queue_service.set_capacity(self.limits)
         
         logger.info(
-            f"Queue worker started with {settings.max_concurrent_image_generations} "
-            f"concurrent image generations and {settings.max_concurrent_reply_generations} "
+            f"Queue worker started with {self.limits[TaskType.GENERATE_IMAGE]} "
+            f"concurrent image generations and {self.limits[TaskType.GENERATE_REPLY]} "
             f"concurrent reply generations"
         )
         
-        # Запускаем обработчики для каждого типа задач
+        # Один диспетчер забирает задачи всех типов
+        self._dispatcher = asyncio.ensure_future(self._dispatch_tasks())
         tasks = [
-            self._process_generate_image_tasks(),
-            self._process_generate_reply_tasks(),
-            self._process_generate_image_prompt_tasks(),
+            self._maintain_leases(),
+            self._promote_retries(),
+            self._log_stats(),
+            self._dispatcher,
         ]
         
         await asyncio.gather(*tasks)
     
-    async def stop(self) -> None:
-        """Останавливает воркер."""
+    async def stop(self, grace: float | None = None) -> None:
+        """
+        Останавливает воркер.
+        
+        Новые задачи сразу перестают забираться, отложенные в FairScheduler
+        возвращаются в очередь. Выполняющимся задачам даётся grace секунд,
+        после чего они прерываются и тоже возвращаются в очередь: их выполнит
+        другой воркер, а прерванная попытка ничего не сохраняет.
+        
+        Args:
+            grace: Сколько ждать выполняющиеся задачи (по умолчанию settings.worker_shutdown_grace)
+        """
+        if self._stopped:
+            return
+        self._stopped = True
+        if grace is None:
+            grace = settings.worker_shutdown_grace
         self.running = False
+        self._capacity_freed.set()
+        
+        # Будим диспетчер и ждём его выхода: после этого новых задач не появится
+        if self._dispatcher is not None and not self._dispatcher.done():
+            try:
+                await self.queue_service.interrupt_wait()
+            except Exception as exc:
+                logger.warning(f"Failed to interrupt dispatcher wait: {exc}")
+            await asyncio.wait({self._dispatcher}, timeout=5.0)
+        
+        staged = [task for scheduler in self._schedulers.values() for task in scheduler.drain()]
+        if staged:
+            logger.info(f"Returning {len(staged)} staged tasks to the queue")
+            await self._return_tasks(staged)
         
-        # Ждем завершения всех активных задач
         if self.active_tasks:
-            logger.info(f"Waiting for {len(self.active_tasks)} active tasks to complete...")
-            await asyncio.gather(*self.active_tasks, return_exceptions=True)
+            logger.info(f"Waiting up to {grace:.0f}s for {len(self.active_tasks)} active tasks to complete...")
+            _, unfinished = await asyncio.wait(set(self.active_tasks), timeout=grace)
+            if unfinished:
+                logger.warning(f"Returning {len(unfinished)} unfinished tasks to the queue")
+                # Сначала возвращаем задачи, потом прерываем: после возврата
+                # результат прерываемой попытки уже не сохранится
+                await self._return_tasks([self.active_tasks[handle] for handle in unfinished])
+                for handle in unfinished:
+                    handle.cancel()
+                await asyncio.gather(*unfinished, return_exceptions=True)
             self.active_tasks.clear()
         
+        try:
+            await self.queue_service.unregister()
+        except Exception as exc:
+            # Запись исчезнет сама по истечении heartbeat
+            logger.warning(f"Failed to unregister worker: {exc}")
         await self.queue_service.disconnect()
+        await self.blob_store.close()
+        await self.provider_limiter.close()
         logger.info("Queue worker stopped")
     
-    async def _process_single_image_task(self, task: Any) -> None:
-        """Обрабатывает одну задачу генерации изображения."""
-        if self.image_semaphore is None:
+    async def _return_tasks(self, tasks: list[Any]) -> None:
+        """Возвращает взятые, но не выполненные задачи в очередь."""
+        for task in tasks:
+            try:
+                await self.queue_service.return_task(task)
+            except Exception as exc:
+                # Задача останется в списке обработки и вернётся по истечении heartbeat
+                logger.error(f"Failed to return task {task.task_id} to the queue: {exc}")
+    
+    async def _maintain_leases(self) -> None:
+        """
+        Регистрирует воркер (heartbeat со слотами), продлевает аренду взятых
+        задач и возвращает в очередь задачи упавших воркеров.
+        """
+        interval = max(1.0, min(settings.worker_heartbeat_interval, settings.queue_visibility_timeout / 3))
+        # Во время остановки heartbeat продолжается, пока задачи дорабатывают:
+        # иначе другие воркеры вернули бы их в очередь и выполнили повторно
+        while self.running or self.active_tasks:
+            try:
+                self._update_worker_state()
+                await self.queue_service.heartbeat()
+                if self.queue_service.is_reliable:
+                    requeued = await self.queue_service.requeue_expired()
+                    if requeued:
+                        logger.warning(f"Requeued {requeued} tasks from expired workers")
+            except Exception as exc:
+                logger.exception(f"Error maintaining task leases: {exc}")
+            await asyncio.sleep(interval)
+    
+    async def _log_stats(self) -> None:
+        """Периодически пишет в лог метрики очереди и лимиты провайдеров (settings.worker_stats_interval)."""
+        interval = settings.worker_stats_interval
+        if interval <= 0:
+            return
+        loop = asyncio.get_running_loop()
+        next_at = loop.time() + interval
+        while self.running:
+            # Короткие паузы: остановка воркера не ждёт целый интервал
+            if loop.time() < next_at:
+                await asyncio.sleep(min(1.0, next_at - loop.time()))
+                continue
+            next_at = loop.time() + interval
+            try:
+                stats = await self.queue_service.get_result_stats()
+                logger.info(
+                    f"Result memory: {stats['bytes']} bytes in {stats['count']} results "
+                    f"(budget {stats['budget'] or 'unlimited'}, evicted {stats['evicted']})"
+                )
+                for provider, limits in (await self.provider_limiter.get_stats()).items():
+                    p95 = f"{limits['p95']:.1f}s" if limits["p95"] is not None else "n/a"
+                    logger.info(
+                        f"Provider {provider}: {limits['in_use']}/{limits['limit']} slots in use "
+                        f"(floor {limits['floor']}, ceiling {limits['ceiling']}, p95 {p95})"
+                    )
+            except Exception as exc:
+                logger.warning(f"Failed to collect queue stats: {exc}")
+    
+    def _update_worker_state(self) -> None:
+        """Передаёт сервису очередей загрузку и здоровье провайдеров для реестра воркеров."""
+        load = Counter(task.task_type for task in self.active_tasks.values())
+        self.queue_service.set_worker_state(
+            load={task_type: load[task_type] for task_type in TaskType},
+            healthy={task_type: health.healthy for task_type, health in self._health.items()},
+        )
+    
+    async def _promote_retries(self) -> None:
+        """Возвращает в очереди задачи, отложенные для повтора."""
+        while self.running:
+            try:
+                await self.queue_service.promote_delayed_tasks()
+            except Exception as exc:
+                logger.exception(f"Error promoting delayed tasks: {exc}")
+            await asyncio.sleep(_RETRY_POLL_INTERVAL)
+    
+    def _handlers(self) -> dict[TaskType, tuple[asyncio.Semaphore, Any]]:
+        """Возвращает семафор и обработчик для каждого типа задач."""
+        if self.image_semaphore is None or self.reply_semaphore is None or self.image_prompt_semaphore is None:
             raise RuntimeError("Worker not started")
-        async with self.image_semaphore:  # Ограничиваем параллелизм
+        return {
+            TaskType.GENERATE_IMAGE: (self.image_semaphore, self._process_single_image_task),
+            TaskType.GENERATE_REPLY: (self.reply_semaphore, self._process_single_reply_task),
+            TaskType.GENERATE_IMAGE_PROMPT: (self.image_prompt_semaphore, self._process_single_image_prompt_task),
+        }
+    
+    async def _dispatch_tasks(self) -> None:
+        """
+        Забирает задачи всех типов одним блокирующим ожиданием.
+        
+        Из очереди запрашиваются только типы, для которых есть свободный слот,
+        поэтому взятая задача сразу начинает выполняться, а не ждёт семафор,
+        пока другие воркеры простаивают. Исключение - задачи пользователя,
+        упёршегося в settings.max_user_concurrent_tasks: они ждут в
+        FairScheduler (не больше settings.fair_scheduler_window на тип), а
+        диспетчер продолжает забирать задачи, пока не найдёт задачи других
+        пользователей для свободных слотов.
+        """
+        handlers = self._handlers()
+        while self.running:
             try:
-                logger.info(f"Processing image generation task: {task.task_id}")
-                
-                # Извлекаем данные задачи
-                prompt = task.data.get("prompt")
-                negative_prompt = task.data.get("negative_prompt")
-                user_id = task.user_id
-                dialog_id = task.data.get("dialog_id")
-                girl_id = task.data.get("girl_id")
-                
-                if not prompt:
-                    raise ValueError("Prompt is required")
-                
-                # Генерируем изображение (используем Live3D, Replicate или локальный API)
-                if settings.use_live3d:
-                    logger.info("Используется Live3D для генерации изображения")
-                    from app.services.live3d_client import Live3DImageClient
-                    image_client = Live3DImageClient()
-                elif settings.use_replicate:
-                    logger.info("Используется Replicate для генерации изображения")
-                    image_client = ReplicateImageClient()
-                else:
-                    logger.info("Используется локальный API для генерации изображения")
-                    image_client = ImageClient()
+                self._capacity_freed.clear()
+                task_types = [
+                    task_type
+                    for task_type, (semaphore, _) in handlers.items()
+                    if not semaphore.locked()
+                    # Отложенные задачи держим только в пределах окна планировщика
+                    and len(self._schedulers[task_type]) < settings.fair_scheduler_window
+                ]
+                if not task_types:
+                    # Все слоты заняты - ждём завершения какой-нибудь задачи
+                    try:
+                        await asyncio.wait_for(self._capacity_freed.wait(), timeout=1)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
                 
+                self._waiting_types = set(task_types)
                 try:
+                    tasks = await self.queue_service.dequeue_tasks(task_types, timeout=1)
+                finally:
+                    self._waiting_types = None
+                if not self.running:
+                    # Задачи пришли, когда воркер уже останавливается
+                    await self._return_tasks(tasks)
+                    break
+                for task in tasks:
+                    self._schedulers[task.task_type].push(task)
+                    await self._start_ready_tasks(task.task_type)
+            
+            except Exception as exc:
+                logger.exception(f"Error in task dispatcher: {exc}")
+                await asyncio.sleep(1)
+    
+    async def _start_ready_tasks(self, task_type: TaskType) -> None:
+        """Запускает задачи типа task_type из FairScheduler, пока есть свободные слоты."""
+        semaphore, handler = self._handlers()[task_type]
+        scheduler = self._schedulers[task_type]
+        while not semaphore.locked():
+            task = scheduler.pop_ready()
+            if task is None:
+                return
+            # Слот свободен, захват не ждёт
+            await semaphore.acquire()
+            task_handle = asyncio.create_task(self._run_task(task, semaphore, handler))
+            self.active_tasks[task_handle] = task
+            # Удаляем завершенные задачи из реестра
+            task_handle.add_done_callback(lambda handle: self.active_tasks.pop(handle, None))
+    
+    async def _run_task(self, task: Any, semaphore: asyncio.Semaphore, handler: Any) -> None:
+        """Выполняет задачу в занятом слоте и освобождает его."""
+        started = time.monotonic()
+        if task.attempt == 0:
+            self._retry_budget.deposit()
+        runner = asyncio.ensure_future(handler(task))
+        # Отменённую задачу прерываем сразу, не дожидаясь ответа провайдера
+        watcher = asyncio.create_task(self._watch_cancellation(task.task_id, runner))
+        try:
+            # После deadline результат никому не нужен: прерываем обработку
+            timeout = None if task.deadline is None else max(0.0, task.deadline - time.time())
+            await asyncio.wait_for(runner, timeout=timeout)
+            if task.task_id not in self._failed_attempts:
+                self._health[task.task_type].record_success()
+        except asyncio.CancelledError:
+            if not (watcher.done() and not watcher.cancelled() and watcher.result()):
+                raise
+            logger.info(f"Task {task.task_id} aborted: cancelled")
+        except asyncio.TimeoutError:
+            logger.warning(f"Task {task.task_id} aborted: deadline exceeded")
+            try:
+                await self.queue_service.update_task_status(
+                    task.task_id,
+                    TaskStatus.FAILED,
+                    error="Deadline exceeded",
+                )
+            except Exception as exc:
+                logger.warning(f"Failed to mark task {task.task_id} as expired: {exc}")
+        finally:
+            self._failed_attempts.discard(task.task_id)
+            watcher.cancel()
+            semaphore.release()
+            # Прерванные попытки не отражают время обработки
+            if runner.done() and not runner.cancelled():
+                try:
+                    await self.queue_service.record_service_time(task.task_type, time.monotonic() - started)
+                except Exception as exc:
+                    logger.warning(f"Failed to record service time: {exc}")
+            self._schedulers[task.task_type].done(task)
+            # Освободившийся слот может занять отложенная задача того же типа
+            if self.running:
+                await self._start_ready_tasks(task.task_type)
+            self._capacity_freed.set()
+            # Диспетчер ждёт задачи других типов - прерываем ожидание,
+            # чтобы он сразу начал ждать и этот тип
+            if self._waiting_types is not None and task.task_type not in self._waiting_types:
+                try:
+                    await self.queue_service.interrupt_wait()
+                except Exception as exc:
+                    logger.warning(f"Failed to interrupt dispatcher wait: {exc}")
+    
+    async def _watch_cancellation(self, task_id: str, runner: asyncio.Future) -> bool:
+        """
+        Прерывает обработку задачи, если её отменили (QueueService.cancel_task).
+        
+        Args:
+            task_id: ID задачи
+            runner: Выполняющийся обработчик задачи
+        
+        Returns:
+            True, если обработка прервана из-за отмены
+        """
+        while not runner.done():
+            try:
+                current = await self.queue_service.wait_for_task(task_id, timeout=60.0)
+            except Exception as exc:
+                logger.warning(f"Failed to watch task {task_id} for cancellation: {exc}")
+                await asyncio.sleep(5.0)
+                continue
+            if current is None:
+                return False
+            if current.status == TaskStatus.CANCELLED:
+                runner.cancel()
+                return True
+            if current.status in TERMINAL_STATUSES:
+                return False
+        return False
+    
+    async def _fail_task(self, task: Any, exc: Exception) -> None:
+        """
+        Планирует повтор задачи после временной ошибки или завершает её с ошибкой.
+        
+        Повтор выполняется, если ошибка временная (сеть, таймаут, 429/5xx),
+        попытки по политике типа не исчерпаны, повтор успевает до deadline
+        задачи и хватает бюджета повторов. Задача, упавшая с временной
+        ошибкой без повтора, сохраняется в dead-letter списке.
+        
+        Args:
+            task: Задача
+            exc: Ошибка попытки
+        """
+        error = str(exc) or type(exc).__name__
+        transient = is_transient_error(exc)
+        self._failed_attempts.add(task.task_id)
+        if transient:
+            await self._record_provider_failure(task.task_type)
+            policy = get_retry_policy(task.task_type)
+            delay = policy.backoff(task.attempt, get_retry_after(exc))
+            if task.attempt + 1 >= policy.max_attempts:
+                logger.warning(f"Task {task.task_id} exhausted {policy.max_attempts} attempts")
+            elif task.deadline is not None and time.time() + delay >= task.deadline:
+                logger.info(f"Task {task.task_id} not retried: deadline is too close")
+            elif not self._retry_budget.try_withdraw():
+                logger.warning(f"Task {task.task_id} not retried: retry budget exhausted")
+            elif await self.queue_service.retry_task(task, error, delay):
+                logger.warning(
+                    f"Task {task.task_id} failed with transient error, "
+                    f"retry {task.attempt + 1} in {delay:.1f}s: {error}"
+                )
+                return
+        
+        failed = await self.queue_service.update_task_status(
+            task.task_id,
+            TaskStatus.FAILED,
+            error=error,
+        )
+        if transient and failed:
+            await self.queue_service.dead_letter_task(task, error)
+    
+    async def _complete_stage(self, task: Any, result: dict[str, Any]) -> bool:
+        """
+        Завершает задачу или, если у неё есть следующие этапы, переводит её дальше.
+        
+        Результат этапа дополняет данные задачи и становится входом
+        следующего этапа; ожидающие задачу получат результат последнего.
+        
+        Args:
+            task: Выполняющаяся задача
+            result: Результат этапа
+        
+        Returns:
+            True, если результат принят; False, если задачу отменили
+        """
+        if task.next_stages:
+            advanced = await self.queue_service.advance_task(task, {**task.data, **result})
+            if advanced:
+                logger.info(f"Task {task.task_id} advanced to {task.next_stages[0].value}")
+            return advanced
+        return await self.queue_service.update_task_status(
+            task.task_id,
+            TaskStatus.COMPLETED,
+            result=result,
+            expected=TaskStatus.PROCESSING,
+        )
+    
+    async def _record_provider_failure(self, task_type: TaskType) -> None:
+        """Учитывает временную ошибку провайдера и сразу сообщает, если он стал нездоров."""
+        health = self._health[task_type]
+        was_healthy = health.healthy
+        health.record_failure()
+        if was_healthy and not health.healthy:
+            logger.warning(
+                f"Provider for {task_type.value} marked unhealthy for "
+                f"{settings.worker_unhealthy_cooldown:.0f}s after {settings.worker_unhealthy_after} failures"
+            )
+            # Не ждём очередного heartbeat: бот должен перестать ставить задачи сразу
+            try:
+                self._update_worker_state()
+                await self.queue_service.heartbeat()
+            except Exception as exc:
+                logger.warning(f"Failed to publish worker state: {exc}")
+    
+    async def _process_single_image_task(self, task: Any) -> None:
+        """Обрабатывает одну задачу генерации изображения."""
+        try:
+            logger.info(f"Processing image generation task: {task.task_id}")
+            
+            # Извлекаем данные задачи
+            prompt = task.data.get("prompt")
+            negative_prompt = task.data.get("negative_prompt")
+            user_id = task.user_id
+            dialog_id = task.data.get("dialog_id")
+            girl_id = task.data.get("girl_id")
+            
+            if not prompt:
+                raise ValueError("Prompt is required")
+            
+            # Генерируем изображение (используем Live3D, Replicate или локальный API)
+            if settings.use_live3d:
+                logger.info("Используется Live3D для генерации изображения")
+                from app.services.live3d_client import Live3DImageClient
+                image_client = Live3DImageClient()
+                provider = PROVIDER_LIVE3D
+            elif settings.use_replicate:
+                logger.info("Используется Replicate для генерации изображения")
+                image_client = ReplicateImageClient()
+                provider = PROVIDER_REPLICATE
+            else:
+                logger.info("Используется локальный API для генерации изображения")
+                image_client = ImageClient()
+                provider = PROVIDER_LOCAL_IMAGE
+            
+            try:
+                async with self.provider_limiter.slot(provider):
                     image_data = await image_client.generate_image(
                         prompt,
                         negative_prompt=negative_prompt
                     )
-                    image_base64 = base64.b64encode(image_data).decode("utf-8")
-                    
+                image_ref = await self.blob_store.put(image_data)
+                
+                async with get_session() as session:
                     # Обновляем счётчик фото, если указан dialog_id
                     if dialog_id:
-                        async with get_session() as session:
-                            await increment_user_photos_used(session, user_id=user_id)
-                            await session.commit()
+                        await increment_user_photos_used(session, user_id=user_id)
                     
-                    # Сохраняем результат
-                    await self.queue_service.update_task_status(
+                    # Сохраняем результат; изображение в Redis учитывается в его
+                    # бюджете памяти и вытесняется вместе с ним
+                    attachment_key = self.blob_store.redis_key(image_ref)
+                    completed = await self.queue_service.update_task_status(
                         task.task_id,
                         TaskStatus.COMPLETED,
                         result={
-                            "image_base64": image_base64,
+                            "image_ref": image_ref,
                             "image_size": len(image_data),
                             "dialog_id": dialog_id,
                             "girl_id": girl_id,
-                        }
+                        },
+                        expected=TaskStatus.PROCESSING,
+                        attachment_key=attachment_key,
+                        attachment_size=len(image_data) if attachment_key else 0,
                     )
-                    
-                    logger.info(f"Image generation completed: {task.task_id}")
-                finally:
-                    await image_client.close()
-            
-            except Exception as exc:
-                logger.exception(f"Error processing image generation task {task.task_id}: {exc}")
-                await self.queue_service.update_task_status(
-                    task.task_id,
-                    TaskStatus.FAILED,
-                    error=str(exc)
-                )
-    
-    async def _process_generate_image_tasks(self) -> None:
-        """Обрабатывает задачи генерации изображений параллельно."""
-        while self.running:
-            try:
-                # Извлекаем задачу из очереди
-                task = await self.queue_service.dequeue_task(
-                    TaskType.GENERATE_IMAGE,
-                    timeout=1
-                )
-                
-                if task is None:
-                    # Очищаем завершенные задачи из активных
-                    self.active_tasks = {t for t in self.active_tasks if not t.done()}
-                    await asyncio.sleep(0.1)
-                    continue
+                    if not completed:
+                        # Задачу отменили, пока она выполнялась: результат не нужен
+                        logger.info(f"Image generation task {task.task_id} was cancelled, dropping result")
+                        await self.blob_store.delete(image_ref)
+                        return
+                    await session.commit()
                 
-                # Запускаем обработку задачи параллельно
-                task_handle = asyncio.create_task(self._process_single_image_task(task))
-                self.active_tasks.add(task_handle)
-                
-                # Удаляем завершенные задачи из множества
-                task_handle.add_done_callback(self.active_tasks.discard)
-            
-            except Exception as exc:
-                logger.exception(f"Error in image generation worker: {exc}")
-                await asyncio.sleep(1)
+                logger.info(f"Image generation completed: {task.task_id}")
+            finally:
+                await image_client.close()
+        
+        except Exception as exc:
+            logger.exception(f"Error processing image generation task {task.task_id}: {exc}")
+            await self._fail_task(task, exc)
+        finally:
+            await self.queue_service.ack_task(task.task_id)
     
     async def _process_single_reply_task(self, task: Any) -> None:
         """Обрабатывает одну задачу генерации ответа."""
-        if self.reply_semaphore is None:
-            raise RuntimeError("Worker not started")
-        async with self.reply_semaphore:  # Ограничиваем параллелизм
+        try:
+            logger.info(f"Processing reply generation task: {task.task_id}")
+            
+            # Извлекаем данные задачи
+            system_prompt = task.data.get("system_prompt")
+            history = task.data.get("history", [])
+            dialog_id = task.data.get("dialog_id")
+            user_message = task.data.get("user_message")
+            
+            if not system_prompt:
+                raise ValueError("System prompt is required")
+            
+            # Генерируем ответ
+            venice_client = VeniceClient()
             try:
-                logger.info(f"Processing reply generation task: {task.task_id}")
-                
-                # Извлекаем данные задачи
-                system_prompt = task.data.get("system_prompt")
-                history = task.data.get("history", [])
-                dialog_id = task.data.get("dialog_id")
-                user_message = task.data.get("user_message")
+                async with self.provider_limiter.slot(PROVIDER_VENICE):
+                    if settings.reply_streaming:
+                        reply_text = await self._stream_reply(task, venice_client, system_prompt, history)
+                    else:
+                        reply_text = await venice_client.generate_reply(system_prompt, history)
                 
-                if not system_prompt:
-                    raise ValueError("System prompt is required")
-                
-                # Генерируем ответ
-                venice_client = VeniceClient()
-                try:
-                    reply_text = await venice_client.generate_reply(system_prompt, history)
-                    
+                async with get_session() as session:
                     # Сохраняем сообщение в БД
                     if dialog_id and user_message:
-                        async with get_session() as session:
-                            # Добавляем сообщение пользователя, если его еще нет
-                            # (может быть уже добавлено в handlers)
-                            # Добавляем ответ ассистента
-                            await add_message(
-                                session,
-                                dialog_id=dialog_id,
-                                role="assistant",
-                                content=reply_text,
-                            )
-                            await session.commit()
+                        # Добавляем сообщение пользователя, если его еще нет
+                        # (может быть уже добавлено в handlers)
+                        # Добавляем ответ ассистента
+                        await add_message(
+                            session,
+                            dialog_id=dialog_id,
+                            role="assistant",
+                            content=reply_text,
+                        )
                     
-                    # Сохраняем результат
-                    await self.queue_service.update_task_status(
+                    # Сохраняем результат. Ответ фиксируется в БД, только если
+                    # задачу не отменили: иначе бот уже сгенерировал его сам
+                    completed = await self.queue_service.update_task_status(
                         task.task_id,
                         TaskStatus.COMPLETED,
                         result={
                             "reply": reply_text,
                             "dialog_id": dialog_id,
-                        }
+                            "prompt_tokens": venice_client.last_context.tokens if venice_client.last_context else None,
+                        },
+                        expected=TaskStatus.PROCESSING,
                     )
-                    
-                    logger.info(f"Reply generation completed: {task.task_id}")
-                finally:
-                    await venice_client.close()
-            
-            except Exception as exc:
-                logger.exception(f"Error processing reply generation task {task.task_id}: {exc}")
-                await self.queue_service.update_task_status(
-                    task.task_id,
-                    TaskStatus.FAILED,
-                    error=str(exc)
-                )
+                    if not completed:
+                        logger.info(f"Reply generation task {task.task_id} was cancelled, dropping reply")
+                        return
+                    await session.commit()
+                
+                logger.info(f"Reply generation completed: {task.task_id}")
+            finally:
+                await venice_client.close()
+        
+        except Exception as exc:
+            logger.exception(f"Error processing reply generation task {task.task_id}: {exc}")
+            await self._fail_task(task, exc)
+        finally:
+            await self.queue_service.ack_task(task.task_id)
     
-    async def _process_generate_reply_tasks(self) -> None:
-        """Обрабатывает задачи генерации ответов AI параллельно."""
-        while self.running:
+    async def _stream_reply(
+        self,
+        task: Any,
+        venice_client: VeniceClient,
+        system_prompt: str,
+        history: list[dict[str, str]],
+    ) -> str:
+        """
+        Генерирует ответ потоком и публикует накопленный текст как промежуточный
+        результат задачи: первый фрагмент - сразу, дальше не чаще раза в
+        settings.reply_stream_interval секунд.
+        
+        Returns:
+            Полный текст ответа (или уже полученная часть, если задачу отменили)
+        """
+        parts: list[str] = []
+        published_at: float | None = None
+        async for chunk in venice_client.stream_reply(system_prompt, history):
+            parts.append(chunk)
+            now = time.monotonic()
+            if published_at is not None and now - published_at < settings.reply_stream_interval:
+                continue
+            published_at = now
             try:
-                # Извлекаем задачу из очереди
-                task = await self.queue_service.dequeue_task(
-                    TaskType.GENERATE_REPLY,
-                    timeout=1
-                )
-                
-                if task is None:
-                    await asyncio.sleep(0.1)
-                    continue
-                
-                # Запускаем обработку задачи параллельно
-                task_handle = asyncio.create_task(self._process_single_reply_task(task))
-                self.active_tasks.add(task_handle)
-                
-                # Удаляем завершенные задачи из множества
-                task_handle.add_done_callback(self.active_tasks.discard)
-            
+                if not await self.queue_service.publish_progress(task.task_id, "".join(parts)):
+                    # Задачу отменили: ответ не понадобится, его не сохранит и переход статуса
+                    logger.info(f"Reply generation task {task.task_id} was cancelled, stopping stream")
+                    break
             except Exception as exc:
-                logger.exception(f"Error in reply generation worker: {exc}")
-                await asyncio.sleep(1)
+                # Без промежуточного результата пользователь дождётся полного ответа
+                logger.warning(f"Failed to publish progress of task {task.task_id}: {exc}")
+        return "".join(parts)
     
-    async def _process_generate_image_prompt_tasks(self) -> None:
-        """Обрабатывает задачи генерации промптов для изображений."""
-        while self.running:
-            try:
-                task = await self.queue_service.dequeue_task(
-                    TaskType.GENERATE_IMAGE_PROMPT,
-                    timeout=1
-                )
-                
-                if task is None:
-                    await asyncio.sleep(0.1)
-                    continue
-                
-                logger.info(f"Processing image prompt generation task: {task.task_id}")
-                
+    async def _process_single_image_prompt_task(self, task: Any) -> None:
+        """
+        Обрабатывает одну задачу генерации промпта для изображения.
+        
+        Этап цепочки "промпт -> изображение" (base_prompt в данных) сам
+        загружает последние сообщения диалога и дополняет base_prompt
+        контекстом от Venice; сбой Venice не проваливает цепочку - фото
+        генерируется по base_prompt.
+        """
+        acked = False
+        try:
+            logger.info(f"Processing image prompt generation task: {task.task_id}")
+            
+            # Извлекаем данные задачи
+            girl_name = task.data.get("girl_name")
+            girl_description = task.data.get("girl_description")
+            recent_dialogue = task.data.get("recent_dialogue")
+            base_prompt = task.data.get("base_prompt")
+            dialog_id = task.data.get("dialog_id")
+            
+            if not girl_name:
+                raise ValueError("Girl name is required")
+            
+            if recent_dialogue is None and dialog_id:
+                async with get_session() as session:
+                    messages = await get_recent_messages(session, dialog_id=dialog_id, limit=15)
+                recent_dialogue = [
+                    {"role": msg.role, "content": msg.content}
+                    for msg in messages
+                ]
+            
+            # Генерируем промпт
+            prompt = base_prompt or ""
+            if recent_dialogue or not base_prompt:
+                venice_client = VeniceClient()
                 try:
-                    # Извлекаем данные задачи
-                    girl_name = task.data.get("girl_name")
-                    girl_description = task.data.get("girl_description")
-                    recent_dialogue = task.data.get("recent_dialogue", [])
-                    
-                    if not girl_name:
-                        raise ValueError("Girl name is required")
-                    
-                    # Генерируем промпт
-                    venice_client = VeniceClient()
-                    try:
-                        prompt = await venice_client.generate_image_prompt(
+                    async with self.provider_limiter.slot(PROVIDER_VENICE):
+                        dialogue_context = await venice_client.generate_image_prompt(
                             girl_name=girl_name,
                             girl_description=girl_description or "",
-                            recent_dialogue=recent_dialogue,
-                        )
-                        
-                        # Сохраняем результат
-                        await self.queue_service.update_task_status(
-                            task.task_id,
-                            TaskStatus.COMPLETED,
-                            result={
-                                "prompt": prompt,
-                            }
+                            recent_dialogue=recent_dialogue or [],
+                            undressing_clothing=task.data.get("undressing_clothing"),
                         )
-                        
-                        logger.info(f"Image prompt generation completed: {task.task_id}")
-                    finally:
-                        await venice_client.close()
-                
                 except Exception as exc:
-                    logger.exception(f"Error processing image prompt generation task {task.task_id}: {exc}")
-                    await self.queue_service.update_task_status(
-                        task.task_id,
-                        TaskStatus.FAILED,
-                        error=str(exc)
-                    )
+                    if not base_prompt:
+                        raise
+                    logger.warning(f"Failed to add dialogue context to task {task.task_id}: {exc}")
+                    dialogue_context = ""
+                finally:
+                    await venice_client.close()
+                
+                if not base_prompt:
+                    prompt = dialogue_context
+                elif dialogue_context and len(dialogue_context.strip()) > 5:
+                    # Добавляем контекст к базовому промпту
+                    prompt = f"{base_prompt}, {dialogue_context}"
             
-            except Exception as exc:
-                logger.exception(f"Error in image prompt generation worker: {exc}")
-                await asyncio.sleep(1)
+            # Сохраняем результат или передаём промпт следующему этапу
+            completed = await self._complete_stage(task, {"prompt": prompt})
+            # Квитанцию этапа цепочки подтверждает advance_task
+            acked = bool(task.next_stages)
+            if not completed:
+                logger.info(f"Image prompt generation task {task.task_id} was cancelled, dropping prompt")
+                return
+            
+            logger.info(f"Image prompt generation completed: {task.task_id}")
+        
+        except Exception as exc:
+            logger.exception(f"Error processing image prompt generation task {task.task_id}: {exc}")
+            await self._fail_task(task, exc)
+        finally:
+            if not acked:
+                await self.queue_service.ack_task(task.task_id)
 
 
-async def main() -> None:
-    """Главная функция для запуска воркера."""
+async def main(limits: dict[TaskType, int] | None = None, handle_sigint: bool = True) -> None:
+    """
+    Главная функция для запуска воркера.
+    
+    Args:
+        limits: Слоты по типам задач (по умолчанию - default_limits)
+        handle_sigint: Останавливаться по SIGINT (False - процесс под
+            супервизором, его останавливает SIGTERM от супервизора)
+    """
     logging.basicConfig(
         level=logging.INFO,
         format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
     )
     
-    worker = QueueWorker()
+    if settings.queue_backend == "memory":
+        # Задачи в памяти видит только процесс, который их поставил
+        raise RuntimeError('QUEUE_BACKEND="memory" runs the worker inside the bot process (main.py)')
+    
+    worker = QueueWorker(limits=limits)
+    
+    # SIGTERM (остановка при деплое) и SIGINT запускают плавную остановку
+    stop_requested = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    signums = (signal.SIGTERM, signal.SIGINT) if handle_sigint else (signal.SIGTERM,)
+    for signum in signums:
+        try:
+            loop.add_signal_handler(signum, stop_requested.set)
+        except NotImplementedError:
+            # Windows: остаётся KeyboardInterrupt
+            pass
     
+    run = asyncio.create_task(worker.start())
+    stop_wait = asyncio.create_task(stop_requested.wait())
     try:
-        await worker.start()
-    except KeyboardInterrupt:
+        await asyncio.wait({run, stop_wait}, return_when=asyncio.FIRST_COMPLETED)
+        if run.done():
+            # Воркер завершился сам (ошибка при запуске)
+            run.result()
+        logger.info("Received stop signal, draining worker")
+    except (KeyboardInterrupt, asyncio.CancelledError):
         logger.info("Received interrupt signal")
     finally:
+        stop_wait.cancel()
         await worker.stop()
+        if not run.done():
+            run.cancel()
+        await asyncio.gather(run, return_exceptions=True)
+        await close_http_clients()
 
 
 if __name__ == "__main__":
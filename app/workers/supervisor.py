@@ -0,0 +1,181 @@
+import logging
+import multiprocessing
+import os
+import signal
+import time
+from multiprocessing.connection import wait
+from multiprocessing.process import BaseProcess
+
+from app.config import settings
+from app.services.queue_service import TaskType
+
+logger = logging.getLogger(__name__)
+
+# Процесс, проработавший дольше, считается запустившимся: задержка перезапуска сбрасывается
+_STABLE_UPTIME = 60.0
+# Потолок задержки перезапуска процесса, падающего сразу после старта (секунды)
+_MAX_RESTART_DELAY = 60.0
+# Сколько ждать процессы сверх worker_shutdown_grace, прежде чем убить их (секунды)
+_SHUTDOWN_MARGIN = 15.0
+
+
+def split_limit(total: int, parts: int) -> list[int]:
+    """
+    Делит общий лимит на parts долей, отличающихся не больше чем на единицу.
+
+    Сумма долей равна total, поэтому процессы вместе не превышают лимит
+    провайдера: split_limit(5, 3) == [2, 2, 1].
+    """
+    base, extra = divmod(total, parts)
+    return [base + (1 if index < extra else 0) for index in range(parts)]
+
+
+def resolve_process_count(requested: int, limits: dict[TaskType, int]) -> int:
+    """
+    Определяет число процессов воркера.
+
+    Args:
+        requested: Запрошенное число (0 - по числу ядер)
+        limits: Общие лимиты одновременных задач по типам
+
+    Returns:
+        Число процессов: не больше наибольшего лимита, иначе лишним
+        процессам не досталось бы ни одного слота
+    """
+    processes = requested if requested > 0 else os.cpu_count() or 1
+    most_slots = max(limits.values(), default=1)
+    if processes > most_slots:
+        logger.warning(f"Reducing worker processes from {processes} to {most_slots}: not enough slots for the rest")
+        processes = max(1, most_slots)
+    return processes
+
+
+def _run_worker_process(index: int, limits: dict[TaskType, int]) -> None:
+    """Точка входа дочернего процесса: обычный воркер со своей долей слотов."""
+    import asyncio
+
+    from app.workers.queue_worker import main
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format=f"%(asctime)s - worker-{index} - %(name)s - %(levelname)s - %(message)s",
+    )
+    # Ctrl+C в терминале получает вся группа процессов: останавливает супервизор
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(main(limits, handle_sigint=False))
+
+
+class WorkerSupervisor:
+    """
+    Запускает несколько процессов воркера и перезапускает упавшие.
+
+    Каждый процесс - обычный QueueWorker со своим event loop, поэтому
+    CPU-работа с изображениями (base64, Pillow) идёт на всех ядрах.
+    Лимиты одновременных задач (settings.max_concurrent_*) делятся между
+    процессами (split_limit): на хост приходится столько же запросов к
+    провайдерам, сколько при одном процессе.
+
+    SIGTERM/SIGINT супервизора передаются процессам как SIGTERM: каждый
+    плавно останавливается (QueueWorker.stop) и возвращает невыполненные
+    задачи в очередь.
+    """
+
+    def __init__(self, processes: int, limits: dict[TaskType, int]) -> None:
+        self._limits = [
+            dict(zip(limits, shares))
+            for shares in zip(*(split_limit(total, processes) for total in limits.values()))
+        ]
+        # spawn: дочерний процесс не наследует состояние event loop и клиентов родителя
+        self._context = multiprocessing.get_context("spawn")
+        self._processes: list[BaseProcess | None] = [None] * processes
+        self._started_at = [0.0] * processes
+        self._restart_delay = [0.0] * processes
+        self._restart_at: list[float | None] = [None] * processes
+        self._stopping = False
+
+    def run(self) -> None:
+        """Запускает процессы и следит за ними до сигнала остановки."""
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self._request_stop)
+        for index, limits in enumerate(self._limits):
+            logger.info(f"Worker {index} limits: " + ", ".join(f"{t.value}={n}" for t, n in limits.items()))
+            self._start(index)
+
+        try:
+            while not self._stopping:
+                self._supervise()
+        finally:
+            self._shutdown()
+
+    def _request_stop(self, signum: int, frame: object) -> None:
+        logger.info(f"Received signal {signum}, stopping worker processes")
+        self._stopping = True
+
+    def _start(self, index: int) -> None:
+        process = self._context.Process(
+            target=_run_worker_process,
+            args=(index, self._limits[index]),
+            name=f"worker-{index}",
+        )
+        process.start()
+        self._processes[index] = process
+        self._started_at[index] = time.monotonic()
+        self._restart_at[index] = None
+        logger.info(f"Started worker {index} (pid {process.pid})")
+
+    def _supervise(self) -> None:
+        """Ждёт завершения процессов (не дольше секунды) и планирует перезапуски."""
+        now = time.monotonic()
+        for index, restart_at in enumerate(self._restart_at):
+            if restart_at is not None and restart_at <= now:
+                self._start(index)
+
+        alive = {process.sentinel: index for index, process in enumerate(self._processes) if process is not None}
+        pending = [at for at in self._restart_at if at is not None]
+        timeout = min([1.0, *(max(0.0, at - now) for at in pending)])
+        for sentinel in wait(list(alive), timeout=timeout):
+            if self._stopping:
+                return
+            index = alive[sentinel]
+            process = self._processes[index]
+            process.join()
+            self._processes[index] = None
+            # Падение сразу после старта (нет Redis, ошибка конфигурации) -
+            # перезапускаем с растущей задержкой, чтобы не крутить цикл
+            if time.monotonic() - self._started_at[index] >= _STABLE_UPTIME:
+                self._restart_delay[index] = 0.0
+            else:
+                self._restart_delay[index] = min(_MAX_RESTART_DELAY, max(1.0, self._restart_delay[index] * 2))
+            logger.error(
+                f"Worker {index} (pid {process.pid}) exited with code {process.exitcode}, "
+                f"restarting in {self._restart_delay[index]:.0f}s"
+            )
+            self._restart_at[index] = time.monotonic() + self._restart_delay[index]
+
+    def _shutdown(self) -> None:
+        """Плавно останавливает процессы: SIGTERM, ожидание, затем SIGKILL."""
+        running = [process for process in self._processes if process is not None and process.is_alive()]
+        for process in running:
+            process.terminate()
+        deadline = time.monotonic() + settings.worker_shutdown_grace + _SHUTDOWN_MARGIN
+        for process in running:
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning(f"Worker {process.name} (pid {process.pid}) did not stop in time, killing")
+                process.kill()
+                process.join()
+        logger.info("All worker processes stopped")
+
+
+def run_supervisor(processes: int, limits: dict[TaskType, int]) -> None:
+    """
+    Запускает супервизор с processes процессами воркера.
+
+    Args:
+        processes: Число процессов
+        limits: Общие лимиты одновременных задач по типам на весь хост
+    """
+    if settings.queue_backend == "memory":
+        # Задачи в памяти видит только процесс, который их поставил
+        raise RuntimeError('QUEUE_BACKEND="memory" runs the worker inside the bot process (main.py)')
+    WorkerSupervisor(processes, limits).run()
@@ -0,0 +1,148 @@
+"""Бенчмарк накладных расходов HTTP-запроса: новый клиент на запрос против общего пула.
+
+Поднимает локальный stub-сервер с ответом в формате Venice (/chat/completions)
+и отправляет запросы двумя способами:
+- per-request - как раньше: новый httpx.AsyncClient на каждый запрос, закрытие после;
+- pooled - VeniceClient поверх общего пула соединений (app.services.http_pool).
+
+Stub отвечает сразу, поэтому время запроса - это почти целиком накладные
+расходы клиента. Установку соединения с реальным upstream (TCP + TLS, несколько
+RTT) имитирует --handshake-ms: задержка stub-сервера на каждом новом соединении.
+
+    python bench_http_pool.py --requests 500 --concurrency 10 --handshake-ms 30
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+import httpx
+
+from app.config import settings
+from app.services.http_pool import close_http_clients
+from app.services.venice_client import VeniceClient
+
+RESPONSE_BODY = json.dumps({"choices": [{"message": {"content": "ok"}}]}).encode()
+
+
+class StubServer:
+    """Минимальный HTTP/1.1 сервер с keep-alive, считающий открытые соединения."""
+
+    def __init__(self, handshake_delay: float) -> None:
+        self.handshake_delay = handshake_delay
+        self.connections = 0
+        self._server: asyncio.base_events.Server | None = None
+
+    async def start(self) -> int:
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.connections += 1
+        await asyncio.sleep(self.handshake_delay)
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                length = 0
+                for line in head.split(b"\r\n"):
+                    name, _, value = line.partition(b":")
+                    if name.strip().lower() == b"content-length":
+                        length = int(value)
+                await reader.readexactly(length)
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                    b"Content-Length: " + str(len(RESPONSE_BODY)).encode() + b"\r\n\r\n" + RESPONSE_BODY
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+async def request_per_client(base_url: str) -> None:
+    """Прежний способ: клиент создаётся и закрывается на каждый запрос."""
+    client = httpx.AsyncClient(
+        base_url=base_url,
+        headers={"Authorization": f"Bearer {settings.venice_api_key}"},
+        timeout=30.0,
+    )
+    try:
+        response = await client.post("/chat/completions", json={"model": settings.venice_model, "messages": []})
+        response.raise_for_status()
+    finally:
+        await client.aclose()
+
+
+async def request_pooled() -> None:
+    """Новый способ: VeniceClient поверх общего пула."""
+    client = VeniceClient()
+    try:
+        await client.generate_reply("bench", [])
+    finally:
+        await client.close()
+
+
+async def run_mode(mode: str, server: StubServer, base_url: str, requests: int, concurrency: int) -> dict[str, float]:
+    latencies: list[float] = []
+    semaphore = asyncio.Semaphore(concurrency)
+    connections_before = server.connections
+
+    async def one() -> None:
+        async with semaphore:
+            started = time.perf_counter()
+            if mode == "per-request":
+                await request_per_client(base_url)
+            else:
+                await request_pooled()
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(requests)))
+    duration = time.perf_counter() - started
+    await close_http_clients()
+
+    latencies.sort()
+    return {
+        "rps": requests / duration,
+        "latency_p50_ms": statistics.median(latencies) * 1000,
+        "latency_p95_ms": latencies[int(len(latencies) * 0.95) - 1] * 1000,
+        "connections": server.connections - connections_before,
+    }
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=500, help="Количество запросов в каждом режиме")
+    parser.add_argument("--concurrency", type=int, default=10, help="Одновременных запросов")
+    parser.add_argument("--handshake-ms", type=float, default=30.0, help="Имитация установки соединения (мс)")
+    args = parser.parse_args()
+
+    server = StubServer(args.handshake_ms / 1000)
+    port = await server.start()
+    base_url = f"http://127.0.0.1:{port}/api/v1"
+    settings.venice_api_base_url = base_url
+
+    print(
+        f"Запросов: {args.requests}, одновременно {args.concurrency}, "
+        f"установка соединения {args.handshake_ms:.0f} мс\n"
+    )
+    print(f"{'режим':<14}{'req/s':>10}{'p50, мс':>12}{'p95, мс':>12}{'соединений':>12}")
+    try:
+        for mode in ("per-request", "pooled"):
+            stats = await run_mode(mode, server, base_url, args.requests, args.concurrency)
+            print(
+                f"{mode:<14}{stats['rps']:>10.0f}{stats['latency_p50_ms']:>12.1f}"
+                f"{stats['latency_p95_ms']:>12.1f}{stats['connections']:>12}"
+            )
+    finally:
+        await server.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,103 @@
+"""Микробенчмарк кодеков задач очереди на типичной задаче GENERATE_REPLY.
+
+Задача - системный промпт персонажа и история из 30 сообщений. Для каждого
+варианта замеряются размер payload, время упаковки и разбора, включая
+прежний путь (model_dump_json + json.loads + QueueTask(**dict)).
+Redis не нужен.
+
+    python bench_task_codec.py --messages 30 --number 2000
+"""
+import argparse
+import json
+import random
+import time
+import timeit
+import uuid
+
+from app.services.queue_service import QueueTask, TaskType
+from app.services.task_codec import decode_task, encode_task, get_task_codec
+
+PHRASES = [
+    "Привет! Как прошёл твой день?",
+    "Я сегодня весь день думала о тебе и о нашей вчерашней прогулке по набережной.",
+    "Расскажи, что тебе больше всего понравилось в том фильме, который ты смотрел?",
+    "*улыбается и поправляет волосы* Знаешь, мне очень приятно, когда ты пишешь мне по вечерам.",
+    "Давай в выходные сходим в кафе, где подают тот самый вишнёвый пирог?",
+    "Мне кажется, ты сегодня какой-то задумчивый. Что-то случилось на работе?",
+]
+
+
+def make_reply_task(messages: int) -> QueueTask:
+    """Собирает задачу генерации ответа, похожую на реальную."""
+    rng = random.Random(42)
+    history = [
+        {
+            "role": "user" if i % 2 == 0 else "assistant",
+            "content": " ".join(rng.choice(PHRASES) for _ in range(rng.randint(1, 4))),
+        }
+        for i in range(messages)
+    ]
+    system_prompt = (
+        "Ты - Алиса, 23 года, студентка художественного училища. Общаешься тепло и игриво, "
+        "используешь описания действий в звёздочках, помнишь детали прошлых разговоров. "
+    ) * 6
+    return QueueTask(
+        task_id=str(uuid.uuid4()),
+        task_type=TaskType.GENERATE_REPLY,
+        user_id=123456789,
+        data={
+            "system_prompt": system_prompt,
+            "history": history,
+            "dialog_id": 4242,
+            "user_message": history[-1]["content"],
+        },
+        created_at=time.time(),
+        lane="free",
+    )
+
+
+def measure(encode, decode, number: int) -> tuple[int, float, float]:
+    """Возвращает размер payload в байтах и время упаковки/разбора в мкс."""
+    payload = encode()
+    size = len(payload.encode("utf-8", "surrogateescape")) if isinstance(payload, str) else len(payload)
+    encode_us = min(timeit.repeat(encode, number=number, repeat=3)) / number * 1e6
+    decode_us = min(timeit.repeat(lambda: decode(payload), number=number, repeat=3)) / number * 1e6
+    return size, encode_us, decode_us
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=30, help="Сообщений в истории")
+    parser.add_argument("--number", type=int, default=2000, help="Повторов на замер")
+    args = parser.parse_args()
+
+    task = make_reply_task(args.messages)
+    variants = {
+        "legacy json": (
+            task.model_dump_json,
+            lambda payload: QueueTask(**json.loads(payload)),
+        ),
+    }
+    codec_names = ["json"]
+    try:
+        get_task_codec("msgpack")
+        codec_names.append("msgpack")
+    except ImportError:
+        print("msgpack не установлен, пропускаем\n")
+    for name in codec_names:
+        codec = get_task_codec(name)
+        for threshold, suffix in ((0, ""), (1, "+zlib")):
+            variants[f"{name}{suffix}"] = (
+                lambda codec=codec, threshold=threshold: encode_task(task, codec, threshold),
+                lambda payload: decode_task(payload, QueueTask),
+            )
+
+    print(f"GENERATE_REPLY, история {args.messages} сообщений\n")
+    print(f"{'вариант':<16}{'байт':>10}{'упаковка, мкс':>16}{'разбор, мкс':>14}")
+    for name, (encode, decode) in variants.items():
+        size, encode_us, decode_us = measure(encode, decode, args.number)
+        print(f"{name:<16}{size:>10}{encode_us:>16.1f}{decode_us:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
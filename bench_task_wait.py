@@ -0,0 +1,128 @@
+"""Бенчмарк ожидания результата задачи: поллинг get_task против уведомлений pub/sub.
+
+Запускает N одновременных ожидающих, имитирует воркер, который завершает задачи
+со случайной задержкой, и замеряет:
+- нагрузку на Redis (команд в секунду по INFO stats),
+- задержку между завершением задачи воркером и пробуждением ожидающего.
+
+Использует отдельные префиксы ключей, поэтому не мешает рабочим очередям.
+
+    python bench_task_wait.py --waiters 500
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import time
+
+from app.services.queue_service import QueueService, TaskStatus, TaskType
+
+BENCH_PREFIX = "ai_girls:bench:"
+# Интервал опроса в старой реализации wait_for_task_result
+POLL_INTERVAL = 0.2
+
+
+def make_service() -> QueueService:
+    """Создаёт сервис очередей с изолированными ключами бенчмарка."""
+    # Все ключи (счётчики, индекс результатов, реестр воркеров) сервис
+    # выводит из этих префиксов
+    return QueueService(
+        queue_prefix=f"{BENCH_PREFIX}queue:",
+        result_prefix=f"{BENCH_PREFIX}result:",
+        events_channel=f"{BENCH_PREFIX}events:task_done",
+    )
+
+
+async def wait_polling(service: QueueService, task_id: str, timeout: float) -> None:
+    """Прежняя реализация ожидания: get_task каждые POLL_INTERVAL секунд."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while loop.time() < deadline:
+        task = await service.get_task(task_id)
+        if task and task.status in (TaskStatus.COMPLETED, TaskStatus.FAILED):
+            return
+        await asyncio.sleep(POLL_INTERVAL)
+
+
+async def wait_notify(service: QueueService, task_id: str, timeout: float) -> None:
+    """Новая реализация ожидания через канал событий."""
+    await service.wait_for_task(task_id, timeout=timeout)
+
+
+async def commands_processed(service: QueueService) -> int:
+    info = await service._redis.info("stats")
+    return int(info["total_commands_processed"])
+
+
+async def run_mode(mode: str, waiters: int, max_delay: float, payload_size: int) -> dict[str, float]:
+    bot_side = make_service()
+    worker_side = make_service()
+    await bot_side.connect()
+    await worker_side.connect()
+
+    # Результат того же порядка, что и реальное изображение в base64
+    fake_result = {"image_base64": "A" * payload_size}
+    task_ids = [
+        await bot_side.enqueue_task(TaskType.GENERATE_IMAGE, user_id=i, data={"prompt": "bench"})
+        for i in range(waiters)
+    ]
+    for task_id in task_ids:
+        await worker_side.update_task_status(task_id, TaskStatus.PROCESSING, result=fake_result)
+
+    completed_at: dict[str, float] = {}
+    latencies: list[float] = []
+    wait = wait_polling if mode == "polling" else wait_notify
+
+    async def waiter(task_id: str) -> None:
+        await wait(bot_side, task_id, timeout=max_delay + 30)
+        latencies.append(time.perf_counter() - completed_at[task_id])
+
+    async def complete(task_id: str) -> None:
+        await asyncio.sleep(random.uniform(0.5, max_delay))
+        completed_at[task_id] = time.perf_counter()
+        await worker_side.update_task_status(task_id, TaskStatus.COMPLETED)
+
+    ops_before = await commands_processed(worker_side)
+    started = time.perf_counter()
+    await asyncio.gather(
+        *(waiter(task_id) for task_id in task_ids),
+        *(complete(task_id) for task_id in task_ids),
+    )
+    duration = time.perf_counter() - started
+    ops_after = await commands_processed(worker_side)
+
+    # Удаляем все ключи бенчмарка: очереди, результаты, счётчики, индексы
+    bench_keys = [key async for key in worker_side._redis.scan_iter(match=f"{BENCH_PREFIX}*")]
+    if bench_keys:
+        await worker_side._redis.delete(*bench_keys)
+    await bot_side.disconnect()
+    await worker_side.disconnect()
+
+    latencies.sort()
+    return {
+        "ops_per_sec": (ops_after - ops_before) / duration,
+        "latency_p50_ms": statistics.median(latencies) * 1000,
+        "latency_p95_ms": latencies[int(len(latencies) * 0.95) - 1] * 1000,
+        "latency_max_ms": latencies[-1] * 1000,
+    }
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--waiters", type=int, default=500, help="Количество одновременных ожидающих")
+    parser.add_argument("--max-delay", type=float, default=5.0, help="Максимальное время 'генерации' (сек)")
+    parser.add_argument("--payload-size", type=int, default=200_000, help="Размер результата задачи (байт)")
+    args = parser.parse_args()
+
+    print(f"Ожидающих: {args.waiters}, время генерации 0.5-{args.max_delay} с, результат {args.payload_size} байт\n")
+    print(f"{'режим':<10}{'ops/s':>12}{'p50, мс':>12}{'p95, мс':>12}{'max, мс':>12}")
+    for mode in ("polling", "notify"):
+        stats = await run_mode(mode, args.waiters, args.max_delay, args.payload_size)
+        print(
+            f"{mode:<10}{stats['ops_per_sec']:>12.0f}{stats['latency_p50_ms']:>12.1f}"
+            f"{stats['latency_p95_ms']:>12.1f}{stats['latency_max_ms']:>12.1f}"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
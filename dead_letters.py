@@ -0,0 +1,70 @@
+"""Просмотр и повторная постановка задач из dead-letter списка очереди.
+
+В dead-letter список попадают задачи, упавшие с временной ошибкой
+(сеть, таймаут, 429/5xx), для которых повторов больше нет.
+
+    python dead_letters.py list --limit 20
+    python dead_letters.py requeue <task_id>
+    python dead_letters.py requeue --all
+"""
+import argparse
+import asyncio
+import time
+
+from app.services.queue_service import create_queue_service
+
+
+async def list_dead_letters(limit: int) -> None:
+    """Печатает последние задачи из dead-letter списка."""
+    service = create_queue_service()
+    try:
+        entries = await service.get_dead_letters(limit)
+        if not entries:
+            print("Dead-letter список пуст")
+            return
+        for entry in entries:
+            task = entry["task"]
+            failed_at = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry["failed_at"]))
+            print(
+                f"{task['task_id']}  {task['task_type']:<22} user={task['user_id']:<12} "
+                f"попыток={task.get('attempt', 0) + 1}  {failed_at}  {entry['error']}"
+            )
+    finally:
+        await service.disconnect()
+
+
+async def requeue(task_ids: list[str], requeue_all: bool) -> None:
+    """Ставит задачи из dead-letter списка в очередь заново."""
+    service = create_queue_service()
+    try:
+        if requeue_all:
+            task_ids = [entry["task"]["task_id"] for entry in await service.get_dead_letters(limit=None)]
+        for task_id in task_ids:
+            if await service.requeue_dead_letter(task_id):
+                print(f"{task_id}: поставлена заново")
+            else:
+                print(f"{task_id}: нет в dead-letter списке или результат уже никто не ждёт")
+    finally:
+        await service.disconnect()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    list_parser = commands.add_parser("list", help="Показать задачи")
+    list_parser.add_argument("--limit", type=int, default=50, help="Сколько последних задач показать")
+    requeue_parser = commands.add_parser("requeue", help="Поставить задачи в очередь заново")
+    requeue_parser.add_argument("task_ids", nargs="*", help="ID задач")
+    requeue_parser.add_argument("--all", action="store_true", help="Все задачи из списка")
+    args = parser.parse_args()
+
+    if args.command == "list":
+        asyncio.run(list_dead_letters(args.limit))
+    elif not args.task_ids and not args.all:
+        parser.error("укажите ID задач или --all")
+    else:
+        asyncio.run(requeue(args.task_ids, args.all))
+
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,7 @@ from app.config import settings
 from app.db import engine
 from app.models import Base
 from app.repositories.girls import ensure_all_girls
+from app.services.http_pool import close_http_clients
 
 # Настройка логирования
 logging.basicConfig(
@@ -109,7 +110,29 @@ async def main() -> None:
     bot = Bot(settings.bot_token)
     dp = setup_dispatcher()
 
-    await dp.start_polling(bot)
+    if settings.queue_backend != "memory":
+        try:
+            await dp.start_polling(bot)
+        finally:
+            # Пулы соединений к Venice живут всё время работы бота
+            await close_http_clients()
+        return
+
+    # Очередь в памяти: воркер обрабатывает задачи в event loop бота
+    # и разделяет с ним сервис очередей и хранилище изображений
+    from app.services.blob_store import blob_store
+    from app.services.queue_service import queue_service
+    from app.workers.queue_worker import QueueWorker
+
+    worker = QueueWorker(queue_service=queue_service, blob_store=blob_store)
+    worker_run = asyncio.create_task(worker.start())
+    try:
+        await dp.start_polling(bot)
+    finally:
+        await worker.stop()
+        await asyncio.gather(worker_run, return_exceptions=True)
+        # Пулы соединений закрываются после задач воркера, которые ими пользуются
+        await close_http_clients()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,10 @@
+import os
+import sys
+from pathlib import Path
+
+# Настройки обязательны при импорте app.config; тестам реальные значения не нужны
+os.environ.setdefault("BOT_TOKEN", "123456:test")
+os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite:///:memory:")
+os.environ.setdefault("VENICE_API_KEY", "test")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,132 @@
+"""Жизненный цикл задачи в очереди на бэкенде в памяти и на списках Redis (fakeredis)."""
+import asyncio
+
+import pytest
+
+from app.services import queue_service as queue_module
+from app.services.memory_queue_service import MemoryQueueService
+from app.services.queue_service import QueueService, TaskStatus, TaskType
+
+# Пустая очередь не блокирует тест дольше этого (секунды)
+_DEQUEUE_TIMEOUT = 0.1
+
+
+@pytest.fixture(params=["memory", "list"])
+def service(request, monkeypatch) -> QueueService:
+    if request.param == "memory":
+        return MemoryQueueService()
+    fakeredis = pytest.importorskip("fakeredis")
+    server = fakeredis.FakeServer()
+
+    async def from_url(url, **kwargs):
+        return fakeredis.FakeAsyncRedis(server=server, **kwargs)
+
+    monkeypatch.setattr(queue_module.redis, "from_url", from_url)
+    return QueueService()
+
+
+def run(service: QueueService, scenario) -> None:
+    """Выполняет сценарий на подключённом сервисе."""
+    async def main() -> None:
+        await service.connect()
+        try:
+            await scenario(service)
+        finally:
+            await service.disconnect()
+
+    asyncio.run(main())
+
+
+async def take(service: QueueService):
+    """Забирает одну задачу ответов или None, если очередь пуста."""
+    tasks = await service.dequeue_tasks([TaskType.GENERATE_REPLY], timeout=_DEQUEUE_TIMEOUT)
+    assert len(tasks) <= 1
+    return tasks[0] if tasks else None
+
+
+def test_complete_and_release(service):
+    async def scenario(service):
+        task_id = await service.enqueue_task(TaskType.GENERATE_REPLY, user_id=1, data={"text": "hi"})
+        assert (await service.get_task(task_id)).status == TaskStatus.PENDING
+
+        task = await take(service)
+        assert task.task_id == task_id
+        assert task.data == {"text": "hi"}
+        assert (await service.get_task(task_id)).status == TaskStatus.PROCESSING
+
+        assert await service.update_task_status(task_id, TaskStatus.COMPLETED, result={"reply": "hello"})
+        await service.ack_task(task_id)
+        done = await service.get_task(task_id)
+        assert done.status == TaskStatus.COMPLETED
+        assert done.result == {"reply": "hello"}
+        # Финальный статус больше не меняется
+        assert not await service.update_task_status(task_id, TaskStatus.FAILED, error="late")
+
+        assert await service.release_task(task_id)
+        assert await service.get_task(task_id) is None
+        assert not await service.release_task(task_id)
+        assert await take(service) is None
+
+    run(service, scenario)
+
+
+def test_cancel_pending(service):
+    async def scenario(service):
+        task_id = await service.enqueue_task(TaskType.GENERATE_REPLY, user_id=1, data={})
+        assert await service.cancel_task(task_id)
+        assert (await service.get_task(task_id)).status == TaskStatus.CANCELLED
+        # Отменённую задачу воркер пропускает
+        assert await take(service) is None
+        assert await service.release_task(task_id)
+
+    run(service, scenario)
+
+
+def test_cancel_running_requires_flag(service):
+    async def scenario(service):
+        task_id = await service.enqueue_task(TaskType.GENERATE_REPLY, user_id=1, data={})
+        assert (await take(service)).task_id == task_id
+        assert not await service.cancel_task(task_id)
+        assert await service.cancel_task(task_id, include_running=True)
+        # Результат отменённой задачи не сохраняется
+        assert not await service.update_task_status(task_id, TaskStatus.COMPLETED, result={"reply": "x"})
+        await service.ack_task(task_id)
+        assert (await service.get_task(task_id)).status == TaskStatus.CANCELLED
+        assert await service.release_task(task_id)
+
+    run(service, scenario)
+
+
+def test_retry_after_transient_error(service):
+    async def scenario(service):
+        task_id = await service.enqueue_task(TaskType.GENERATE_REPLY, user_id=1, data={})
+        task = await take(service)
+        assert await service.retry_task(task, "timeout", delay=0)
+        retried = await service.get_task(task_id)
+        assert retried.status == TaskStatus.PENDING
+        assert retried.error == "timeout"
+
+        assert await service.promote_delayed_tasks() == 1
+        again = await take(service)
+        assert again.task_id == task_id
+        assert again.attempt == 1
+
+        assert await service.update_task_status(task_id, TaskStatus.COMPLETED, result={"reply": "ok"})
+        await service.ack_task(task_id)
+        assert (await service.get_task(task_id)).result == {"reply": "ok"}
+        assert await service.release_task(task_id)
+
+    run(service, scenario)
+
+
+def test_retry_of_cancelled_task_is_refused(service):
+    async def scenario(service):
+        task_id = await service.enqueue_task(TaskType.GENERATE_REPLY, user_id=1, data={})
+        task = await take(service)
+        assert await service.cancel_task(task_id, include_running=True)
+        assert not await service.retry_task(task, "timeout", delay=0)
+        await service.ack_task(task_id)
+        assert await service.promote_delayed_tasks() == 0
+        assert await take(service) is None
+
+    run(service, scenario)
@@ -1,13 +1,29 @@
 """Скрипт для запуска воркера обработки задач из очереди Redis."""
+import argparse
 import asyncio
 import logging
 
-from app.workers.queue_worker import main
+from app.config import settings
+from app.workers.queue_worker import default_limits, main
+from app.workers.supervisor import resolve_process_count, run_supervisor
 
 if __name__ == "__main__":
     logging.basicConfig(
         level=logging.INFO,
         format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
     )
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="Воркер очереди задач")
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=settings.worker_processes,
+        help="Число процессов воркера (0 - по числу ядер, 1 - один процесс без супервизора)",
+    )
+    args = parser.parse_args()
 
+    limits = default_limits()
+    processes = resolve_process_count(args.processes, limits)
+    if processes == 1:
+        asyncio.run(main())
+    else:
+        run_supervisor(processes, limits)